@@ -0,0 +1,518 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from main import (ConnectionManager, HospitalDB, MIGRATIONS, PATIENT_LIST, DOCTOR_LIST,
+                  APPOINTMENT_LIST, RECORD_LIST, BILL_LIST, CALENDAR_LIST, DOCTOR_CALENDAR_LIST,
+                  new_uid, parse_uid, patient_keys, time_of, timestamp_of, uid_text)
+
+# Patients per scale; everything else is generated in proportion
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+DOCTORS_PER_PATIENT = 1 / 200
+APPOINTMENTS_PER_PATIENT = 3
+RECORDS_PER_PATIENT = 2
+BILLS_PER_PATIENT = 2
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda',
+               'David', 'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph',
+               'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen', 'Aarav', 'Priya', 'Rahul',
+               'Ananya', 'Vikram', 'Sneha', 'Arjun', 'Kavya', 'Rohan', 'Meera', 'Omar',
+               'Fatima', 'Chen', 'Mei', 'Hiroshi', 'Yuki', 'Carlos', 'Sofia', 'Ivan', 'Olga']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis',
+              'Rodriguez', 'Martinez', 'Sharma', 'Patel', 'Singh', 'Kumar', 'Gupta', 'Reddy',
+              'Iyer', 'Nair', 'Khan', 'Ali', 'Wang', 'Li', 'Zhang', 'Tanaka', 'Sato',
+              'Hernandez', 'Lopez', 'Wilson', 'Anderson', 'Taylor', 'Thomas', 'Moore',
+              'Jackson', 'Martin', 'Lee', 'Thompson', 'White', 'Harris', 'Clark', 'Lewis']
+STREETS = ['Main St', 'Park Ave', 'MG Road', 'Station Rd', 'High St', 'Lake View',
+           'Church St', 'Hill Rd', 'Market St', 'Ring Rd']
+CITIES = ['Mumbai', 'Delhi', 'Pune', 'Chennai', 'Bengaluru', 'Springfield', 'Riverside',
+          'Fairview', 'Kolkata', 'Hyderabad']
+SPECIALIZATIONS = ['Cardiology', 'Dermatology', 'Neurology', 'Orthopedics', 'Pediatrics',
+                   'Psychiatry', 'Radiology', 'General Medicine', 'Oncology', 'ENT']
+DIAGNOSES = ['Hypertension', 'Type 2 diabetes', 'Migraine', 'Asthma', 'Influenza',
+             'Fracture', 'Dermatitis', 'Anxiety', 'Bronchitis', 'Back pain']
+MEDICINES = ['Paracetamol', 'Amoxicillin', 'Metformin', 'Amlodipine', 'Ibuprofen',
+             'Cetirizine', 'Omeprazole', 'Salbutamol', 'Atorvastatin', 'Sertraline']
+GENDERS = ['Male', 'Female', 'Other']
+BLOOD_GROUPS = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
+BATCH_SIZE = 50000
+
+def uid_source(rng, start_ms=1735689600000):
+    # UUIDv7 public IDs on a clock that ticks one millisecond per ID, so
+    # generated rows are in time order and the same seed gives the same IDs
+    clock = itertools.count(start_ms)
+    return lambda: new_uid(next(clock), rng.getrandbits(80))
+
+def person_name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+def phone(rng):
+    return f"9{rng.randrange(10 ** 9):09d}"
+
+def insert_batches(conn, table, columns, rows):
+    sql = (f"INSERT INTO {table} ({', '.join(columns)}) "
+           f"VALUES ({', '.join('?' for _ in columns)})")
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(sql, batch)
+            conn.commit()
+            batch = []
+    conn.executemany(sql, batch)
+    conn.commit()
+
+def generate(path, patients, seed=1, out=sys.stderr):
+    # Builds a database through the app's own migrations, then fills it in
+    # batched transactions. Integer keys are assigned in order and uids are
+    # drawn from the seeded generator, so the same scale and seed always
+    # give the same data.
+    rng = random.Random(seed)
+    new_id = uid_source(rng)
+    manager = ConnectionManager(path)
+    conn = manager.writer
+    started = time.perf_counter()
+    today = datetime(2026, 1, 1)
+    history_days = 3 * 365
+
+    def day(offset):
+        return (today - timedelta(days=offset)).strftime('%Y-%m-%d')
+
+    doctors = max(10, int(patients * DOCTORS_PER_PATIENT))
+    insert_batches(conn, 'doctors',
+                   ('doctor_id', 'uid', 'name', 'specialization', 'phone', 'email'),
+                   ((d, new_id(), 'Dr. ' + person_name(rng),
+                     SPECIALIZATIONS[d % len(SPECIALIZATIONS)], phone(rng),
+                     f"doctor{d}@hospital.example")
+                    for d in range(1, doctors + 1)))
+    insert_batches(conn, 'doctor_hours',
+                   ('doctor_id', 'weekday', 'start_time', 'end_time', 'slot_minutes'),
+                   ((d, weekday, '09:00', '17:00', 15)
+                    for d in range(1, doctors + 1) for weekday in range(5)))
+    print(f"{doctors:,} doctors", file=out)
+
+    insert_batches(conn, 'patients',
+                   ('patient_id', 'uid', 'name', 'age', 'gender', 'phone', 'address',
+                    'blood_group', 'phone_key', 'name_key', 'birth_year'),
+                   ((p, new_id(), name, age, gender, number,
+                     f"{rng.randrange(1, 500)} {rng.choice(STREETS)}, {rng.choice(CITIES)}",
+                     rng.choice(BLOOD_GROUPS)) + patient_keys(name, age, number, today.year)
+                    for p in range(1, patients + 1)
+                    for name, age, gender, number in [(person_name(rng), rng.randrange(1, 95),
+                                                       rng.choice(GENDERS), phone(rng))]))
+    print(f"{patients:,} patients", file=out)
+
+    def appointments():
+        for _ in range(patients * APPOINTMENTS_PER_PATIENT):
+            offset = rng.randrange(-60, history_days)
+            starts_at = timestamp_of(today - timedelta(days=offset)) + (9 * 60 + 15 * rng.randrange(32)) * 60
+            yield (new_id(), rng.randint(1, patients), rng.randint(1, doctors), starts_at, 15,
+                   'Scheduled' if offset < 0 else rng.choice(['Completed', 'Completed', 'Cancelled']))
+    insert_batches(conn, 'appointments',
+                   ('uid', 'patient_id', 'doctor_id', 'starts_at', 'duration', 'status'),
+                   appointments())
+    print(f"{patients * APPOINTMENTS_PER_PATIENT:,} appointments", file=out)
+
+    # Records go in first so their prescriptions' foreign keys resolve
+    total = patients * RECORDS_PER_PATIENT
+    for first in range(0, total, BATCH_SIZE):
+        records, prescriptions = [], []
+        for record_id in range(first + 1, first + 1 + min(BATCH_SIZE, total - first)):
+            records.append((record_id, new_id(), rng.randint(1, patients),
+                            rng.randint(1, doctors), day(rng.randrange(history_days)),
+                            rng.choice(DIAGNOSES), 'Medication and rest',
+                            'Follow up in two weeks'))
+            for _ in range(rng.randrange(4)):
+                prescriptions.append((new_id(), record_id, rng.choice(MEDICINES),
+                                      f"{rng.choice([250, 500, 650])} mg",
+                                      rng.choice(['Once daily', 'Twice daily', 'As needed']),
+                                      f"{rng.randrange(3, 30)} days"))
+        insert_batches(conn, 'medical_records',
+                       ('record_id', 'uid', 'patient_id', 'doctor_id', 'date', 'diagnosis',
+                        'treatment', 'notes'), records)
+        insert_batches(conn, 'prescriptions',
+                       ('uid', 'record_id', 'medicine_name', 'dosage',
+                        'frequency', 'duration'), prescriptions)
+    print(f"{total:,} medical records", file=out)
+
+    insert_batches(conn, 'bills',
+                   ('uid', 'patient_id', 'date', 'description', 'amount', 'status'),
+                   ((new_id(), rng.randint(1, patients), day(rng.randrange(history_days)),
+                     rng.choice(['Consultation', 'Lab tests', 'Pharmacy', 'X-ray', 'Surgery']),
+                     round(rng.uniform(100, 20000), 2), rng.choice(['Paid', 'Paid', 'Pending']))
+                    for _ in range(patients * BILLS_PER_PATIENT)))
+    print(f"{patients * BILLS_PER_PATIENT:,} bills", file=out)
+
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    manager.close()
+    print(f"Generated {path} in {time.perf_counter() - started:.1f}s", file=out)
+
+def percentile(samples, fraction):
+    # Nearest-rank percentile of an already sorted list
+    index = max(0, min(len(samples) - 1, int(round(fraction * len(samples) + 0.5)) - 1))
+    return samples[index]
+
+def summarize(samples, errors):
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'errors': errors,
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+    }
+
+class Benchmark:
+    # Times the database calls behind each UI action, using a HospitalDB
+    # wired like a DBExecutor worker: its own writer and read-only reader.
+    def __init__(self, path, iterations=200, warmup=10, seed=1):
+        self.manager = ConnectionManager(path)
+        self.manager.prepare()
+        self.db = HospitalDB(self.manager, reader=self.manager.connect(readonly=True))
+        self.iterations = iterations
+        self.warmup = warmup
+        self.rng = random.Random(seed)
+        self.counts = {table: self.db.reader.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+                       for table in ('patients', 'doctors', 'appointments', 'medical_records',
+                                     'prescriptions', 'bills')}
+        # Default Treeview height plus PagedTreeview's prefetch margin
+        self.page_size = 10 + 25
+        self.count_cap = 10000
+        self.feed_seq = None
+
+    def random_uid(self, table):
+        # Rowids are dense in generated data; retry across any gaps
+        while True:
+            row = self.db.reader.execute(f'SELECT uid FROM {table} WHERE rowid = ?',
+                                         (self.rng.randint(1, self.counts[table]),)).fetchone()
+            if row is not None:
+                return row[0]
+
+    def random_id(self, table):
+        # The public ID as the UI passes it to HospitalDB
+        return uid_text(self.random_uid(table))
+
+    def list_refresh(self, query, params=()):
+        # PagedTreeview.refresh(): capped count plus the first page
+        self.db.count_rows(query, params, self.count_cap)
+        return self.db.fetch_page(query, params, None, self.page_size)
+
+    def list_scroll(self, query, params=()):
+        # PagedTreeview.load_more() from a random point in the list
+        after = self.rng.randint(1, self.counts[query.source.split()[0]])
+        return self.db.fetch_page(query, params, (after,), self.page_size)
+
+    def search(self, search_type):
+        if search_type.endswith('ID'):
+            term = '%04x' % self.rng.getrandbits(16)
+        elif search_type.endswith('Name'):
+            term = self.rng.choice(FIRST_NAMES)[:self.rng.randint(2, 5)]
+        else:
+            term = f"{self.rng.choice(FIRST_NAMES)} {self.rng.choice(CITIES)[:3]}"
+        return self.db.search(search_type, term)
+
+    def calendar(self, days, doctor=False):
+        # A day or week of the calendar tab, anywhere in the generated history
+        first = timestamp_of(datetime(2026, 1, 1) - timedelta(days=self.rng.randrange(3 * 365)))
+        if doctor:
+            return self.list_refresh(DOCTOR_CALENDAR_LIST,
+                                     (self.random_uid('doctors'), first, first + days * 86400))
+        return self.list_refresh(CALENDAR_LIST, (first, first + days * 86400))
+
+    def reports(self):
+        # The reports pane for a month of the generated history
+        return self.db.get_reports(f"{2023 + self.rng.randrange(3)}-{1 + self.rng.randrange(12):02d}")
+
+    def book_appointment(self):
+        day = datetime(2026, 1, 5) + timedelta(days=self.rng.randrange(365))
+        while day.weekday() >= 5:
+            day += timedelta(days=1)
+        try:
+            return self.db.book_appointment(self.random_id('patients'),
+                                            self.random_id('doctors'),
+                                            day.strftime('%Y-%m-%d'),
+                                            time_of(9 * 60 + 15 * self.rng.randrange(32)))
+        except ValueError:
+            # A taken slot is a normal outcome at the front desk
+            return None
+
+    def save_record(self):
+        return self.db.add_medical_record(
+            self.random_id('patients'), self.random_id('doctors'),
+            self.rng.choice(DIAGNOSES), 'Medication and rest', 'Benchmark visit',
+            [(self.rng.choice(MEDICINES), '500 mg', 'Twice daily', '5 days')
+             for _ in range(self.rng.randrange(1, 4))])
+
+    def poll_changes(self):
+        # Another desk's bill reaching an open bill list: the change feed's
+        # poll and the fetch of the new row. Joining the feed first turns on
+        # the change log triggers.
+        if self.feed_seq is None:
+            self.feed_seq = self.db.join_change_feed('benchmark')
+        patient_id = self.random_id('patients')
+        self.db.add_bill(patient_id, 'Consultation', round(self.rng.uniform(100, 20000), 2))
+        reset, self.feed_seq, rows = self.db.read_changes(self.feed_seq)
+        for seq, table, row_id, operation in rows:
+            self.db.fetch_row(BILL_LIST, (parse_uid(patient_id),), row_id)
+
+    def find_duplicates(self):
+        # The registration check, for someone registered before under a
+        # slightly different spelling
+        name, age, gender, number, address = self.db.reader.execute(
+            'SELECT name, age, gender, phone, address FROM patients WHERE uid = ?',
+            (self.random_uid('patients'),)).fetchone()
+        return self.db.find_duplicate_patients(name.replace('a', 'e', 1), age, gender, number,
+                                               address)
+
+    def cases(self):
+        patient = lambda: (self.random_uid('patients'),)
+        return [
+            ('refresh_patient_list', lambda: self.list_refresh(PATIENT_LIST)),
+            ('scroll_patient_list', lambda: self.list_scroll(PATIENT_LIST)),
+            ('refresh_doctor_list', lambda: self.list_refresh(DOCTOR_LIST)),
+            ('refresh_appointment_list', lambda: self.list_refresh(APPOINTMENT_LIST)),
+            ('scroll_appointment_list', lambda: self.list_scroll(APPOINTMENT_LIST)),
+            ('calendar_day', lambda: self.calendar(1)),
+            ('calendar_week', lambda: self.calendar(7)),
+            ('calendar_doctor_week', lambda: self.calendar(7, doctor=True)),
+            ('perform_search[Patient ID]', lambda: self.search('Patient ID')),
+            ('perform_search[Patient Name]', lambda: self.search('Patient Name')),
+            ('perform_search[Patient (any field)]', lambda: self.search('Patient (any field)')),
+            ('perform_search[Doctor Name]', lambda: self.search('Doctor Name')),
+            ('refresh_records', lambda: self.list_refresh(RECORD_LIST, patient())),
+            ('view_record_details', lambda: self.db.get_record_details(
+                [row[-1] for row in self.list_refresh(RECORD_LIST, patient())])),
+            ('refresh_bills', lambda: self.list_refresh(BILL_LIST, patient())),
+            ('find_free_slots', lambda: self.db.find_free_slots(
+                self.random_id('doctors'), None, 10)),
+            ('pick_patient', lambda: self.db.pick('Patient', person_name(self.rng)[:3])),
+            ('pick_patient[phone]', lambda: self.db.pick('Patient', phone(self.rng)[:5])),
+            ('pick_doctor', lambda: self.db.pick('Doctor', person_name(self.rng).split()[1][:4])),
+            ('find_duplicate_patients', self.find_duplicates),
+            ('register_patient', lambda: self.db.add_patient(
+                person_name(self.rng), self.rng.randrange(1, 95), self.rng.choice(GENDERS),
+                phone(self.rng), 'Benchmark address', self.rng.choice(BLOOD_GROUPS))),
+            ('refresh_reports', self.reports),
+            ('book_appointment', self.book_appointment),
+            ('save_record', self.save_record),
+            ('generate_bill', lambda: self.db.add_bill(
+                self.random_id('patients'), 'Consultation', round(self.rng.uniform(100, 20000), 2))),
+            ('poll_changes', self.poll_changes),
+        ]
+
+    def write_load(self, desks, writes_per_desk):
+        # Desks saving at the same time, each on its own thread with its own
+        # HospitalDB as DBExecutor workers have: registrations, bookings,
+        # records and bills in turn. IDs are drawn up front because the
+        # shared reader belongs to this thread.
+        plans = [[(self.random_id('patients'), self.random_id('doctors'),
+                   datetime(2027, 1, 4) + timedelta(days=self.rng.randrange(365)),
+                   self.rng.randrange(32)) for _ in range(writes_per_desk)]
+                 for _ in range(desks)]
+        samples, errors = [], [0]
+        lock = threading.Lock()
+
+        def desk(plan):
+            db = HospitalDB(self.manager, reader=self.manager.connect(readonly=True))
+            for number, (patient, doctor, day, slot) in enumerate(plan):
+                started = time.perf_counter()
+                try:
+                    kind = number % 4
+                    if kind == 0:
+                        db.add_patient('Load Test', 40, 'Other', '9000000000', 'Desk', 'O+')
+                    elif kind == 1:
+                        db.book_appointment(patient, doctor, day.strftime('%Y-%m-%d'),
+                                            time_of(9 * 60 + 15 * slot))
+                    elif kind == 2:
+                        db.add_medical_record(patient, doctor, 'Checkup', 'Rest', 'Load test',
+                                              [('Paracetamol', '500 mg', 'Twice daily', '3 days')])
+                    else:
+                        db.add_bill(patient, 'Consultation', 500.0)
+                except ValueError:
+                    # A taken slot or closed day is a normal outcome
+                    pass
+                except sqlite3.Error:
+                    with lock:
+                        errors[0] += 1
+                with lock:
+                    samples.append(time.perf_counter() - started)
+            db.reader.close()
+
+        threads = [threading.Thread(target=desk, args=(plan,)) for plan in plans]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return dict(summarize(samples, errors[0]),
+                    writes_per_s=round(len(samples) / elapsed, 1))
+
+    def run(self, only=None, out=sys.stderr):
+        results = {}
+        for name, case in self.cases():
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            for _ in range(self.warmup):
+                case()
+            samples, errors = [], 0
+            for _ in range(self.iterations):
+                started = time.perf_counter()
+                try:
+                    case()
+                except sqlite3.Error:
+                    errors += 1
+                samples.append(time.perf_counter() - started)
+            results[name] = summarize(samples, errors)
+            print(f"{name:<40} p50 {results[name]['p50_ms']:>9.3f} ms  "
+                  f"p95 {results[name]['p95_ms']:>9.3f} ms  "
+                  f"p99 {results[name]['p99_ms']:>9.3f} ms", file=out)
+        if self.feed_seq is not None:
+            # The write load below runs with no views open, as before
+            self.db.leave_change_feed('benchmark')
+            self.feed_seq = None
+        for desks in (1, 8):
+            name = f'concurrent_writes[{desks} desks]'
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            results[name] = self.write_load(desks, max(1, self.iterations * 4 // desks))
+            print(f"{name:<40} p50 {results[name]['p50_ms']:>9.3f} ms  "
+                  f"p95 {results[name]['p95_ms']:>9.3f} ms  "
+                  f"p99 {results[name]['p99_ms']:>9.3f} ms  "
+                  f"{results[name]['writes_per_s']:,.0f} writes/s", file=out)
+        return results
+
+    def close(self):
+        self.db.reader.close()
+        self.manager.close()
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def template_path(data_dir, scale, seed):
+    # Templates are tied to the schema version so a migration forces a rebuild
+    return os.path.join(data_dir, f"bench-{scale}-seed{seed}-v{len(MIGRATIONS)}.db")
+
+def run_generate(args):
+    if os.path.exists(args.output):
+        print(f"Error: {args.output} already exists", file=sys.stderr)
+        return 1
+    generate(args.output, SCALES[args.scale], args.seed)
+
+def run_benchmarks(args):
+    os.makedirs(args.data_dir, exist_ok=True)
+    template = template_path(args.data_dir, args.scale, args.seed)
+    if not os.path.exists(template):
+        generate(template + '.tmp', SCALES[args.scale], args.seed)
+        os.replace(template + '.tmp', template)
+
+    # Writes go to a throwaway copy so every run starts from the same data
+    workdir = tempfile.mkdtemp(prefix='hms-bench-', dir=args.data_dir)
+    path = os.path.join(workdir, 'hospital.db')
+    shutil.copyfile(template, path)
+    benchmark = Benchmark(path, iterations=args.iterations, warmup=args.warmup, seed=args.seed)
+    try:
+        results = benchmark.run(args.only.split(',') if args.only else None)
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'scale': args.scale,
+                'seed': args.seed,
+                'iterations': args.iterations,
+                'rows': benchmark.counts,
+                'db_bytes': os.path.getsize(template),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'run_at': datetime.now().isoformat(timespec='seconds'),
+            },
+            'results': results,
+        }
+    finally:
+        benchmark.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+def run_compare(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+    for key in ('scale', 'seed'):
+        if baseline['meta'].get(key) != candidate['meta'].get(key):
+            print(f"Warning: runs differ in {key} ({baseline['meta'].get(key)} vs "
+                  f"{candidate['meta'].get(key)})", file=sys.stderr)
+    print(f"{'case':<40} {'baseline p95':>13} {'candidate p95':>14} {'change':>8}")
+    regressions = 0
+    for name, result in candidate['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f"{name:<40} {'-':>13} {result['p95_ms']:>12.3f}ms {'new':>8}")
+            continue
+        change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+        flag = ' !' if change > args.threshold else ''
+        regressions += bool(flag)
+        print(f"{name:<40} {before['p95_ms']:>11.3f}ms {result['p95_ms']:>12.3f}ms "
+              f"{change:>+7.1f}%{flag}")
+    return 1 if regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hospital Management System benchmarks")
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help="time the SQL paths behind the UI actions")
+    run_parser.add_argument('--scale', choices=sorted(SCALES), default='10k')
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--iterations', type=int, default=200)
+    run_parser.add_argument('--warmup', type=int, default=10)
+    run_parser.add_argument('--only', help="comma-separated case name prefixes")
+    run_parser.add_argument('--data-dir', default='.bench',
+                            help="where generated databases are kept between runs")
+    run_parser.add_argument('--output', help="JSON results file (default: stdout)")
+
+    generate_parser = commands.add_parser('generate', help="write a synthetic database")
+    generate_parser.add_argument('output')
+    generate_parser.add_argument('--scale', choices=sorted(SCALES), default='10k')
+    generate_parser.add_argument('--seed', type=int, default=1)
+
+    compare_parser = commands.add_parser('compare', help="compare two result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=20,
+                                help="p95 slowdown in percent reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        return run_generate(args)
+    if args.command == 'compare':
+        return run_compare(args)
+    if args.command == 'run':
+        return run_benchmarks(args)
+    parser.print_help()
+
+if __name__ == "__main__":
+    sys.exit(main())
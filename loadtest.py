@@ -0,0 +1,301 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmark import (BLOOD_GROUPS, DIAGNOSES, FIRST_NAMES, GENDERS, MEDICINES, SCALES,
+                       generate, git_commit, person_name, phone, summarize, template_path)
+from main import (BILL_LIST, ConnectionManager, HospitalDB, PATIENT_LIST, ServiceClient,
+                  time_of, uid_text)
+
+# How often each desk does what, roughly a front desk's day: mostly looking
+# things up, with a save every few actions
+WORKLOAD = [
+    ('refresh_patient_list', 3), ('refresh_bills', 2), ('search', 2), ('pick_patient', 2),
+    ('poll_changes', 2), ('register_patient', 1), ('book_appointment', 1),
+    ('save_record', 1), ('generate_bill', 1),
+]
+# Default Treeview height plus PagedTreeview's prefetch margin, as in benchmark.py
+PAGE_SIZE = 10 + 25
+COUNT_CAP = 10000
+ACK_S = 2
+
+class Desk:
+    # One workstation's database calls, made either straight on the file
+    # like a DBExecutor worker or through a HospitalService
+    def __init__(self, number, path, service, patients, doctors, seed):
+        self.number = number
+        self.rng = random.Random(seed * 1000 + number)
+        self.patients = patients
+        self.doctors = doctors
+        self.subscriber = f'loadtest-{os.getpid()}'
+        if service:
+            self.manager = None
+            self.db = ServiceClient(service)
+        else:
+            self.manager = ConnectionManager(path)
+            self.manager.prepare()
+            self.db = HospitalDB(self.manager, reader=self.manager.connect(readonly=True))
+
+    def call(self, name, *args):
+        if self.manager is None:
+            return self.db.call(name, args)
+        return getattr(self.db, name)(*args)
+
+    def list_refresh(self, query, params=()):
+        # PagedTreeview.refresh(): capped count plus the first page
+        self.call('count_rows', query, params, COUNT_CAP)
+        return self.call('fetch_page', query, params, None, PAGE_SIZE)
+
+    def patient(self):
+        return uid_text(self.rng.choice(self.patients))
+
+    def doctor(self):
+        return uid_text(self.rng.choice(self.doctors))
+
+    def run_action(self, name):
+        if name == 'refresh_patient_list':
+            self.list_refresh(PATIENT_LIST)
+        elif name == 'refresh_bills':
+            self.list_refresh(BILL_LIST, (self.rng.choice(self.patients),))
+        elif name == 'search':
+            self.call('search', 'Patient Name', self.rng.choice(FIRST_NAMES)[:self.rng.randint(2, 5)])
+        elif name == 'pick_patient':
+            self.call('pick', 'Patient', person_name(self.rng)[:3], 10)
+        elif name == 'poll_changes':
+            # ChangeFeed.poll(), acknowledging every few seconds as the UI does
+            result = self.call('read_changes', self.seq)
+            if result:
+                reset, self.seq, rows = result
+            if time.monotonic() - self.acknowledged_at >= ACK_S:
+                restart = self.call('acknowledge_changes', self.subscriber, self.seq)
+                if restart is not None:
+                    self.seq = restart
+                self.acknowledged_at = time.monotonic()
+        elif name == 'register_patient':
+            self.call('add_patient', person_name(self.rng), self.rng.randrange(1, 95),
+                      self.rng.choice(GENDERS), phone(self.rng), 'Load test address',
+                      self.rng.choice(BLOOD_GROUPS))
+        elif name == 'book_appointment':
+            day = datetime(2027, 1, 4) + timedelta(days=self.rng.randrange(365))
+            self.call('book_appointment', self.patient(), self.doctor(), day.strftime('%Y-%m-%d'),
+                      time_of(9 * 60 + 15 * self.rng.randrange(32)))
+        elif name == 'save_record':
+            self.call('add_medical_record', self.patient(), self.doctor(),
+                      self.rng.choice(DIAGNOSES), 'Medication and rest', 'Load test visit',
+                      [(self.rng.choice(MEDICINES), '500 mg', 'Twice daily', '5 days')
+                       for _ in range(self.rng.randrange(1, 4))])
+        elif name == 'generate_bill':
+            self.call('add_bill', self.patient(), 'Consultation',
+                      round(self.rng.uniform(100, 20000), 2))
+
+    def run(self, actions, think_ms, start_at):
+        names = [name for name, weight in WORKLOAD]
+        weights = [weight for name, weight in WORKLOAD]
+        samples = {name: [] for name in names}
+        errors = {name: 0 for name in names}
+        refused = 0
+        self.seq = self.call('join_change_feed', self.subscriber)
+        self.acknowledged_at = time.monotonic()
+        # Every desk starts at once, after all of them have connected
+        time.sleep(max(0, start_at - time.time()))
+        for _ in range(actions):
+            name = self.rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                self.run_action(name)
+            except ValueError:
+                # A taken slot or closed day is a normal outcome at the desk
+                refused += 1
+            except (sqlite3.Error, ConnectionError, RuntimeError):
+                errors[name] += 1
+            samples[name].append(time.perf_counter() - started)
+            if think_ms:
+                time.sleep(self.rng.expovariate(1000 / think_ms))
+        self.call('leave_change_feed', self.subscriber)
+        return samples, errors, refused
+
+    def close(self):
+        if self.manager is None:
+            self.db.close()
+        else:
+            self.db.reader.close()
+            self.manager.close()
+
+def desk_process(number, path, service, patients, doctors, seed, actions, think_ms, start_at,
+                 results):
+    desk = None
+    try:
+        desk = Desk(number, path, service, patients, doctors, seed)
+        results.put(desk.run(actions, think_ms, start_at))
+    except BaseException as e:
+        # The parent waits for one report per desk
+        results.put(repr(e))
+        raise
+    finally:
+        if desk is not None:
+            desk.close()
+
+def sample_ids(path, count=2000):
+    # IDs are drawn up front so desks don't spend their time finding them
+    conn = sqlite3.connect(path)
+    try:
+        return [[uid for (uid,) in conn.execute(
+                    f'SELECT uid FROM {table} ORDER BY random() LIMIT ?', (count,))]
+                for table in ('patients', 'doctors')]
+    finally:
+        conn.close()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_service(path, readers, timeout=60):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'),
+         '--db', path, 'serve', '--port', str(port), '--readers', str(readers)],
+        stdout=subprocess.DEVNULL)
+    client = ServiceClient(url, timeout=5)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                client.status()
+                return server, url
+            except ConnectionError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    stop_service(server)
+                    raise RuntimeError(f"The service on {url} did not start")
+                time.sleep(0.1)
+    finally:
+        client.close()
+
+def stop_service(server):
+    # SIGINT lets the service finish its requests and close the database
+    if server.poll() is None:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+def run_mode(mode, template, workdir, args, out=sys.stderr):
+    # Every mode gets its own copy so they start from the same data
+    path = os.path.join(workdir, f'{mode}.db')
+    shutil.copyfile(template, path)
+    patients, doctors = sample_ids(path)
+    server, url = start_service(path, args.readers) if mode == 'service' else (None, None)
+    try:
+        results = multiprocessing.Queue()
+        start_at = time.time() + 1 + args.desks * 0.05
+        desks = [multiprocessing.Process(target=desk_process, args=(
+                    number, path, url, patients, doctors, args.seed, args.actions,
+                    args.think_ms, start_at, results))
+                 for number in range(args.desks)]
+        for desk in desks:
+            desk.start()
+        reports = [results.get() for _ in desks]
+        elapsed = time.time() - start_at
+        for desk in desks:
+            desk.join()
+    finally:
+        if server is not None:
+            stop_service(server)
+    failed = [report for report in reports if isinstance(report, str)]
+    if failed:
+        raise RuntimeError(f"{len(failed)} desk(s) failed: {failed[0]}")
+
+    operations = {}
+    for name, weight in WORKLOAD:
+        samples = [sample for report in reports for sample in report[0][name]]
+        if samples:
+            operations[name] = summarize(samples, sum(report[1][name] for report in reports))
+    actions = sum(result['n'] for result in operations.values())
+    result = {
+        'desks': args.desks,
+        'actions': actions,
+        'errors': sum(result['errors'] for result in operations.values()),
+        'refused': sum(report[2] for report in reports),
+        'elapsed_s': round(elapsed, 2),
+        'actions_per_s': round(actions / elapsed, 1),
+        'operations': operations,
+    }
+    print(f"{mode}: {args.desks} desks, {actions:,} actions in {elapsed:.1f}s "
+          f"({result['actions_per_s']:,.0f}/s), {result['errors']} errors", file=out)
+    for name, summary in operations.items():
+        print(f"  {name:<24} p50 {summary['p50_ms']:>9.3f} ms  p95 {summary['p95_ms']:>9.3f} ms  "
+              f"p99 {summary['p99_ms']:>9.3f} ms", file=out)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Simulate many desks using one hospital database at once")
+    parser.add_argument('--mode', choices=['service', 'direct', 'both'], default='both',
+                        help="desks call a local service, open the file themselves, or both "
+                             "one after the other")
+    parser.add_argument('--desks', type=int, default=16)
+    parser.add_argument('--actions', type=int, default=200, help="actions per desk")
+    parser.add_argument('--think-ms', type=float, default=20,
+                        help="average pause between a desk's actions")
+    parser.add_argument('--readers', type=int, default=4,
+                        help="the service's read-only connections")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='10k')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data-dir', default='.bench',
+                        help="where generated databases are kept between runs")
+    parser.add_argument('--output', help="JSON results file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    template = template_path(args.data_dir, args.scale, args.seed)
+    if not os.path.exists(template):
+        generate(template + '.tmp', SCALES[args.scale], args.seed)
+        os.replace(template + '.tmp', template)
+
+    workdir = tempfile.mkdtemp(prefix='hms-load-', dir=args.data_dir)
+    try:
+        modes = ['direct', 'service'] if args.mode == 'both' else [args.mode]
+        results = {mode: run_mode(mode, template, workdir, args) for mode in modes}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'scale': args.scale,
+            'seed': args.seed,
+            'desks': args.desks,
+            'actions_per_desk': args.actions,
+            'think_ms': args.think_ms,
+            'readers': args.readers,
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'run_at': datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    sys.exit(main())
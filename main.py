@@ -1,76 +1,2881 @@
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 import sqlite3
-from datetime import datetime
+import os
+import pathlib
+from datetime import datetime, timedelta
 import hashlib
 import uuid
+import argparse
+import re
+import sys
+import threading
+import queue
+import itertools
+import bisect
+import concurrent.futures
+import csv
+import json
+import time
+import gzip
+import zipfile
+import io
+import functools
+import random
+import shutil
+import struct
+import difflib
+import unicodedata
+import http.client
+import http.server
+import hmac
+import ipaddress
+import signal
+import urllib.parse
+from collections import OrderedDict, deque
 
-class HospitalDB:
-    def __init__(self):
-        self.conn = sqlite3.connect('hospital.db')
-        self.create_tables()
+def new_uid(ms=None, random_bits=None):
+    # Public IDs are UUIDv7: 48 bits of Unix time in milliseconds followed
+    # by random bits, stored as 16 bytes. New IDs sort after older ones, so
+    # the uid indexes grow at their right edge.
+    if ms is None:
+        ms = time.time_ns() // 1000000
+    if random_bits is None:
+        random_bits = int.from_bytes(os.urandom(10), 'big')
+    value = ms << 80 | random_bits
+    value = value & ~(0xf << 76) | 0x7 << 76
+    value = value & ~(0x3 << 62) | 0x2 << 62
+    return value.to_bytes(16, 'big')
+
+def uid_text(uid):
+    # Same text as str(uuid.UUID(bytes=uid)) at a fifth of the cost; it
+    # runs for every row of every list page
+    if uid is None:
+        return None
+    h = uid.hex()
+    return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+def parse_uid(text, kind='record'):
+    try:
+        return uuid.UUID(str(text).strip()).bytes
+    except ValueError:
+        raise ValueError(f"Invalid {kind} ID {text!r}")
+
+def uid_from_text(text):
+    # Databases before migrate_compact_ids stored uuid4 text; anything
+    # that does not parse gets a fresh ID
+    try:
+        return uuid.UUID(text).bytes
+    except (TypeError, ValueError, AttributeError):
+        return new_uid()
+
+# Appointment starts are whole seconds since 1970-01-01 00:00 on the
+# hospital's wall clock, with no time zone, so SQLite's 'unixepoch'
+# modifier gives back the same local date and time
+EPOCH = datetime(1970, 1, 1)
+
+def timestamp_of(moment):
+    return (moment - EPOCH) // timedelta(seconds=1)
+
+def start_from_text(date, time_of_day):
+    # Appointments booked before times were validated may hold anything;
+    # those that cannot be read give None
+    text = f"{date or ''} {time_of_day or ''}".strip()
+    for pattern in ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %I:%M %p'):
+        try:
+            return timestamp_of(datetime.strptime(text, pattern))
+        except ValueError:
+            pass
+    return None
+
+# Rows are referred to by integer keys inside the database and by uid
+# everywhere else
+KEY_TABLES = {
+    'patient': ('patients', 'patient_id'),
+    'doctor': ('doctors', 'doctor_id'),
+}
+
+def lookup_key(conn, kind, public_id):
+    table, key = KEY_TABLES[kind]
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT {key} FROM {table} WHERE uid = ?', (parse_uid(public_id, kind),))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(f"Unknown {kind} ID {public_id!r}")
+    return row[0]
+
+def migrate_base_schema(cursor):
+    # Create Users table for login
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        password TEXT NOT NULL,
+        role TEXT NOT NULL
+    )''')
+
+    # Create Patients table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS patients (
+        patient_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        age INTEGER,
+        gender TEXT,
+        phone TEXT,
+        address TEXT,
+        blood_group TEXT
+    )''')
+
+    # Create Doctors table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS doctors (
+        doctor_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        specialization TEXT,
+        phone TEXT,
+        email TEXT
+    )''')
+
+    # Create Appointments table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS appointments (
+        appointment_id TEXT PRIMARY KEY,
+        patient_id TEXT,
+        doctor_id TEXT,
+        date TEXT,
+        time TEXT,
+        status TEXT,
+        FOREIGN KEY (patient_id) REFERENCES patients (patient_id),
+        FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id)
+    )''')
+
+    # Create Medical Records table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS medical_records (
+        record_id TEXT PRIMARY KEY,
+        patient_id TEXT,
+        doctor_id TEXT,
+        date TEXT,
+        diagnosis TEXT,
+        treatment TEXT,
+        notes TEXT,
+        FOREIGN KEY (patient_id) REFERENCES patients (patient_id),
+        FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id)
+    )''')
+
+    # Create Prescriptions table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS prescriptions (
+        prescription_id TEXT PRIMARY KEY,
+        record_id TEXT,
+        medicine_name TEXT,
+        dosage TEXT,
+        frequency TEXT,
+        duration TEXT,
+        FOREIGN KEY (record_id) REFERENCES medical_records (record_id)
+    )''')
+
+    # Create Bills table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS bills (
+        bill_id TEXT PRIMARY KEY,
+        patient_id TEXT,
+        date TEXT,
+        description TEXT,
+        amount REAL,
+        status TEXT,
+        FOREIGN KEY (patient_id) REFERENCES patients (patient_id)
+    )''')
+
+    # Insert default admin user if not exists
+    cursor.execute('''
+    INSERT OR IGNORE INTO users (username, password, role)
+    VALUES (?, ?, ?)
+    ''', ('admin', hashlib.sha256('admin123'.encode()).hexdigest(), 'admin'))
+
+def migrate_access_path_indexes(cursor):
+    # Medical history and bills are listed per patient, newest first
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_medical_records_patient_date
+    ON medical_records (patient_id, date)''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_bills_patient_date
+    ON bills (patient_id, date)''')
     
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        # Create Users table for login
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            password TEXT NOT NULL,
-            role TEXT NOT NULL
-        )''')
-        
-        # Create Patients table
+    # Doctor schedules and a patient's appointments. Once date and time
+    # are replaced by starts_at, migrate_appointment_times indexes that.
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(appointments)')]
+    if 'date' in columns:
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            patient_id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            age INTEGER,
-            gender TEXT,
-            phone TEXT,
-            address TEXT,
-            blood_group TEXT
-        )''')
-        
-        # Create Doctors table
+        CREATE INDEX IF NOT EXISTS idx_appointments_doctor_date_time
+        ON appointments (doctor_id, date, time)''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_appointments_patient
+    ON appointments (patient_id)''')
+    
+    # Prescriptions are always read through their record
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_prescriptions_record
+    ON prescriptions (record_id)''')
+
+def fts5_available(cursor):
+    options = [row[0] for row in cursor.execute('PRAGMA compile_options')]
+    return 'ENABLE_FTS5' in options
+
+def migrate_search_index(cursor):
+    # External-content FTS5 tables index the searchable columns without
+    # storing a second copy of the rows. SearchEngine falls back to plain
+    # queries on SQLite builds without FTS5.
+    if not fts5_available(cursor):
+        return
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5 (
+        name, phone, address,
+        content='patients', content_rowid='rowid', prefix='1 2 3 4'
+    )''')
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS doctors_fts USING fts5 (
+        name, specialization, phone,
+        content='doctors', content_rowid='rowid', prefix='1 2 3 4'
+    )''')
+    
+    # Keep the indexes in step with their content tables
+    for table, columns in (('patients', 'name, phone, address'),
+                           ('doctors', 'name, specialization, phone')):
+        new_values = ', '.join('new.' + c for c in columns.split(', '))
+        old_values = ', '.join('old.' + c for c in columns.split(', '))
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts (rowid, {columns}) VALUES (new.rowid, {new_values});
+        END''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {columns})
+            VALUES ('delete', old.rowid, {old_values});
+        END''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {columns})
+            VALUES ('delete', old.rowid, {old_values});
+            INSERT INTO {table}_fts (rowid, {columns}) VALUES (new.rowid, {new_values});
+        END''')
+        cursor.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+def migrate_import_tables(cursor):
+    # External IDs from other clinics' systems, so later files can refer
+    # to patients and doctors imported earlier
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS import_id_map (
+        source TEXT NOT NULL,
+        entity TEXT NOT NULL,
+        external_id TEXT NOT NULL,
+        internal_id TEXT NOT NULL,
+        PRIMARY KEY (source, entity, external_id)
+    ) WITHOUT ROWID''')
+    
+    # Progress of each import, committed together with the rows it covers
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS import_checkpoints (
+        source TEXT NOT NULL,
+        entity TEXT NOT NULL,
+        path TEXT NOT NULL,
+        records_done INTEGER NOT NULL,
+        rows_imported INTEGER NOT NULL,
+        rows_rejected INTEGER NOT NULL,
+        indexes_deferred INTEGER NOT NULL DEFAULT 0,
+        completed INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT,
+        PRIMARY KEY (source, entity, path)
+    )''')
+
+def migrate_scheduling(cursor):
+    # Appointments occupy [time, time + duration) on the doctor's calendar
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(appointments)')]
+    if 'duration' not in columns:
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS doctors (
-            doctor_id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            specialization TEXT,
-            phone TEXT,
-            email TEXT
-        )''')
-        
-        # Create Appointments table
+        ALTER TABLE appointments ADD COLUMN duration INTEGER NOT NULL DEFAULT 30''')
+
+    # Weekly working hours per doctor, split into bookable slots
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS doctor_hours (
+        doctor_id TEXT NOT NULL,
+        weekday INTEGER NOT NULL,
+        start_time TEXT NOT NULL,
+        end_time TEXT NOT NULL,
+        slot_minutes INTEGER NOT NULL DEFAULT 30,
+        PRIMARY KEY (doctor_id, weekday),
+        FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id)
+    ) WITHOUT ROWID''')
+
+    # Free-slot search by specialization
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_doctors_specialization
+    ON doctors (specialization COLLATE NOCASE)''')
+
+def migrate_compact_ids(cursor):
+    # Tables were keyed on uuid4 text, which scattered inserts over the
+    # B-trees and repeated 36 bytes in every foreign key and index. Each
+    # table is rebuilt with an INTEGER PRIMARY KEY under the same column
+    # name, keeping its rowids, and the old ID becomes a 16-byte uid.
+    # Foreign keys are rewritten to the parents' integer keys.
+    cursor.connection.create_function('uid_from_text', 1, uid_from_text)
+    cursor.execute('''
+    CREATE TABLE patients_new (
+        patient_id INTEGER PRIMARY KEY,
+        uid BLOB NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        age INTEGER,
+        gender TEXT,
+        phone TEXT,
+        address TEXT,
+        blood_group TEXT
+    )''')
+    cursor.execute('''
+    INSERT INTO patients_new
+    SELECT rowid, uid_from_text(patient_id), name, age, gender, phone, address, blood_group
+    FROM patients''')
+
+    cursor.execute('''
+    CREATE TABLE doctors_new (
+        doctor_id INTEGER PRIMARY KEY,
+        uid BLOB NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        specialization TEXT,
+        phone TEXT,
+        email TEXT
+    )''')
+    cursor.execute('''
+    INSERT INTO doctors_new
+    SELECT rowid, uid_from_text(doctor_id), name, specialization, phone, email
+    FROM doctors''')
+
+    cursor.execute('''
+    CREATE TABLE appointments_new (
+        appointment_id INTEGER PRIMARY KEY,
+        uid BLOB NOT NULL UNIQUE,
+        patient_id INTEGER,
+        doctor_id INTEGER,
+        date TEXT,
+        time TEXT,
+        status TEXT,
+        duration INTEGER NOT NULL DEFAULT 30,
+        FOREIGN KEY (patient_id) REFERENCES patients_new (patient_id),
+        FOREIGN KEY (doctor_id) REFERENCES doctors_new (doctor_id)
+    )''')
+    cursor.execute('''
+    INSERT INTO appointments_new
+    SELECT a.rowid, uid_from_text(a.appointment_id), p.rowid, d.rowid,
+           a.date, a.time, a.status, a.duration
+    FROM appointments a
+    LEFT JOIN patients p ON p.patient_id = a.patient_id
+    LEFT JOIN doctors d ON d.doctor_id = a.doctor_id''')
+
+    cursor.execute('''
+    CREATE TABLE medical_records_new (
+        record_id INTEGER PRIMARY KEY,
+        uid BLOB NOT NULL UNIQUE,
+        patient_id INTEGER,
+        doctor_id INTEGER,
+        date TEXT,
+        diagnosis TEXT,
+        treatment TEXT,
+        notes TEXT,
+        FOREIGN KEY (patient_id) REFERENCES patients_new (patient_id),
+        FOREIGN KEY (doctor_id) REFERENCES doctors_new (doctor_id)
+    )''')
+    cursor.execute('''
+    INSERT INTO medical_records_new
+    SELECT m.rowid, uid_from_text(m.record_id), p.rowid, d.rowid,
+           m.date, m.diagnosis, m.treatment, m.notes
+    FROM medical_records m
+    LEFT JOIN patients p ON p.patient_id = m.patient_id
+    LEFT JOIN doctors d ON d.doctor_id = m.doctor_id''')
+
+    cursor.execute('''
+    CREATE TABLE prescriptions_new (
+        prescription_id INTEGER PRIMARY KEY,
+        uid BLOB NOT NULL UNIQUE,
+        record_id INTEGER,
+        medicine_name TEXT,
+        dosage TEXT,
+        frequency TEXT,
+        duration TEXT,
+        FOREIGN KEY (record_id) REFERENCES medical_records_new (record_id)
+    )''')
+    cursor.execute('''
+    INSERT INTO prescriptions_new
+    SELECT pr.rowid, uid_from_text(pr.prescription_id), m.rowid,
+           pr.medicine_name, pr.dosage, pr.frequency, pr.duration
+    FROM prescriptions pr
+    LEFT JOIN medical_records m ON m.record_id = pr.record_id''')
+
+    cursor.execute('''
+    CREATE TABLE bills_new (
+        bill_id INTEGER PRIMARY KEY,
+        uid BLOB NOT NULL UNIQUE,
+        patient_id INTEGER,
+        date TEXT,
+        description TEXT,
+        amount REAL,
+        status TEXT,
+        FOREIGN KEY (patient_id) REFERENCES patients_new (patient_id)
+    )''')
+    cursor.execute('''
+    INSERT INTO bills_new
+    SELECT b.rowid, uid_from_text(b.bill_id), p.rowid,
+           b.date, b.description, b.amount, b.status
+    FROM bills b
+    LEFT JOIN patients p ON p.patient_id = b.patient_id''')
+
+    cursor.execute('''
+    CREATE TABLE doctor_hours_new (
+        doctor_id INTEGER NOT NULL,
+        weekday INTEGER NOT NULL,
+        start_time TEXT NOT NULL,
+        end_time TEXT NOT NULL,
+        slot_minutes INTEGER NOT NULL DEFAULT 30,
+        PRIMARY KEY (doctor_id, weekday),
+        FOREIGN KEY (doctor_id) REFERENCES doctors_new (doctor_id)
+    ) WITHOUT ROWID''')
+    cursor.execute('''
+    INSERT INTO doctor_hours_new
+    SELECT d.rowid, h.weekday, h.start_time, h.end_time, h.slot_minutes
+    FROM doctor_hours h JOIN doctors d ON d.doctor_id = h.doctor_id''')
+
+    # Imported rows are found again by their integer key
+    cursor.execute('''
+    CREATE TABLE import_id_map_new (
+        source TEXT NOT NULL,
+        entity TEXT NOT NULL,
+        external_id TEXT NOT NULL,
+        internal_id INTEGER NOT NULL,
+        PRIMARY KEY (source, entity, external_id)
+    ) WITHOUT ROWID''')
+    for entity, key in (('patients', 'patient_id'), ('doctors', 'doctor_id'),
+                        ('appointments', 'appointment_id')):
+        cursor.execute(f'''
+        INSERT INTO import_id_map_new
+        SELECT m.source, m.entity, m.external_id, t.rowid
+        FROM import_id_map m JOIN {entity} t ON t.{key} = m.internal_id
+        WHERE m.entity = ?''', (entity,))
+
+    # Children go first so no foreign key is left pointing at a dropped
+    # table; renaming the new tables also renames their references
+    tables = ['import_id_map', 'doctor_hours', 'prescriptions', 'bills',
+              'medical_records', 'appointments', 'doctors', 'patients']
+    for table in tables:
+        cursor.execute(f'DROP TABLE {table}')
+    for table in tables:
+        cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+    # Indexes and search triggers went with the old tables. Rowids are
+    # unchanged, so the search indexes still match their content.
+    migrate_access_path_indexes(cursor)
+    migrate_search_index(cursor)
+    migrate_scheduling(cursor)
+
+def migrate_appointment_times(cursor):
+    # Free-text date and time columns become one starts_at timestamp, so
+    # day, week and calendar queries are range scans. Rows whose text
+    # cannot be read keep it in entered_as with no start.
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(appointments)')]
+    if 'starts_at' not in columns:
+        cursor.connection.create_function('start_from_text', 2, start_from_text)
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS appointments (
-            appointment_id TEXT PRIMARY KEY,
-            patient_id TEXT,
-            doctor_id TEXT,
-            date TEXT,
-            time TEXT,
+        CREATE TABLE appointments_new (
+            appointment_id INTEGER PRIMARY KEY,
+            uid BLOB NOT NULL UNIQUE,
+            patient_id INTEGER,
+            doctor_id INTEGER,
+            starts_at INTEGER,
+            duration INTEGER NOT NULL DEFAULT 30,
             status TEXT,
+            entered_as TEXT,
             FOREIGN KEY (patient_id) REFERENCES patients (patient_id),
             FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id)
         )''')
-        
-        # Insert default admin user if not exists
         cursor.execute('''
-        INSERT OR IGNORE INTO users (username, password, role)
-        VALUES (?, ?, ?)
-        ''', ('admin', hashlib.sha256('admin123'.encode()).hexdigest(), 'admin'))
+        INSERT INTO appointments_new
+        SELECT appointment_id, uid, patient_id, doctor_id, start, duration, status,
+               CASE WHEN start IS NULL
+                    THEN trim(coalesce(date, '') || ' ' || coalesce(time, '')) END
+        FROM (SELECT *, start_from_text(date, time) AS start FROM appointments)''')
+        cursor.execute('DROP TABLE appointments')
+        cursor.execute('ALTER TABLE appointments_new RENAME TO appointments')
+        migrate_access_path_indexes(cursor)
+
+    # A doctor's calendar, and everyone's appointments for a day or week
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_appointments_doctor_start
+    ON appointments (doctor_id, starts_at)''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_appointments_start
+    ON appointments (starts_at)''')
+
+# Hospital-wide totals, kept current by triggers on their source tables so
+# reports read a few rows per day instead of scanning bills, appointments
+# and medical records. Money is summed in whole cents, so the running
+# totals never drift from a recount. Each entry is the table definition
+# and the condition under which a row no longer counts anything.
+SUMMARY_TABLES = {
+    'revenue_daily': ('''(
+        date TEXT NOT NULL,
+        status TEXT NOT NULL,
+        bills INTEGER NOT NULL,
+        amount_cents INTEGER NOT NULL,
+        PRIMARY KEY (date, status)
+    ) WITHOUT ROWID''', 'bills = 0'),
+    'revenue_totals': ('''(
+        status TEXT PRIMARY KEY,
+        bills INTEGER NOT NULL,
+        amount_cents INTEGER NOT NULL
+    ) WITHOUT ROWID''', 'bills = 0'),
+    'patient_balances': ('''(
+        patient_id INTEGER PRIMARY KEY,
+        pending_bills INTEGER NOT NULL,
+        outstanding_cents INTEGER NOT NULL
+    )''', 'pending_bills = 0'),
+    'doctor_daily': ('''(
+        date TEXT NOT NULL,
+        doctor_id INTEGER NOT NULL,
+        appointments INTEGER NOT NULL,
+        cancelled INTEGER NOT NULL,
+        visits INTEGER NOT NULL,
+        PRIMARY KEY (date, doctor_id)
+    ) WITHOUT ROWID''', 'appointments = 0 AND visits = 0'),
+    'doctor_monthly': ('''(
+        month TEXT NOT NULL,
+        doctor_id INTEGER NOT NULL,
+        appointments INTEGER NOT NULL,
+        cancelled INTEGER NOT NULL,
+        visits INTEGER NOT NULL,
+        PRIMARY KEY (month, doctor_id)
+    ) WITHOUT ROWID''', 'appointments = 0 AND visits = 0'),
+}
+
+# How source rows are counted: (summary, source table, columns whose
+# change moves the row between summary rows, summary keys, counters,
+# condition for the row to count). Expressions name the row as {row}.
+CENTS = "CAST(round(coalesce({row}.amount, 0) * 100) AS INTEGER)"
+SUMMARY_SOURCES = [
+    ('revenue_daily', 'bills', ('date', 'status', 'amount'),
+     {'date': '{row}.date', 'status': "coalesce({row}.status, '')"},
+     {'bills': '1', 'amount_cents': CENTS},
+     '{row}.date IS NOT NULL'),
+    ('revenue_totals', 'bills', ('status', 'amount'),
+     {'status': "coalesce({row}.status, '')"},
+     {'bills': '1', 'amount_cents': CENTS},
+     'TRUE'),
+    ('patient_balances', 'bills', ('patient_id', 'status', 'amount'),
+     {'patient_id': '{row}.patient_id'},
+     {'pending_bills': '1', 'outstanding_cents': CENTS},
+     "{row}.patient_id IS NOT NULL AND {row}.status = 'Pending'"),
+    # Appointments per doctor by the day and month they fall on, visits
+    # by the date of the medical record
+    ('doctor_daily', 'appointments', ('doctor_id', 'starts_at', 'status'),
+     {'date': "date({row}.starts_at, 'unixepoch')", 'doctor_id': '{row}.doctor_id'},
+     {'appointments': '1', 'cancelled': "{row}.status IS 'Cancelled'", 'visits': '0'},
+     '{row}.doctor_id IS NOT NULL AND {row}.starts_at IS NOT NULL'),
+    ('doctor_daily', 'medical_records', ('doctor_id', 'date'),
+     {'date': '{row}.date', 'doctor_id': '{row}.doctor_id'},
+     {'appointments': '0', 'cancelled': '0', 'visits': '1'},
+     '{row}.doctor_id IS NOT NULL AND {row}.date IS NOT NULL'),
+    ('doctor_monthly', 'appointments', ('doctor_id', 'starts_at', 'status'),
+     {'month': "strftime('%Y-%m', {row}.starts_at, 'unixepoch')", 'doctor_id': '{row}.doctor_id'},
+     {'appointments': '1', 'cancelled': "{row}.status IS 'Cancelled'", 'visits': '0'},
+     '{row}.doctor_id IS NOT NULL AND {row}.starts_at IS NOT NULL'),
+    ('doctor_monthly', 'medical_records', ('doctor_id', 'date'),
+     {'month': 'substr({row}.date, 1, 7)', 'doctor_id': '{row}.doctor_id'},
+     {'appointments': '0', 'cancelled': '0', 'visits': '1'},
+     '{row}.doctor_id IS NOT NULL AND {row}.date IS NOT NULL'),
+]
+
+def summary_upsert(target, keys, counters, condition, row, sign='', source=None):
+    # Adds one trigger row (or with sign '-' takes it away) to the summary.
+    # Given a source table it adds up all of that table's rows instead.
+    key_values = [expr.format(row=row) for expr in keys.values()]
+    if source is None:
+        values = [f'{sign}({expr.format(row=row)})' for expr in counters.values()]
+        tail = f'WHERE {condition.format(row=row)}'
+    else:
+        values = [f'sum({expr.format(row=row)})' for expr in counters.values()]
+        tail = (f'FROM {source} AS {row} WHERE {condition.format(row=row)} '
+                f"GROUP BY {', '.join(key_values)}")
+    updates = ', '.join(f'{c} = {c} + excluded.{c}' for c in counters)
+    return f'''
+    INSERT INTO {target} ({', '.join(keys)}, {', '.join(counters)})
+    SELECT {', '.join(key_values + values)} {tail}
+    ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates}'''
+
+def fill_summaries(cursor, prefix='', schemas=(None,)):
+    # Recounts every summary from scratch into empty tables named
+    # prefix + summary, adding up the source tables of each schema
+    for schema in schemas:
+        for summary, source, moved, keys, counters, condition in SUMMARY_SOURCES:
+            if schema is not None:
+                source = f'{schema}.{source}'
+            cursor.execute(summary_upsert(prefix + summary, keys, counters, condition,
+                                          's', source=source))
+
+def migrate_summaries(cursor):
+    for summary, (definition, empty) in SUMMARY_TABLES.items():
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {summary} {definition}')
+    
+    # Largest balances first
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_patient_balances_outstanding
+    ON patient_balances (outstanding_cents)''')
+    
+    # An update that changes a counted column takes the old row away and
+    # adds the new one; summary rows left counting nothing are removed
+    for summary, source, moved, keys, counters, condition in SUMMARY_SOURCES:
+        name = f'{source}_summary_{summary}'
+        add = summary_upsert(summary, keys, counters, condition, 'new')
+        remove = summary_upsert(summary, keys, counters, condition, 'old', sign='-')
+        matches = ' AND '.join(f'{key} = {expr.format(row="old")}' for key, expr in keys.items())
+        remove += f''';
+    DELETE FROM {summary} WHERE {matches} AND {SUMMARY_TABLES[summary][1]}'''
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {name}_insert AFTER INSERT ON {source} BEGIN
+            {add};
+        END''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {name}_delete AFTER DELETE ON {source} BEGIN
+            {remove};
+        END''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {name}_update AFTER UPDATE OF {', '.join(moved)}
+        ON {source} BEGIN
+            {remove};
+            {add};
+        END''')
+    
+    # Start from the data already there
+    for summary in SUMMARY_TABLES:
+        cursor.execute(f'DELETE FROM {summary}')
+    fill_summaries(cursor)
+
+def migrate_date_indexes(cursor):
+    # Hospital-wide date ranges of records and bills, for analytics
+    # partitions and dated exports
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_medical_records_date
+    ON medical_records (date)''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_bills_date
+    ON bills (date)''')
+
+# Tables whose changes open views are told about, and how long (seconds) a
+# change feed reader may go without checking in before it is dropped
+CHANGE_FEED_TABLES = ('patients', 'doctors', 'appointments', 'medical_records', 'bills')
+CHANGE_FEED_TTL = 600
+
+def migrate_change_log(cursor):
+    # AUTOINCREMENT keeps sequence numbers rising after the log is pruned
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        operation TEXT NOT NULL
+    )''')
+
+    # One row per process with views open: how far it has read, and when
+    # it last checked in
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS change_subscribers (
+        subscriber TEXT PRIMARY KEY,
+        seq INTEGER NOT NULL,
+        seen_at INTEGER NOT NULL
+    )''')
+
+    # Nothing is logged while no reader is live, e.g. during a command-line
+    # import with the app closed
+    for table in CHANGE_FEED_TABLES:
+        for event, row in (('insert', 'new'), ('update', 'new'), ('delete', 'old')):
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_changes_{event} AFTER {event.upper()} ON {table}
+            WHEN EXISTS (SELECT 1 FROM change_subscribers
+                         WHERE seen_at > CAST(strftime('%s', 'now') AS INTEGER) - {CHANGE_FEED_TTL})
+            BEGIN
+                INSERT INTO change_log (table_name, row_id, operation)
+                VALUES ('{table}', {row}.rowid, '{event}');
+            END''')
+
+def join_change_log(conn, subscriber):
+    # (Re)starts a reader at the current end of the log
+    conn.execute('''
+    INSERT INTO change_subscribers (subscriber, seq, seen_at)
+    VALUES (?, coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'change_log'), 0), ?)
+    ON CONFLICT(subscriber) DO UPDATE SET seq = excluded.seq, seen_at = excluded.seen_at
+    ''', (subscriber, int(time.time())))
+    return conn.execute('SELECT seq FROM change_subscribers WHERE subscriber = ?',
+                        (subscriber,)).fetchone()[0]
+
+# Drops the log up to the slowest reader, or all of it once none are left
+CHANGE_LOG_PRUNE = '''
+DELETE FROM change_log WHERE seq <= coalesce((SELECT min(seq) FROM change_subscribers),
+                                             (SELECT max(seq) FROM change_log))'''
+
+def migrate_archive_catalog(cursor):
+    # Yearly archive files next to the database, and which patients have
+    # rows in which of them, so a history list only opens the files it needs
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archives (
+        year INTEGER PRIMARY KEY,
+        file TEXT NOT NULL
+    )''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archive_contents (
+        table_name TEXT NOT NULL,
+        patient_id INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        rows INTEGER NOT NULL,
+        PRIMARY KEY (table_name, patient_id, year)
+    ) WITHOUT ROWID''')
+
+# Closed rows that Archiver moves out: (table, the year a row belongs to,
+# rows older than the cutoff, rows that are closed). Scheduled appointments
+# and pending bills stay in the working database however old they are.
+# Prescriptions move with their medical record.
+ARCHIVE_TABLES = [
+    ('appointments', "CAST(strftime('%Y', starts_at, 'unixepoch') AS INTEGER)",
+     'starts_at < :cutoff_ts', "status IN ('Completed', 'Cancelled')"),
+    ('medical_records', 'CAST(substr(date, 1, 4) AS INTEGER)', 'date < :cutoff', 'TRUE'),
+    ('bills', 'CAST(substr(date, 1, 4) AS INTEGER)', 'date < :cutoff', "status != 'Pending'"),
+]
+
+def archive_file(conn, year):
+    # The 2021 archive of hospital.db is hospital-2021.db beside it
+    path = conn.execute('PRAGMA main.database_list').fetchone()[2]
+    stem, ext = os.path.splitext(os.path.basename(path))
+    return f'{stem}-{year}{ext}'
+
+def attach_archive(conn, year, file, readonly=True):
+    # Attached as archive_YEAR. Read-only needs a connection opened with
+    # URI filenames, as ConnectionManager's readers are.
+    schema = f'archive_{year}'
+    path = os.path.join(os.path.dirname(conn.execute('PRAGMA main.database_list').fetchone()[2]),
+                        file)
+    if readonly:
+        path = pathlib.Path(path).as_uri() + '?mode=ro'
+    conn.execute(f'ATTACH DATABASE ? AS {schema}', (path,))
+    return schema
+
+# Duplicate patients are looked for only among patients sharing a block:
+# the same phone number, or a name that sounds the same with a birth year
+# within BIRTH_YEAR_BAND. The keys are stored with each patient and indexed.
+BIRTH_YEAR_BAND = 2
+NAME_TITLES = {'mr', 'mrs', 'ms', 'miss', 'dr', 'prof'}
+SOUNDEX_CODES = {letter: digit for digit, letters in (('1', 'bfpv'), ('2', 'cgjkqsxz'),
+                                                      ('3', 'dt'), ('4', 'l'), ('5', 'mn'),
+                                                      ('6', 'r'))
+                 for letter in letters}
+
+def name_words(name):
+    # Lower-case ASCII words without titles; accents are dropped
+    text = unicodedata.normalize('NFKD', name or '').encode('ascii', 'ignore').decode()
+    return [word for word in re.findall(r'[a-z]+', text.lower()) if word not in NAME_TITLES]
+
+def soundex(word):
+    key, last = word[0].upper(), SOUNDEX_CODES.get(word[0])
+    for letter in word[1:]:
+        code = SOUNDEX_CODES.get(letter)
+        if code and code != last:
+            key += code
+        if letter not in 'hw':
+            last = code
+    return (key + '000')[:4]
+
+def phone_key(phone):
+    # The last ten digits, so '+91 98450 12345' and '9845012345' match;
+    # anything shorter than a local number is too common to block on
+    digits = re.sub(r'\D', '', phone or '')
+    return digits[-10:] if len(digits) >= 7 else None
+
+def patient_keys(name, age, phone, year=None):
+    # (phone_key, name_key, birth_year). The name key is the Soundex codes
+    # of the first and last names in either order, so 'Jon Smyth' and
+    # 'Smith, John' share a block.
+    words = name_words(name)
+    name_key = ' '.join(sorted({soundex(words[0]), soundex(words[-1])})) if words else None
+    try:
+        birth_year = (year or datetime.now().year) - int(age)
+    except (TypeError, ValueError):
+        birth_year = None
+    return phone_key(phone), name_key, birth_year
+
+def migrate_patient_blocks(cursor):
+    # Ages of patients registered earlier are taken to be as of today
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(patients)')]
+    if 'name_key' not in columns:
+        cursor.execute('ALTER TABLE patients ADD COLUMN phone_key TEXT')
+        cursor.execute('ALTER TABLE patients ADD COLUMN name_key TEXT')
+        cursor.execute('ALTER TABLE patients ADD COLUMN birth_year INTEGER')
+        # The search index and change log do not cover the new columns;
+        # their update triggers are put back once the keys are filled in
+        triggers = cursor.execute('''
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'trigger' AND tbl_name = 'patients' AND name LIKE '%_update'
+        ''').fetchall()
+        for name, sql in triggers:
+            cursor.execute(f'DROP TRIGGER {name}')
+        rows = cursor.execute('SELECT patient_id, name, age, phone FROM patients').fetchall()
+        cursor.executemany('''
+        UPDATE patients SET phone_key = ?, name_key = ?, birth_year = ?
+        WHERE patient_id = ?''', [patient_keys(name, age, phone) + (patient_id,)
+                                  for patient_id, name, age, phone in rows])
+        for name, sql in triggers:
+            cursor.execute(sql)
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_patients_phone_key
+    ON patients (phone_key)''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_patients_name_key
+    ON patients (name_key, birth_year)''')
+
+# Everyone in a new patient's blocks
+DUPLICATE_CANDIDATES = '''
+SELECT patient_id, name, birth_year, gender, phone_key, address FROM patients
+WHERE phone_key = :phone
+UNION
+SELECT patient_id, name, birth_year, gender, phone_key, address FROM patients
+WHERE name_key = :name AND (birth_year BETWEEN :year - :band AND :year + :band
+                            OR birth_year IS NULL OR :year IS NULL)
+LIMIT :block'''
+
+def migrate_name_indexes(cursor):
+    # Pickers find patients and doctors by the start of their name as it
+    # is typed, in any case
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_patients_name
+    ON patients (name COLLATE NOCASE)''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_doctors_name
+    ON doctors (name COLLATE NOCASE)''')
+
+# Ordered schema migrations; a database at PRAGMA user_version N has had
+# the first N applied. Append new steps, never reorder or edit old ones.
+MIGRATIONS = [
+    migrate_base_schema,
+    migrate_access_path_indexes,
+    migrate_search_index,
+    migrate_import_tables,
+    migrate_scheduling,
+    migrate_compact_ids,
+    migrate_appointment_times,
+    migrate_summaries,
+    migrate_date_indexes,
+    migrate_change_log,
+    migrate_archive_catalog,
+    migrate_patient_blocks,
+    migrate_name_indexes,
+]
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    if schema_version(conn) >= len(MIGRATIONS):
+        return []
+    conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Re-read under the write lock in case another process migrated first
+        version = schema_version(conn)
+        cursor = conn.cursor()
+        applied = []
+        for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            step(cursor)
+            applied.append((number, step.__name__))
+        cursor.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+def rebuild_summaries(conn, check=False):
+    # Recounts every summary table from its source rows and reports how
+    # many rows of the trigger-maintained copy differ. Unless only
+    # checking, the recount then replaces it. Archived rows still count.
+    conn.commit()
+    schemas = ['main']
+    for year, file in conn.execute('SELECT year, file FROM archives ORDER BY year').fetchall():
+        schemas.append(attach_archive(conn, year, file, readonly=False))
+    conn.execute('BEGIN' if check else 'BEGIN IMMEDIATE')
+    try:
+        cursor = conn.cursor()
+        for summary, (definition, empty) in SUMMARY_TABLES.items():
+            cursor.execute(f'CREATE TEMP TABLE fresh_{summary} {definition}')
+        fill_summaries(cursor, 'fresh_', schemas)
+        differences = []
+        for summary in SUMMARY_TABLES:
+            cursor.execute(f'''
+            SELECT (SELECT count(*) FROM (SELECT * FROM fresh_{summary}
+                                          EXCEPT SELECT * FROM main.{summary}))
+                 + (SELECT count(*) FROM (SELECT * FROM main.{summary}
+                                          EXCEPT SELECT * FROM fresh_{summary}))''')
+            differences.append((summary, cursor.fetchone()[0]))
+            if not check:
+                cursor.execute(f'DELETE FROM main.{summary}')
+                cursor.execute(f'INSERT INTO main.{summary} SELECT * FROM fresh_{summary}')
+            cursor.execute(f'DROP TABLE fresh_{summary}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        for schema in schemas[1:]:
+            conn.execute(f'DETACH DATABASE {schema}')
+    return differences
+
+class LatencyHistogram:
+    # Counts per latency bucket on a roughly logarithmic scale. Percentiles
+    # are reported as the upper bound of the bucket they fall in.
+    BOUNDS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.buckets[bisect.bisect_left(self.BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, fraction):
+        rank = max(1, -(-self.count * fraction // 1))
+        seen = 0
+        for bound, count in zip(self.BOUNDS_MS + (None,), self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(self.max_ms if bound is None else min(bound, self.max_ms), 3)
+        return 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else 0,
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max_ms, 3),
+            'buckets': {f'<={bound}': count for bound, count
+                        in zip(self.BOUNDS_MS + ('inf',), self.buckets) if count},
+        }
+
+class Metrics:
+    # Process-wide query and UI action timings. Connections report each
+    # statement through their trace callback; inside a HospitalDB call a
+    # statement's latency runs until the next statement starts or the call
+    # returns, so it includes fetching its rows. Statements above slow_ms
+    # are kept with their query plan.
+    LITERALS = re.compile(r"[xX]?'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+    IN_LISTS = re.compile(r'IN \((?:\?, )+\?\)', re.IGNORECASE)
+
+    def __init__(self, slow_ms=100, keep_slow=100):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.enabled = os.environ.get('HOSPITAL_METRICS', '1') != '0'
+        self.slow_ms = float(os.environ.get('HOSPITAL_SLOW_MS', slow_ms))
+        self.keep_slow = keep_slow
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.statements = {}
+            self.operations = {}
+            self.actions = {}
+            self.slow = deque(maxlen=self.keep_slow)
+
+    def attach(self, conn):
+        # "--" lines are statements run inside triggers and FTS5 on behalf of
+        # the statement being timed; FTS5 runs many per query, so they are
+        # dropped before any other work. Python 3.11+ repeats the outer
+        # statement's text for them instead, which traced() skips until the
+        # next execution starts (see TracedCursor).
+        if self.enabled:
+            conn.set_trace_callback(lambda sql: sql.startswith('--') or self.traced(conn, sql))
+
+    def traced(self, conn, sql):
+        now = time.perf_counter()
+        local = self.local
+        if getattr(local, 'explaining', False) or getattr(local, 'executing', None) == sql:
+            return
+        local.executing = sql
+        self.finish_statement(now)
+        # Bound values are expanded into the traced text; strip them so
+        # statements group together and no patient data is kept
+        plan_sql = ' '.join(self.LITERALS.sub('?', sql).split())
+        key = self.IN_LISTS.sub('IN (...)', plan_sql)
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = [0, LatencyHistogram()]
+            stats[0] += 1
+        if getattr(local, 'depth', 0):
+            local.current = (key, plan_sql, now, conn)
+
+    def finish_statement(self, now):
+        current = getattr(self.local, 'current', None)
+        if current is None:
+            return
+        self.local.current = None
+        key, plan_sql, started, conn = current
+        ms = (now - started) * 1000
+        with self.lock:
+            self.statements[key][1].add(ms)
+        if ms >= self.slow_ms:
+            self.local.slow.append((key, plan_sql, ms, conn))
+
+    def timed(self, fn):
+        name = fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return fn(*args, **kwargs)
+            local = self.local
+            depth = getattr(local, 'depth', 0)
+            if depth == 0:
+                local.current = None
+                local.slow = []
+            local.depth = depth + 1
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                local.depth = depth
+                if depth == 0:
+                    now = time.perf_counter()
+                    self.finish_statement(now)
+                    self.record(self.operations, name, (now - started) * 1000)
+                    for key, plan_sql, ms, conn in local.slow:
+                        self.record_slow(key, plan_sql, ms, conn, name)
+        return wrapper
+
+    def record(self, table, name, ms):
+        with self.lock:
+            histogram = table.get(name)
+            if histogram is None:
+                histogram = table[name] = LatencyHistogram()
+            histogram.add(ms)
+
+    def record_slow(self, key, plan_sql, ms, conn, operation):
+        plan = []
+        if re.match(r'\s*(SELECT|WITH)\b', plan_sql, re.IGNORECASE):
+            self.local.explaining = True
+            try:
+                plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + plan_sql,
+                                                       [None] * plan_sql.count('?'))]
+            except sqlite3.Error as e:
+                plan = [f'plan unavailable: {e}']
+            finally:
+                self.local.explaining = False
+        with self.lock:
+            self.slow.append({'at': datetime.now().isoformat(timespec='seconds'),
+                              'ms': round(ms, 3), 'operation': operation,
+                              'sql': key, 'plan': plan})
+
+    def start_action(self, name):
+        # UI actions are timed from the button press until their result is
+        # on screen; the returned callable marks the end
+        with self.lock:
+            started = self.actions.get(name)
+            if started is None:
+                started = self.actions[name] = [0, LatencyHistogram()]
+            started[0] += 1
+        begin = time.perf_counter()
+
+        def finish(*args):
+            with self.lock:
+                self.actions[name][1].add((time.perf_counter() - begin) * 1000)
+        return finish
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'generated_at': datetime.now().isoformat(timespec='seconds'),
+                'slow_query_ms': self.slow_ms,
+                'actions': {name: dict(stats[1].as_dict(), started=stats[0])
+                            for name, stats in self.actions.items()},
+                'operations': {name: histogram.as_dict()
+                               for name, histogram in self.operations.items()},
+                'statements': {sql: dict(stats[1].as_dict(), calls=stats[0])
+                               for sql, stats in self.statements.items()},
+                'slow_queries': list(self.slow),
+            }
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+METRICS = Metrics()
+
+class TracedCursor(sqlite3.Cursor):
+    # Marks where each execution starts, so a statement run again with the
+    # same values is counted again rather than taken for its own triggers
+    def execute(self, sql, parameters=()):
+        METRICS.local.executing = None
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return super().executemany(sql, self.each(seq_of_parameters))
+
+    def executescript(self, sql_script):
+        METRICS.local.executing = None
+        return super().executescript(sql_script)
+
+    @staticmethod
+    def each(seq_of_parameters):
+        # The next row's values are taken just before it runs
+        for parameters in seq_of_parameters:
+            METRICS.local.executing = None
+            yield parameters
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+class ConnectionManager:
+    # Process-wide owner of the SQLite connections. The database is opened
+    # and its schema checked once; windows borrow the shared connections.
+    _instance = None
+
+    def __init__(self, path=None, cache_size_kb=65536, mmap_size=268435456,
+                 statement_cache=256, busy_timeout_ms=5000):
+        self.path = path or os.environ.get('HOSPITAL_DB', 'hospital.db')
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.statement_cache = statement_cache
+        self.busy_timeout_ms = busy_timeout_ms
+        self._writer = None
+        self._reader = None
+        self._write_queue = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, path=None, **options):
+        if cls._instance is not None:
+            cls._instance.close()
+        cls._instance = cls(path, **options)
+        return cls._instance
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def connect(self, readonly=False, pooled=False):
+        # A pooled connection is handed from thread to thread, one at a time
+        options = dict(cached_statements=self.statement_cache, check_same_thread=not pooled,
+                       factory=TracedConnection)
+        if readonly and self.path != ':memory:':
+            uri = pathlib.Path(self.path).resolve().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, **options)
+        else:
+            conn = sqlite3.connect(self.path, **options)
+        if not readonly:
+            conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size={-int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.create_function('uid_text', 1, uid_text)
+        METRICS.attach(conn)
+        return conn
+
+    @property
+    def writer(self):
+        if self._writer is None:
+            self._writer = self.connect()
+            migrate(self._writer)
+        return self._writer
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            # The writer creates the file and schema before anyone reads it
+            writer = self.writer
+            if self.path == ':memory:':
+                self._reader = writer
+            else:
+                self._reader = self.connect(readonly=True)
+        return self._reader
+
+    @property
+    def write_queue(self):
+        # Executor workers ask for the queue at the same time; the process
+        # must end up with only one
+        if self._write_queue is None:
+            with self.lock:
+                if self._write_queue is None:
+                    self._write_queue = WriteQueue(self)
+        return self._write_queue
+
+    def prepare(self):
+        # Opening the writer applies any pending migrations
+        return self.writer
+
+    def close(self):
+        if self._write_queue is not None:
+            self._write_queue.close()
+        for conn in (self._reader, self._writer):
+            if conn is not None:
+                conn.close()
+        self._writer = None
+        self._reader = None
+        self._write_queue = None
+
+class WriteQueue:
+    # Group commit for the process's writes. Callers hand in an operation,
+    # a function of the write connection, and block until the transaction
+    # holding it has committed. One thread runs whatever queued up while the
+    # last transaction was committing (waiting up to max_wait_ms for more,
+    # if set) in a single BEGIN IMMEDIATE transaction, each operation in its
+    # own savepoint, so a failing operation is undone and reported to its
+    # caller alone.
+    def __init__(self, manager, max_batch=64, max_wait_ms=0, lock_timeout_ms=10000):
+        self.manager = manager
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.lock_timeout = lock_timeout_ms / 1000
+        self.pending = queue.Queue()
+        self.batches = 0
+        self.operations = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, operation, *args):
+        # operation is called as operation(conn, *args) inside the
+        # transaction; it must not commit or roll back itself
+        future = concurrent.futures.Future()
+        self.pending.put((future, operation, args))
+        return future
+
+    def write(self, operation, *args):
+        return self.submit(operation, *args).result()
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+
+    def run(self):
+        conn = None
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    remaining = deadline - time.perf_counter()
+                    if remaining > 0:
+                        item = self.pending.get(timeout=remaining)
+                    else:
+                        item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.pending.put(None)
+                    break
+                batch.append(item)
+            batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                if conn is None:
+                    conn = self.manager.connect()
+                    # Lock waits are retried here with backoff instead
+                    conn.execute('PRAGMA busy_timeout=0')
+                self.commit(conn, batch)
+            except Exception as e:
+                for future, operation, args in batch:
+                    if not future.done():
+                        future.set_exception(e)
+        if conn is not None:
+            conn.close()
+
+    def begin(self, conn):
+        # Another process may hold the write lock. Back off exponentially,
+        # with jitter so waiting processes do not retry in step.
+        deadline = time.perf_counter() + self.lock_timeout
+        delay = 0.001
+        while True:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                if time.perf_counter() + delay > deadline:
+                    raise sqlite3.OperationalError(
+                        "The database is busy; the change was not saved, please try again")
+                time.sleep(delay * (0.5 + random.random()))
+                delay = min(delay * 2, 0.1)
+
+    def commit(self, conn, batch):
+        self.begin(conn)
+        # A lone operation needs no savepoint; if it fails the whole
+        # transaction is rolled back
+        savepoints = len(batch) > 1
+        outcomes = []
+        try:
+            for future, operation, args in batch:
+                if savepoints:
+                    conn.execute('SAVEPOINT operation')
+                try:
+                    result = operation(conn, *args)
+                except Exception as e:
+                    if savepoints:
+                        conn.execute('ROLLBACK TO operation')
+                    outcomes.append((future, None, e))
+                else:
+                    outcomes.append((future, result, None))
+                if savepoints:
+                    conn.execute('RELEASE operation')
+            if savepoints or outcomes[0][2] is None:
+                conn.commit()
+            else:
+                conn.rollback()
+        except Exception:
+            conn.rollback()
+            raise
+        # Callers only hear back once their change is committed
+        self.batches += 1
+        self.operations += len(batch)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+class HospitalDB:
+    # Archive files attached to the reader at once; SQLite allows 10
+    MAX_ARCHIVES = 4
+
+    def __init__(self, manager=None, reader=None, writes=None):
+        self.manager = manager or ConnectionManager.get()
+        # Writes are group-committed by the process's WriteQueue; list and
+        # search queries use the read-only reader
+        self.writes = writes or self.manager.write_queue
+        self.reader = reader or self.manager.reader
+        self.search_engine = None
+        self.scheduler = None
+        self.change_version = None
+        self.archives = OrderedDict()
+
+    @METRICS.timed
+    def authenticate(self, username, password_hash):
+        cursor = self.reader.cursor()
+        cursor.execute('SELECT role FROM users WHERE username = ? AND password = ?',
+                       (username, password_hash))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    @METRICS.timed
+    def add_patient(self, name, age, gender, phone, address, blood_group):
+        def insert(conn):
+            uid = new_uid()
+            cursor = conn.cursor()
+            cursor.execute('''
+            INSERT INTO patients (uid, name, age, gender, phone, address, blood_group,
+                                  phone_key, name_key, birth_year)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (uid, name, age, gender, phone, address, blood_group)
+                 + patient_keys(name, age, phone))
+            return uid_text(uid), cursor.lastrowid
+        return self.writes.write(insert)
+
+    @METRICS.timed
+    def find_duplicate_patients(self, name, age, gender, phone, address):
+        return DuplicateFinder(self.reader).matches(name, age, gender, phone, address)
+
+    @METRICS.timed
+    def add_doctor(self, name, specialization, phone, email):
+        def insert(conn):
+            uid = new_uid()
+            cursor = conn.cursor()
+            cursor.execute('''
+            INSERT INTO doctors (uid, name, specialization, phone, email)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (uid, name, specialization, phone, email))
+            return uid_text(uid), cursor.lastrowid
+        return self.writes.write(insert)
+
+    @METRICS.timed
+    def book_appointment(self, patient_id, doctor_id, date, time, duration=None):
+        scheduler = self.get_scheduler()
+        def book(conn):
+            return scheduler.book(conn, lookup_key(conn, 'patient', patient_id),
+                                  lookup_key(conn, 'doctor', doctor_id), date, time, duration)
+        return self.writes.write(book)
+
+    @METRICS.timed
+    def set_doctor_hours(self, doctor_id, weekdays, start_time, end_time, slot_minutes):
+        scheduler = self.get_scheduler()
+        def set_hours(conn):
+            return scheduler.set_hours(conn, lookup_key(conn, 'doctor', doctor_id),
+                                       weekdays, start_time, end_time, slot_minutes)
+        return self.writes.write(set_hours)
+
+    @METRICS.timed
+    def find_free_slots(self, doctor_id=None, specialization=None, count=10):
+        if doctor_id:
+            doctor_id = lookup_key(self.reader, 'doctor', doctor_id)
+        return self.get_scheduler().free_slots(doctor_id, specialization, count)
+
+    @METRICS.timed
+    def add_medical_record(self, patient_id, doctor_id, diagnosis, treatment, notes,
+                           prescriptions):
+        def insert(conn):
+            uid = new_uid()
+            cursor = conn.cursor()
+            
+            # Save medical record
+            cursor.execute('''
+            INSERT INTO medical_records 
+            (uid, patient_id, doctor_id, date, diagnosis, treatment, notes)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (uid, lookup_key(conn, 'patient', patient_id),
+                 lookup_key(conn, 'doctor', doctor_id),
+                 datetime.now().strftime('%Y-%m-%d'), diagnosis, treatment, notes))
+            record_id = cursor.lastrowid
+            
+            # Save prescriptions
+            cursor.executemany('''
+            INSERT INTO prescriptions 
+            (uid, record_id, medicine_name, dosage, frequency, duration)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(new_uid(), record_id) + tuple(p) for p in prescriptions])
+            return uid_text(uid), record_id
+        return self.writes.write(insert)
+
+    @METRICS.timed
+    def add_bill(self, patient_id, description, amount):
+        def insert(conn):
+            uid = new_uid()
+            cursor = conn.cursor()
+            cursor.execute('''
+            INSERT INTO bills (uid, patient_id, date, description, amount, status)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (uid, lookup_key(conn, 'patient', patient_id),
+                 datetime.now().strftime('%Y-%m-%d'), description, amount, "Pending"))
+            return uid_text(uid), cursor.lastrowid
+        return self.writes.write(insert)
+
+    @METRICS.timed
+    def get_patient(self, patient_id):
+        cursor = self.reader.cursor()
+        cursor.execute('''
+        SELECT uid_text(uid), name, age, gender, phone, address, blood_group
+        FROM patients WHERE uid = ?
+        ''', (parse_uid(patient_id, 'patient'),))
+        return cursor.fetchone()
+
+    @METRICS.timed
+    def pick(self, kind, term, limit=10):
+        if self.search_engine is None:
+            self.search_engine = SearchEngine(self.reader)
+        return self.search_engine.pick(kind, term, limit)
+
+    @METRICS.timed
+    def get_record_details(self, record_rowids, patient_id=None):
+        # Records and all of their prescriptions for a batch of
+        # medical_records rowids, two indexed queries per 500 records.
+        # Given the patient's uid, records not found are looked up in the
+        # archives that hold any of that patient's records.
+        details = {}
+        self.read_record_details(record_rowids, 'main', details)
+        missing = [rowid for rowid in record_rowids if rowid not in details]
+        if missing and patient_id is not None:
+            for year in self.archived_years('medical_records', patient_id):
+                self.read_record_details(missing, self.open_archive(year), details)
+                missing = [rowid for rowid in missing if rowid not in details]
+                if not missing:
+                    break
+        return details
+
+    def read_record_details(self, record_rowids, schema, details):
+        cursor = self.reader.cursor()
+        for start in range(0, len(record_rowids), 500):
+            chunk = list(record_rowids[start:start + 500])
+            marks = ', '.join('?' for _ in chunk)
+            cursor.execute(f'''
+            SELECT m.rowid, uid_text(m.uid), m.date, d.name, m.diagnosis, m.treatment, m.notes
+            FROM {schema}.medical_records m
+            LEFT JOIN doctors d ON m.doctor_id = d.doctor_id
+            WHERE m.rowid IN ({marks})
+            ''', chunk)
+            for row in cursor.fetchall():
+                details[row[0]] = (row[1:], [])
+            cursor.execute(f'''
+            SELECT m.rowid, p.medicine_name, p.dosage, p.frequency, p.duration
+            FROM {schema}.medical_records m
+            JOIN {schema}.prescriptions p ON p.record_id = m.record_id
+            WHERE m.rowid IN ({marks})
+            ORDER BY m.rowid, p.rowid
+            ''', chunk)
+            for row in cursor.fetchall():
+                details[row[0]][1].append(row[1:])
+
+    def open_archive(self, year):
+        # Attaches a year's archive read-only on first use. Only a few stay
+        # attached; the least recently used is detached to make room.
+        if year in self.archives:
+            self.archives.move_to_end(year)
+            return self.archives[year]
+        row = self.reader.execute('SELECT file FROM archives WHERE year = ?', (year,)).fetchone()
+        if row is None:
+            raise ValueError(f"There is no archive for {year}")
+        while len(self.archives) >= self.MAX_ARCHIVES:
+            old_year, schema = self.archives.popitem(last=False)
+            self.reader.execute(f'DETACH DATABASE {schema}')
+        self.archives[year] = attach_archive(self.reader, year, row[0])
+        return self.archives[year]
+
+    def archived_years(self, table, patient_id):
+        # Years whose archive holds some of this patient's rows, newest first
+        return [year for (year,) in self.reader.execute('''
+            SELECT year FROM archive_contents
+            WHERE table_name = ? AND patient_id = (SELECT patient_id FROM patients WHERE uid = ?)
+            ORDER BY year DESC''', (table, patient_id))]
+
+    @METRICS.timed
+    def fetch_page(self, query, params, after_key, limit):
+        cursor = self.reader.cursor()
+        cursor.execute(query.page_sql(after_key), tuple(params) + tuple(after_key or ()) + (limit,))
+        rows = cursor.fetchall()
+        if not query.archived:
+            return rows
+        # Archives are read newest first, and only while the page could
+        # still take rows from their year
+        width = len(query.columns)
+        for year in self.archived_years(query.table, params[0]):
+            if after_key is not None and (after_key[0] or '') < f'{year}-01-01':
+                continue
+            if len(rows) >= limit and (rows[limit - 1][width] or '') > f'{year}-12-31':
+                break
+            cursor.execute(query.page_sql(after_key, self.open_archive(year)),
+                           tuple(params) + tuple(after_key or ()) + (limit,))
+            # A row being archived can briefly be in both places
+            merged = {tuple(row[width:]): row for row in rows + cursor.fetchall()}
+            newest = sorted(merged, key=lambda key: (key[0] is not None, key), reverse=True)
+            rows = [merged[key] for key in newest[:limit]]
+        return rows
+
+    @METRICS.timed
+    def count_rows(self, query, params, cap):
+        cursor = self.reader.cursor()
+        cursor.execute(query.count_sql(), tuple(params) + (cap + 1,))
+        count = cursor.fetchone()[0]
+        if query.archived:
+            count += cursor.execute('''
+            SELECT coalesce(sum(rows), 0) FROM archive_contents
+            WHERE table_name = ? AND patient_id = (SELECT patient_id FROM patients WHERE uid = ?)
+            ''', (query.table, params[0])).fetchone()[0]
+        return min(count, cap + 1)
+
+    @METRICS.timed
+    def fetch_row(self, query, params, row_key):
+        cursor = self.reader.cursor()
+        cursor.execute(query.row_sql(), tuple(params) + (row_key,))
+        row = cursor.fetchone()
+        if row is None and query.archived:
+            for year in self.archived_years(query.table, params[0]):
+                cursor.execute(query.row_sql(self.open_archive(year)), tuple(params) + (row_key,))
+                row = cursor.fetchone()
+                if row is not None:
+                    break
+        return row
+
+    @METRICS.timed
+    def warm_up(self, queries, page_size=35, count_cap=10000):
+        # Read the first screen of each list so its tab opens from a warm
+        # cache; the rows themselves are discarded
+        for query in queries:
+            self.count_rows(query, (), count_cap)
+            self.fetch_page(query, (), None, page_size)
+
+    @METRICS.timed
+    def get_reports(self, month, top=20):
+        # Hospital-wide figures for a YYYY-MM month, from the summaries
+        cursor = self.reader.cursor()
+        return {
+            'receivables': cursor.execute(RECEIVABLES_REPORT, ('Pending',)).fetchone(),
+            'revenue': cursor.execute(REVENUE_REPORT, (month, month)).fetchall(),
+            'doctors': cursor.execute(DOCTOR_REPORT, (month,)).fetchall(),
+            'balances': cursor.execute(BALANCE_REPORT, (top,)).fetchall(),
+        }
+
+    @METRICS.timed
+    def join_change_feed(self, subscriber):
+        return self.writes.write(join_change_log, subscriber)
+
+    @METRICS.timed
+    def acknowledge_changes(self, subscriber, seq):
+        # Records how far this reader has got, drops readers that stopped
+        # checking in and prunes what everyone has read. Returns None, or the
+        # sequence number to restart from when this reader had been dropped
+        # and may have missed changes.
+        def acknowledge(conn):
+            now = int(time.time())
+            cursor = conn.cursor()
+            cursor.execute('''
+            UPDATE change_subscribers SET seq = ?, seen_at = ?
+            WHERE subscriber = ? AND seen_at > ?''', (seq, now, subscriber, now - CHANGE_FEED_TTL))
+            restart = None if cursor.rowcount else join_change_log(conn, subscriber)
+            cursor.execute('DELETE FROM change_subscribers WHERE seen_at <= ?',
+                           (now - CHANGE_FEED_TTL,))
+            cursor.execute(CHANGE_LOG_PRUNE)
+            return restart
+        return self.writes.write(acknowledge)
+
+    @METRICS.timed
+    def leave_change_feed(self, subscriber):
+        def leave(conn):
+            conn.execute('DELETE FROM change_subscribers WHERE subscriber = ?', (subscriber,))
+            conn.execute(CHANGE_LOG_PRUNE)
+        return self.writes.write(leave)
+
+    @METRICS.timed
+    def read_changes(self, after, limit=1000):
+        # Change log rows after sequence number `after`, as (reset, last seq,
+        # rows). Returns None without touching the log when nothing was
+        # committed since this connection last looked. reset means the rows
+        # are not all there, because more than `limit` arrived or some were
+        # pruned before this reader got to them.
+        version = self.reader.execute('PRAGMA data_version').fetchone()[0]
+        if version == self.change_version:
+            return None
+        self.change_version = version
+        cursor = self.reader.cursor()
+        oldest, latest = cursor.execute('''
+        SELECT (SELECT min(seq) FROM change_log), (SELECT max(seq) FROM change_log)
+        ''').fetchone()
+        if latest is None or latest <= after:
+            return False, after, []
+        if oldest > after + 1 or latest - after > limit:
+            return True, latest, []
+        cursor.execute('''
+        SELECT seq, table_name, row_id, operation FROM change_log
+        WHERE seq > ? AND seq <= ? ORDER BY seq''', (after, latest))
+        return False, latest, cursor.fetchall()
+
+    @METRICS.timed
+    def export_patient(self, patient_id, path, tables=None):
+        # On a connection of its own, as the patient's archives may already
+        # be attached to the reader for their history lists
+        conn = self.manager.connect(readonly=True)
+        try:
+            exporter = Exporter(conn)
+            archives = exporter.attach_archives(patient_id=patient_id)
+            return exporter.export(exporter.datasets(patient_id=patient_id, archives=archives),
+                                   path, tables=tables)
+        finally:
+            conn.close()
+
+    def get_scheduler(self):
+        if self.scheduler is None:
+            self.scheduler = Scheduler(self.reader)
+        return self.scheduler
+
+    @METRICS.timed
+    def search(self, search_type, term, is_cancelled=None):
+        if self.search_engine is None:
+            self.search_engine = SearchEngine(self.reader)
+        SEARCH_CACHE.sync(self.reader)
+        # A stale search is interrupted from the progress handler
+        if is_cancelled is not None:
+            self.reader.set_progress_handler(is_cancelled, 1000)
+        try:
+            return self.search_engine.search(search_type, term)
+        finally:
+            if is_cancelled is not None:
+                self.reader.set_progress_handler(None, 0)
+
+class DBExecutor:
+    # Runs HospitalDB calls on worker threads that own their connections,
+    # so the Tk mainloop never waits on SQL. Interactive work is queued ahead
+    # of bulk refreshes; completions are handed back to Tk by poll().
+    INTERACTIVE = 0
+    BULK = 1
+    _instance = None
+
+    def __init__(self, workers=2, manager=None, service=None):
+        self.manager = manager or ConnectionManager.get()
+        # With a service URL the workers send their calls to a
+        # HospitalService instead of opening the database
+        self.service = service or os.environ.get('HOSPITAL_SERVICE')
+        # Migrations run in the background so the first window is drawn at
+        # once; workers wait for them before opening their connections
+        self.ready = threading.Event()
+        self.startup_error = None
+        threading.Thread(target=self.prepare, daemon=True).start()
+        self.tasks = queue.PriorityQueue()
+        self.completed = queue.Queue()
+        self.sequence = itertools.count()
+        self.root = None
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **options):
+        cls._instance = cls(**options)
+        return cls._instance
+
+    def prepare(self):
+        try:
+            if self.service:
+                # The service migrates the database when it starts
+                client = ServiceClient(self.service)
+                try:
+                    client.status()
+                finally:
+                    client.close()
+                return
+            conn = self.manager.connect()
+            try:
+                migrate(conn)
+            finally:
+                conn.close()
+        except Exception as e:
+            self.startup_error = e
+        finally:
+            self.ready.set()
+
+    def submit(self, fn, *args, priority=INTERACTIVE):
+        # fn is called as fn(db, *args) with the worker's HospitalDB
+        future = concurrent.futures.Future()
+        self.tasks.put((priority, next(self.sequence), future, fn, args))
+        return future
+
+    def work(self):
+        self.ready.wait()
+        db = None
+        if self.startup_error is None:
+            if self.service:
+                db = ServiceClient(self.service)
+            else:
+                db = HospitalDB(self.manager, reader=self.manager.connect(readonly=True))
+        while True:
+            priority, sequence, future, fn, args = self.tasks.get()
+            if fn is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if db is None:
+                    raise self.startup_error
+                if self.service:
+                    future.set_result(db.call(fn.__name__, args))
+                else:
+                    future.set_result(fn(db, *args))
+            except BaseException as e:
+                future.set_exception(e)
+        if self.service:
+            db.close()
+        elif db is not None:
+            db.reader.close()
+
+    def shutdown(self):
+        for thread in self.threads:
+            self.tasks.put((sys.maxsize, next(self.sequence), None, None, ()))
+
+    def run(self, fn, *args, on_success=None, on_error=None, priority=INTERACTIVE,
+            busy=None):
+        # Like submit(), but the callbacks run on the Tk thread
+        if busy is not None:
+            busy.set_busy(1)
+        future = self.submit(fn, *args, priority=priority)
+        future.add_done_callback(
+            lambda f: self.completed.put((f, on_success, on_error, busy)))
+        return future
+
+    def attach(self, root):
+        # A destroyed root (the login window) hands polling to the new one
+        try:
+            alive = self.root is not None and self.root.winfo_exists()
+        except tk.TclError:
+            alive = False
+        if not alive:
+            self.root = root
+            self.poll()
+
+    def poll(self):
+        root = self.root
+        while True:
+            try:
+                future, on_success, on_error, busy = self.completed.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if busy is not None:
+                    busy.set_busy(-1)
+                error = future.exception()
+                if error is not None:
+                    if on_error is not None:
+                        on_error(error)
+                    else:
+                        messagebox.showerror("Error", str(error))
+                elif on_success is not None:
+                    on_success(future.result())
+            except Exception as e:
+                messagebox.showerror("Error", str(e))
+        try:
+            root.after(20, self.poll)
+        except tk.TclError:
+            # The root window is gone; the next window re-attaches
+            if self.root is root:
+                self.root = None
+
+# HospitalDB calls a desk may make through the service. Exports write files,
+# so they are run where the database is (python main.py export).
+SERVICE_CALLS = {
+    'authenticate', 'add_patient', 'add_doctor', 'book_appointment', 'set_doctor_hours',
+    'find_free_slots', 'add_medical_record', 'add_bill', 'get_patient',
+    'find_duplicate_patients', 'pick', 'get_record_details', 'fetch_page', 'count_rows',
+    'fetch_row', 'warm_up', 'get_reports', 'join_change_feed', 'acknowledge_changes',
+    'leave_change_feed', 'read_changes', 'search',
+}
+# Errors that reach the desk as their own type; anything else is a RuntimeError
+SERVICE_ERRORS = {'ValueError': ValueError, 'OperationalError': sqlite3.OperationalError,
+                  'PermissionError': PermissionError}
+
+def to_wire(value):
+    # JSON that comes back as the same Python values: uids stay bytes,
+    # rows stay tuples, and list queries are sent by name. A cancellation
+    # check (see HospitalDB.search) becomes a marker; the client sends
+    # /cancel when it turns true.
+    if isinstance(value, bytes):
+        return {'$bytes': value.hex()}
+    if isinstance(value, tuple):
+        return {'$tuple': [to_wire(item) for item in value]}
+    if isinstance(value, list):
+        return [to_wire(item) for item in value]
+    if isinstance(value, dict):
+        return {'$dict': [[to_wire(key), to_wire(item)] for key, item in value.items()]}
+    if isinstance(value, ListQuery):
+        return {'$query': next(name for name, query in LIST_QUERIES.items() if query is value)}
+    if callable(value):
+        return {'$cancel': True}
+    return value
+
+def from_wire(value, is_cancelled=None):
+    # is_cancelled stands in for the client's cancellation checks
+    if isinstance(value, list):
+        return [from_wire(item, is_cancelled) for item in value]
+    if isinstance(value, dict):
+        if '$cancel' in value:
+            return is_cancelled
+        if '$bytes' in value:
+            return bytes.fromhex(value['$bytes'])
+        if '$tuple' in value:
+            return tuple(from_wire(item, is_cancelled) for item in value['$tuple'])
+        if '$dict' in value:
+            return {from_wire(key, is_cancelled): from_wire(item, is_cancelled)
+                    for key, item in value['$dict']}
+        if '$query' in value:
+            return LIST_QUERIES[value['$query']]
+    return value
+
+class ServiceClient:
+    # Stands in for HospitalDB in DBExecutor's workers when the desks share a
+    # HospitalService. Each call is one HTTP request on the worker's
+    # kept-alive connection.
+    CANCEL_CHECK_S = 0.05
+
+    def __init__(self, url, timeout=30, token=None):
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or 8765
+        self.timeout = timeout
+        self.token = token or os.environ.get('HOSPITAL_SERVICE_TOKEN')
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        headers = dict(headers or (), **{'Content-Type': 'application/json'})
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            payload = json.loads(response.read())
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            # Not retried: a save may have gone through before the reply
+            # was lost. The next call reconnects.
+            self.close()
+            raise ConnectionError(f"No answer from the service at {self.url}: {e}")
+        if response.status != 200:
+            raise SERVICE_ERRORS.get(payload.get('type'), RuntimeError)(payload.get('error'))
+        return payload
+
+    def status(self):
+        return self.request('GET', '/status')
+
+    def call(self, name, args):
+        if name not in SERVICE_CALLS:
+            raise ValueError(f"{name} is not available through the service")
+        body = json.dumps({'args': to_wire(list(args))}).encode()
+        checks = [arg for arg in args if callable(arg)]
+        if not checks:
+            return from_wire(self.request('POST', f'/call/{name}', body)['result'])
+        # The call is tagged so a watcher can cancel it on the service once
+        # the desk's check says it is no longer wanted
+        request_id = uuid.uuid4().hex
+        finished = threading.Event()
+
+        def watch():
+            while not finished.wait(self.CANCEL_CHECK_S):
+                if any(check() for check in checks):
+                    canceller = ServiceClient(self.url, self.timeout, self.token)
+                    try:
+                        canceller.request('POST', f'/cancel/{request_id}', b'{}')
+                    except (ConnectionError, ValueError):
+                        pass
+                    finally:
+                        canceller.close()
+                    return
+
+        threading.Thread(target=watch, daemon=True).start()
+        try:
+            return from_wire(self.request('POST', f'/call/{name}', body,
+                                          {'X-Request-Id': request_id})['result'])
+        finally:
+            finished.set()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+class ServiceRequestHandler(http.server.BaseHTTPRequestHandler):
+    # POST /call/NAME with {"args": [...]} runs HospitalDB.NAME; GET /status
+    # describes the service
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this every reply on
+    # a kept-alive connection waits ~40 ms for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        service = self.server.service
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        except (TypeError, ValueError) as e:
+            self.reply(400, {'error': f"Bad request: {e}", 'type': 'ValueError'})
+            return
+        if not self.authorized():
+            return
+        if self.path.startswith('/cancel/'):
+            self.reply(200, {'result': service.cancel(self.path[len('/cancel/'):])})
+            return
+        name = self.path[len('/call/'):] if self.path.startswith('/call/') else None
+        if name not in SERVICE_CALLS:
+            self.reply(404, {'error': f"Unknown call {name!r}", 'type': 'ValueError'})
+            return
+        cancelled = threading.Event()
+        try:
+            args = from_wire(payload['args'], cancelled.is_set)
+        except (TypeError, ValueError, KeyError) as e:
+            self.reply(400, {'error': f"Bad request: {e}", 'type': 'ValueError'})
+            return
+        try:
+            result = service.call(name, args, self.headers.get('X-Request-Id'), cancelled)
+        except ValueError as e:
+            self.reply(400, {'error': str(e), 'type': 'ValueError'})
+        except sqlite3.OperationalError as e:
+            self.reply(503, {'error': str(e), 'type': 'OperationalError'})
+        except Exception as e:
+            self.reply(500, {'error': f"{type(e).__name__}: {e}", 'type': 'RuntimeError'})
+        else:
+            self.reply(200, {'result': to_wire(result)})
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path == '/status':
+            self.reply(200, self.server.service.status())
+        else:
+            self.reply(404, {'error': f"Unknown path {self.path!r}", 'type': 'ValueError'})
+
+    def authorized(self):
+        token = self.server.service.token
+        if token and not hmac.compare_digest(self.headers.get('Authorization', ''),
+                                             f'Bearer {token}'):
+            self.reply(401, {'error': "Wrong or missing service token", 'type': 'PermissionError'})
+            return False
+        return True
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class HospitalService:
+    # One process owning the database for every desk, so desks no longer
+    # compete for SQLite's file lock. Writes from all desks are serialized
+    # and group-committed by the WriteQueue's single connection; reads take
+    # a HospitalDB with its own read-only connection from a pool, waiting
+    # when all of them are busy. Anywhere but this computer, desks must
+    # send the shared token; there is no encryption.
+    def __init__(self, manager=None, host='127.0.0.1', port=8765, readers=4, token=None):
+        self.token = token
+        self.server = http.server.ThreadingHTTPServer((host, port), ServiceRequestHandler)
+        if not token and not ipaddress.ip_address(self.server.server_address[0]).is_loopback:
+            self.server.server_close()
+            raise ValueError(f"Serving on {host} needs a token: set HOSPITAL_SERVICE_TOKEN "
+                             f"here and on the desks")
+        self.server.daemon_threads = True
+        self.server.service = self
+        self.address = self.server.server_address
+        self.manager = manager or ConnectionManager.get()
+        self.manager.prepare()
+        self.readers = readers
+        self.pool = queue.LifoQueue()
+        for _ in range(readers):
+            self.pool.put(HospitalDB(self.manager,
+                                     reader=self.manager.connect(readonly=True, pooled=True)))
+        self.lock = threading.Lock()
+        self.calls = 0
+        # Cancellation flags of the tagged calls in progress, by request id
+        self.running = {}
+        self.started = time.time()
+
+    def call(self, name, args, request_id=None, cancelled=None):
+        with self.lock:
+            self.calls += 1
+            if request_id:
+                self.running[request_id] = cancelled
+        try:
+            return self.run_call(name, args)
+        finally:
+            if request_id:
+                with self.lock:
+                    self.running.pop(request_id, None)
+
+    def cancel(self, request_id):
+        # False when the call has already finished
+        with self.lock:
+            cancelled = self.running.get(request_id)
+        if cancelled is None:
+            return False
+        cancelled.set()
+        return True
+
+    def run_call(self, name, args):
+        db = self.pool.get()
+        # Pooled readers take turns serving every desk, so data_version
+        # cannot tell whether this desk has seen the latest changes
+        db.change_version = None
+        try:
+            return getattr(db, name)(*args)
+        finally:
+            self.pool.put(db)
+
+    def status(self):
+        return {'database': os.path.abspath(self.manager.path), 'readers': self.readers,
+                'idle_readers': self.pool.qsize(), 'calls': self.calls,
+                'uptime_s': round(time.time() - self.started)}
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        while not self.pool.empty():
+            self.pool.get().reader.close()
+        self.manager.close()
+
+class ChangeFeed:
+    # Tells open views which rows were added, changed or deleted by other
+    # windows, desks or processes, so each can update just those rows.
+    # Triggers append every change to change_log; the feed reads the new
+    # entries whenever PRAGMA data_version shows a commit, and hands each
+    # subscriber the ones for the tables it shows. How far this process has
+    # read is stored in change_subscribers so the log can be pruned.
+    POLL_MS = 500
+    # Reads are acknowledged at most this often, and at least every
+    # HEARTBEAT_S seconds to stay registered (see CHANGE_FEED_TTL)
+    ACK_S = 2
+    HEARTBEAT_S = 60
+    _instance = None
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.subscriber = uid_text(new_uid())
+        self.subscriptions = []
+        self.seq = None
+        self.acknowledged = None
+        self.acknowledged_at = 0
+        # A poll is scheduled or its query is running
+        self.active = False
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None:
+            cls._instance = cls(DBExecutor.get())
+        return cls._instance
+
+    def subscribe(self, widget, tables, callback):
+        # callback gets a list of (table, row id, operation) in commit
+        # order, or None when the view should reload everything. The
+        # subscription ends when widget is destroyed.
+        self.subscriptions.append([widget, set(tables), callback, self.seq])
+        if not self.active:
+            self.schedule(0)
+
+    def schedule(self, delay):
+        self.active = False
+        for widget, tables, callback, seq in self.subscriptions:
+            try:
+                widget.after(delay, self.poll)
+                self.active = True
+                return
+            except tk.TclError:
+                continue
+
+    def poll(self):
+        self.subscriptions = [s for s in self.subscriptions if self.alive(s[0])]
+        if not self.subscriptions:
+            self.active = False
+            if self.seq is not None:
+                self.seq = None
+                self.executor.run(HospitalDB.leave_change_feed, self.subscriber,
+                                  on_error=self.failed, priority=DBExecutor.BULK)
+            return
+        if self.seq is None:
+            self.executor.run(HospitalDB.join_change_feed, self.subscriber,
+                              on_success=self.joined, on_error=self.failed,
+                              priority=DBExecutor.BULK)
+            return
+        elapsed = time.monotonic() - self.acknowledged_at
+        if (elapsed >= self.HEARTBEAT_S
+                or (elapsed >= self.ACK_S and self.seq != self.acknowledged)):
+            seq = self.seq
+            self.executor.run(HospitalDB.acknowledge_changes, self.subscriber, seq,
+                              on_success=lambda restart: self.acknowledged_to(seq, restart),
+                              on_error=self.failed, priority=DBExecutor.BULK)
+            return
+        self.executor.run(HospitalDB.read_changes, self.seq,
+                          on_success=self.received, on_error=self.failed,
+                          priority=DBExecutor.BULK)
+
+    @staticmethod
+    def alive(widget):
+        try:
+            return bool(widget.winfo_exists())
+        except tk.TclError:
+            return False
+
+    def joined(self, seq):
+        self.seq = self.acknowledged = seq
+        self.acknowledged_at = time.monotonic()
+        for subscription in self.subscriptions:
+            if subscription[3] is None:
+                subscription[3] = seq
+        self.schedule(self.POLL_MS)
+
+    def acknowledged_to(self, seq, restart):
+        self.acknowledged = seq
+        self.acknowledged_at = time.monotonic()
+        if restart is not None:
+            # Dropped for not checking in; changes may have gone unlogged
+            self.seq = self.acknowledged = restart
+            self.dispatch(None, restart)
+        self.schedule(0)
+
+    def received(self, changes):
+        if changes is not None:
+            reset, seq, rows = changes
+            self.dispatch(None if reset else rows, seq)
+        self.schedule(self.POLL_MS)
+
+    def failed(self, error):
+        # Polling is best effort; try again on the next tick
+        self.schedule(self.POLL_MS)
+
+    def dispatch(self, rows, seq):
+        self.seq = seq
+        for subscription in list(self.subscriptions):
+            widget, tables, callback, after = subscription
+            subscription[3] = seq
+            if rows is None:
+                changes = None
+            else:
+                changes = [(table, row_id, operation) for number, table, row_id, operation in rows
+                           if table in tables and (after is None or number > after)]
+                if not changes:
+                    continue
+            try:
+                callback(changes)
+            except tk.TclError:
+                # Destroyed since the last poll; dropped on the next one
+                pass
+
+    def close(self):
+        # Unregisters straight away rather than waiting for the entry to
+        # expire, e.g. when the main window is closed
+        self.subscriptions = []
+        if self.seq is not None:
+            self.seq = None
+            try:
+                self.executor.submit(HospitalDB.leave_change_feed, self.subscriber).result(5)
+            except Exception:
+                pass
+
+class ListQuery:
+    # Describes a list pane as a keyset-paginated query. The last order_by
+    # expression must be unique so it can double as the Treeview item id.
+    # An archived list is a patient's history, newest first: its first
+    # parameter is the patient's uid, its first order_by a YYYY-MM-DD date,
+    # and older rows may have moved to the yearly archives.
+    def __init__(self, columns, source, order_by, where=None, descending=False,
+                 archived=False):
+        self.columns = columns
+        self.source = source
+        self.order_by = order_by
+        self.where = where
+        self.descending = descending
+        self.archived = archived
+
+    @property
+    def table(self):
+        # The table each row key belongs to, for change notifications
+        return self.source.split()[0]
+
+    def from_sql(self, schema=None):
+        # The source table can be read from an attached archive instead
+        return f'{schema}.{self.source}' if schema else self.source
+
+    def page_sql(self, after_key, schema=None):
+        conditions = [self.where] if self.where else []
+        if after_key is not None:
+            keys = ', '.join(self.order_by)
+            placeholders = ', '.join('?' for _ in self.order_by)
+            op = '<' if self.descending else '>'
+            conditions.append(f'({keys}) {op} ({placeholders})')
+        direction = ' DESC' if self.descending else ''
+        sql = f"SELECT {', '.join(self.columns + self.order_by)} FROM {self.from_sql(schema)}"
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY ' + ', '.join(k + direction for k in self.order_by)
+        return sql + ' LIMIT ?'
+
+    def count_sql(self):
+        # Counting stops at a cap so large tables cost a bounded index walk
+        sql = f'SELECT 1 FROM {self.source}'
+        if self.where:
+            sql += f' WHERE {self.where}'
+        return f'SELECT COUNT(*) FROM ({sql} LIMIT ?)'
+
+    def row_sql(self, schema=None):
+        # Single row lookup by the unique trailing key, used for in-place updates
+        conditions = [self.where] if self.where else []
+        conditions.append(f'{self.order_by[-1]} = ?')
+        return (f"SELECT {', '.join(self.columns + self.order_by)} FROM {self.from_sql(schema)}"
+                f" WHERE {' AND '.join(conditions)}")
+
+PATIENT_LIST = ListQuery(
+    columns=('uid_text(uid)', 'name', 'age', 'gender', 'phone'),
+    source='patients',
+    order_by=('rowid',))
+
+DOCTOR_LIST = ListQuery(
+    columns=('uid_text(uid)', 'name', 'specialization', 'phone'),
+    source='doctors',
+    order_by=('rowid',))
+
+# Appointment date and time as shown and exported; appointments whose old
+# free text could not be read show that text instead
+APPOINTMENT_DATE = "coalesce(date(a.starts_at, 'unixepoch'), a.entered_as)"
+APPOINTMENT_TIME = "strftime('%H:%M', a.starts_at, 'unixepoch')"
+
+APPOINTMENT_LIST = ListQuery(
+    columns=('uid_text(a.uid)', 'p.name', 'd.name', APPOINTMENT_DATE, APPOINTMENT_TIME,
+             'a.status'),
+    source='''appointments a
+        JOIN patients p ON a.patient_id = p.patient_id
+        JOIN doctors d ON a.doctor_id = d.doctor_id''',
+    order_by=('a.rowid',))
+
+# Calendar views: everyone's appointments, or one doctor's, between two
+# starts_at values in time order
+CALENDAR_COLUMNS = (APPOINTMENT_DATE, APPOINTMENT_TIME, 'a.duration', 'p.name', 'd.name',
+                    'a.status')
+CALENDAR_SOURCE = '''appointments a
+        LEFT JOIN patients p ON a.patient_id = p.patient_id
+        LEFT JOIN doctors d ON a.doctor_id = d.doctor_id'''
+
+CALENDAR_LIST = ListQuery(
+    columns=CALENDAR_COLUMNS,
+    source=CALENDAR_SOURCE,
+    where='a.starts_at >= ? AND a.starts_at < ?',
+    order_by=('a.starts_at', 'a.appointment_id'))
+
+DOCTOR_CALENDAR_LIST = ListQuery(
+    columns=CALENDAR_COLUMNS,
+    source=CALENDAR_SOURCE,
+    where='''a.doctor_id = (SELECT doctor_id FROM doctors WHERE uid = ?)
+        AND a.starts_at >= ? AND a.starts_at < ?''',
+    order_by=('a.starts_at', 'a.appointment_id'))
+
+RECORD_LIST = ListQuery(
+    columns=('m.date', 'd.name', 'm.diagnosis', 'm.treatment'),
+    source='medical_records m JOIN doctors d ON m.doctor_id = d.doctor_id',
+    where='m.patient_id = (SELECT p.patient_id FROM patients p WHERE p.uid = ?)',
+    order_by=('m.date', 'm.rowid'),
+    descending=True,
+    archived=True)
+
+BILL_LIST = ListQuery(
+    columns=('date', 'description', 'amount', 'status'),
+    source='bills',
+    where='patient_id = (SELECT p.patient_id FROM patients p WHERE p.uid = ?)',
+    order_by=('date', 'rowid'),
+    descending=True,
+    archived=True)
+
+# The lists by name, as the service protocol refers to them
+LIST_QUERIES = {
+    'PATIENT_LIST': PATIENT_LIST, 'DOCTOR_LIST': DOCTOR_LIST,
+    'APPOINTMENT_LIST': APPOINTMENT_LIST, 'CALENDAR_LIST': CALENDAR_LIST,
+    'DOCTOR_CALENDAR_LIST': DOCTOR_CALENDAR_LIST, 'RECORD_LIST': RECORD_LIST,
+    'BILL_LIST': BILL_LIST,
+}
+
+# Reports pane. Each reads only the summary tables, a few rows per day.
+RECEIVABLES_REPORT = '''
+SELECT coalesce(sum(bills), 0), coalesce(sum(amount_cents), 0)
+FROM revenue_totals WHERE status = ?'''
+REVENUE_REPORT = '''
+SELECT date, status, bills, amount_cents FROM revenue_daily
+WHERE date BETWEEN ? || '-01' AND ? || '-31' ORDER BY date, status'''
+DOCTOR_REPORT = '''
+SELECT d.name, uid_text(d.uid), s.appointments, s.cancelled, s.visits
+FROM doctor_monthly s JOIN doctors d ON d.doctor_id = s.doctor_id
+WHERE s.month = ? ORDER BY s.visits DESC, s.appointments DESC'''
+BALANCE_REPORT = '''
+SELECT p.name, uid_text(p.uid), b.pending_bills, b.outstanding_cents
+FROM patient_balances b JOIN patients p ON p.patient_id = b.patient_id
+WHERE b.outstanding_cents > 0 ORDER BY b.outstanding_cents DESC LIMIT ?'''
+
+# Queries run on every list scroll, registration or record view. Each must
+# be answered from an index; check_query_plans() flags any full table scan.
+HOT_QUERIES = [
+    ('patient list page', PATIENT_LIST.page_sql((0,)), (0, 50)),
+    ('doctor list page', DOCTOR_LIST.page_sql((0,)), (0, 50)),
+    ('appointment list page', APPOINTMENT_LIST.page_sql((0,)), (0, 50)),
+    ('medical history page', RECORD_LIST.page_sql(('', 0)), (b'', '', 0, 50)),
+    ('bill history page', BILL_LIST.page_sql(('', 0)), (b'', '', 0, 50)),
+    ('day calendar page', CALENDAR_LIST.page_sql((0, 0)), (0, 0, 0, 0, 50)),
+    ('doctor calendar page', DOCTOR_CALENDAR_LIST.page_sql((0, 0)), (b'', 0, 0, 0, 0, 50)),
+    ('doctor schedule range', '''
+        SELECT doctor_id, date(starts_at, 'unixepoch'), starts_at % 86400 / 60, duration
+        FROM appointments
+        WHERE doctor_id IN (?, ?) AND starts_at >= ? AND starts_at < ?
+        AND status != 'Cancelled' ''', (0, 0, 0, 0)),
+    ('doctors by specialization', '''
+        SELECT doctor_id, name, uid_text(uid) FROM doctors
+        WHERE specialization = ? COLLATE NOCASE''', ('',)),
+    ('patient appointments', '''
+        SELECT appointment_id FROM appointments WHERE patient_id = ?''', (0,)),
+    ('patient by id', '''
+        SELECT patient_id FROM patients WHERE uid = ?''', (b'',)),
+    ('duplicate patient candidates', DUPLICATE_CANDIDATES,
+     {'phone': '', 'name': '', 'year': 0, 'band': 0, 'block': 0}),
+    ('patient name prefix', '''
+        SELECT uid FROM patients WHERE name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE
+        ORDER BY name COLLATE NOCASE LIMIT ?''', ('', '', 10)),
+    ('doctor name prefix', '''
+        SELECT uid FROM doctors WHERE name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE
+        ORDER BY name COLLATE NOCASE LIMIT ?''', ('', '', 10)),
+    ('patient phone prefix', '''
+        SELECT uid FROM patients WHERE phone_key >= ? AND phone_key < ?
+        ORDER BY phone_key LIMIT ?''', ('', '', 10)),
+    ('patient id prefix', '''
+        SELECT uid FROM patients
+        WHERE uid BETWEEN ? AND ? ORDER BY uid LIMIT ?''', (b'', b'', 50)),
+    ('record details', '''
+        SELECT m.rowid, uid_text(m.uid), m.date, d.name, m.diagnosis, m.treatment, m.notes
+        FROM medical_records m LEFT JOIN doctors d ON m.doctor_id = d.doctor_id
+        WHERE m.rowid IN (?, ?)''', (0, 0)),
+    ('record prescriptions', '''
+        SELECT m.rowid, p.medicine_name, p.dosage, p.frequency, p.duration
+        FROM medical_records m JOIN prescriptions p ON p.record_id = m.record_id
+        WHERE m.rowid IN (?, ?) ORDER BY m.rowid, p.rowid''', (0, 0)),
+    ('receivables', RECEIVABLES_REPORT, ('Pending',)),
+    ('revenue by day', REVENUE_REPORT, ('', '')),
+    ('doctor activity', DOCTOR_REPORT, ('',)),
+    ('largest balances', BALANCE_REPORT, (20,)),
+]
+
+def check_query_plans(conn):
+    report = []
+    for name, sql, params in HOT_QUERIES:
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        scans = [step for step in plan if step.startswith('SCAN')]
+        report.append((name, plan, not scans))
+    return report
+
+class PagedTreeview:
+    # Treeview that starts with one screen of rows plus a prefetch margin
+    # and pulls the next page from the database as the user scrolls near
+    # the end. Pages already loaded stay loaded until the next refresh, so
+    # scrolling through a whole table still ends up holding all of it.
+    # Queries run on the DBExecutor; results are applied on the Tk thread.
+    def __init__(self, parent, executor, columns, query, params=(), prefetch=25,
+                 count_cap=10000, action=None, on_loaded=None, **tree_options):
+        self.executor = executor
+        self.query = query
+        # Name under which refreshes are timed in the diagnostics
+        self.action = action
+        self.params = tuple(params)
+        self.count_cap = count_cap
+        self.generation = 0
+        self.busy = 0
+        self.frame = ttk.Frame(parent)
+
+        self.tree = ttk.Treeview(self.frame, columns=columns, **tree_options)
+        for column in columns:
+            self.tree.heading(column, text=column)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient='vertical', command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self.on_scroll)
+        status_frame = ttk.Frame(self.frame)
+        self.count_label = ttk.Label(status_frame)
+        ttk.Button(status_frame, text="Reload", command=self.refresh).pack(side='right')
+        self.count_label.pack(side='right', padx=5)
+
+        status_frame.pack(side='bottom', fill='x')
+        self.scrollbar.pack(side='right', fill='y')
+        self.tree.pack(side='left', fill='both', expand=True)
+
+        self.page_size = int(self.tree.cget('height')) + prefetch
+        self.refresh(on_done=on_loaded)
+        ChangeFeed.get().subscribe(self.tree, (query.table,), self.apply_changes)
+
+    def pack(self, **options):
+        self.frame.pack(**options)
+
+    def grid(self, **options):
+        self.frame.grid(**options)
+
+    def set_busy(self, delta):
+        self.busy += delta
+        self.tree.configure(cursor='watch' if self.busy else '')
+        self.update_count_label()
+
+    def refresh(self, on_done=None):
+        # Results of loads issued before this point are discarded
+        timer = METRICS.start_action(self.action) if self.action else None
+
+        def done():
+            if timer is not None:
+                timer()
+            if on_done is not None:
+                on_done()
+
+        self.generation += 1
+        self.tree.delete(*self.tree.get_children())
+        self.keys = []
+        self.pending_rows = []
+        self.exhausted = False
+        self.loading = False
+        self.load_scheduled = False
+        self.total = 0
+        generation = self.generation
+
+        def counted(total):
+            if generation == self.generation:
+                self.total += total
+                self.update_count_label()
+
+        self.executor.run(HospitalDB.count_rows, self.query, self.params, self.count_cap,
+                          on_success=counted, priority=DBExecutor.BULK, busy=self)
+        self.load_more(priority=DBExecutor.BULK, on_done=done)
+
+    def show(self, query, params):
+        # Point the pane at another query or range, e.g. the next calendar week
+        self.query = query
+        self.params = tuple(params)
+        self.refresh()
+
+    def load_more(self, priority=DBExecutor.INTERACTIVE, on_done=None):
+        self.load_scheduled = False
+        if self.exhausted or self.loading:
+            return
+        self.loading = True
+        after_key = self.keys[-1] if self.keys else None
+        generation = self.generation
+
+        def loaded(rows):
+            if generation != self.generation:
+                return
+            self.loading = False
+            width = len(self.query.columns)
+            for row in rows:
+                key = tuple(row[width:])
+                self.tree.insert('', 'end', iid=str(key[-1]), values=row[:width])
+                self.keys.append(key)
+            if len(rows) < self.page_size:
+                self.exhausted = True
+            # Rows written while this page was in flight go in now
+            pending, self.pending_rows = self.pending_rows, []
+            for row in pending:
+                self.place_row(row)
+            self.update_count_label()
+            if on_done is not None:
+                on_done()
+
+        def failed(error):
+            if generation == self.generation:
+                self.loading = False
+            messagebox.showerror("Error", str(error))
+
+        self.executor.run(HospitalDB.fetch_page, self.query, self.params, after_key,
+                          self.page_size, on_success=loaded, on_error=failed,
+                          priority=priority, busy=self)
+
+    def fetch_row(self, row_key, on_success):
+        generation = self.generation
+
+        def fetched(row):
+            if generation == self.generation:
+                on_success(row)
+
+        self.executor.run(HospitalDB.fetch_row, self.query, self.params, row_key,
+                          on_success=fetched, busy=self)
+
+    def sort_position(self, key):
+        # Binary search over the loaded keys, honouring the sort direction
+        low, high = 0, len(self.keys)
+        while low < high:
+            mid = (low + high) // 2
+            if (self.keys[mid] > key) if self.query.descending else (self.keys[mid] < key):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def place_row(self, row):
+        if self.loading:
+            self.pending_rows.append(row)
+            return
+        width = len(self.query.columns)
+        key = tuple(row[width:])
+        if self.tree.exists(str(key[-1])):
+            self.forget_row(key[-1])
+        position = self.sort_position(key)
+        # Rows past the loaded window arrive with the page that covers them
+        if position == len(self.keys) and not self.exhausted:
+            return
+        self.tree.insert('', position, iid=str(key[-1]), values=row[:width])
+        self.keys.insert(position, key)
+
+    def insert_row(self, row_key, on_done=None):
+        def fetched(row):
+            if row is not None:
+                if not self.tree.exists(str(row_key)):
+                    self.total += 1
+                self.place_row(row)
+                self.update_count_label()
+            if on_done is not None:
+                on_done()
+
+        self.fetch_row(row_key, fetched)
+
+    def update_row(self, row_key):
+        def fetched(row):
+            if row is None:
+                self.remove_row(row_key)
+                return
+            self.place_row(row)
+            self.update_count_label()
+
+        self.fetch_row(row_key, fetched)
+
+    def remove_row(self, row_key):
+        if self.tree.exists(str(row_key)):
+            self.forget_row(row_key)
+        self.total = max(self.total - 1, 0)
+        self.update_count_label()
+
+    def forget_row(self, row_key):
+        position = self.tree.index(str(row_key))
+        self.tree.delete(str(row_key))
+        del self.keys[position]
+
+    def apply_changes(self, changes):
+        # Rows written elsewhere, from the ChangeFeed. A reset, or more
+        # changes than a page, reloads the list instead.
+        if changes is None or len(changes) > self.page_size:
+            self.refresh()
+            return
+        for table, row_key, operation in changes:
+            if operation == 'delete':
+                # Archived history rows are deleted here but still listed
+                if self.tree.exists(str(row_key)):
+                    if self.query.archived:
+                        self.update_row(row_key)
+                    else:
+                        self.remove_row(row_key)
+            elif operation == 'insert':
+                self.insert_row(row_key)
+            elif self.tree.exists(str(row_key)):
+                self.update_row(row_key)
+            else:
+                # An edit can bring a row into the list, e.g. an appointment
+                # moved into the calendar week on screen
+                self.fetch_row(row_key, self.moved_in)
+
+    def moved_in(self, row):
+        if row is not None:
+            self.place_row(row)
+            self.update_count_label()
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        # Keep a page ahead of the viewport
+        if float(last) >= 0.9 and not self.exhausted and not self.load_scheduled:
+            self.load_scheduled = True
+            self.tree.after_idle(self.load_more)
+
+    def update_count_label(self):
+        if self.total > self.count_cap:
+            total = f'{self.count_cap:,}+'
+        else:
+            total = f'{self.total:,}'
+        text = f'Showing {len(self.keys):,} of {total}'
+        if self.busy:
+            text = 'Loading... ' + text
+        self.count_label.configure(text=text)
+
+class DiagnosticsPanel:
+    # Admin view of METRICS: UI action and query latencies, plus the slow
+    # queries with their plans. Refreshed whenever the tab is shown.
+    def __init__(self, parent):
+        self.parent = parent
+        controls = ttk.Frame(parent)
+        controls.pack(fill='x', padx=10, pady=5)
+        ttk.Label(controls, text="Slow query threshold (ms):").pack(side='left')
+        self.threshold = ttk.Entry(controls, width=8)
+        self.threshold.insert(0, f'{METRICS.slow_ms:g}')
+        self.threshold.pack(side='left', padx=5)
+        ttk.Button(controls, text="Apply", command=self.apply_threshold).pack(side='left')
+        ttk.Button(controls, text="Save JSON...", command=self.save).pack(side='right')
+        ttk.Button(controls, text="Reset", command=self.reset).pack(side='right', padx=5)
+        ttk.Button(controls, text="Refresh", command=self.refresh).pack(side='right')
         
-        self.conn.commit()
+        self.action_tree = self.table("UI Actions (button press to screen updated)",
+                                      ("Action", "Started", "Completed", "p50 ms", "p95 ms",
+                                       "p99 ms", "Max ms"))
+        self.query_tree = self.table("Queries", ("Statement", "Calls", "Timed", "p50 ms",
+                                                 "p95 ms", "Max ms", "Total ms"))
+        self.slow_tree = self.table("Slow Queries", ("Time", "ms", "Operation", "Statement"))
+        self.slow_tree.bind('<<TreeviewSelect>>', self.show_plan)
+        self.plan = tk.Text(parent, height=4)
+        self.plan.pack(fill='x', padx=10, pady=5)
+        self.slow_queries = []
+        parent.bind('<Map>', lambda event: self.refresh())
+        self.refresh()
+    
+    def table(self, title, columns):
+        frame = ttk.LabelFrame(self.parent, text=title)
+        frame.pack(fill='both', expand=True, padx=10, pady=5)
+        tree = ttk.Treeview(frame, columns=columns, show='headings', height=5)
+        for column in columns:
+            tree.heading(column, text=column)
+            tree.column(column, width=70, anchor='e')
+        tree.column(columns[0], width=300, anchor='w')
+        tree.pack(fill='both', expand=True)
+        return tree
+    
+    def refresh(self):
+        snapshot = METRICS.snapshot()
+        self.action_tree.delete(*self.action_tree.get_children())
+        for name, stats in sorted(snapshot['actions'].items()):
+            self.action_tree.insert('', 'end', values=(
+                name, stats['started'], stats['count'], stats['p50_ms'], stats['p95_ms'],
+                stats['p99_ms'], stats['max_ms']))
+        
+        # Most expensive statements first
+        self.query_tree.delete(*self.query_tree.get_children())
+        statements = sorted(snapshot['statements'].items(), key=lambda s: -s[1]['total_ms'])
+        for sql, stats in statements[:200]:
+            self.query_tree.insert('', 'end', values=(
+                sql, stats['calls'], stats['count'], stats['p50_ms'], stats['p95_ms'],
+                stats['max_ms'], stats['total_ms']))
+        
+        self.slow_tree.delete(*self.slow_tree.get_children())
+        self.slow_queries = snapshot['slow_queries'][::-1]
+        for index, slow in enumerate(self.slow_queries):
+            self.slow_tree.insert('', 'end', iid=str(index), values=(
+                slow['at'], slow['ms'], slow['operation'], slow['sql']))
+        self.plan.delete('1.0', 'end')
+    
+    def show_plan(self, event):
+        selection = self.slow_tree.selection()
+        if not selection:
+            return
+        slow = self.slow_queries[int(selection[0])]
+        self.plan.delete('1.0', 'end')
+        self.plan.insert('1.0', slow['sql'] + '\n\n' + '\n'.join(slow['plan'] or ['(no plan)']))
+    
+    def apply_threshold(self):
+        try:
+            METRICS.slow_ms = float(self.threshold.get())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+    
+    def reset(self):
+        METRICS.reset()
+        self.refresh()
+    
+    def save(self):
+        path = filedialog.asksaveasfilename(defaultextension='.json',
+                                            filetypes=[("JSON", "*.json")])
+        if not path:
+            return
+        METRICS.dump(path)
+        messagebox.showinfo("Success", f"Diagnostics saved to {path}")
+
+def money(cents):
+    return f"{cents / 100:,.2f}"
+
+class ReportsPanel:
+    # Receivables, revenue and doctor activity for a month. The figures
+    # come from the trigger-maintained summary tables only.
+    def __init__(self, parent, executor):
+        self.parent = parent
+        self.executor = executor
+        self.busy = 0
+        controls = ttk.Frame(parent)
+        controls.pack(fill='x', padx=10, pady=5)
+        ttk.Label(controls, text="Month:").pack(side='left')
+        self.month = ttk.Entry(controls, width=10)
+        self.month.insert(0, datetime.now().strftime('%Y-%m'))
+        self.month.pack(side='left', padx=5)
+        ttk.Button(controls, text="<", width=3,
+                   command=lambda: self.refresh(-1)).pack(side='left')
+        ttk.Button(controls, text=">", width=3,
+                   command=lambda: self.refresh(1)).pack(side='left')
+        ttk.Button(controls, text="Show", command=self.refresh).pack(side='left', padx=5)
+        
+        self.totals = ttk.Label(parent)
+        self.totals.pack(fill='x', padx=10)
+        self.revenue_tree = self.table("Revenue by Day", ("Date", "Status", "Bills", "Amount"))
+        self.doctor_tree = self.table("Doctor Activity", ("Doctor", "Doctor ID", "Appointments",
+                                                          "Cancelled", "Visits"))
+        self.balance_tree = self.table("Largest Outstanding Balances",
+                                       ("Patient", "Patient ID", "Pending Bills", "Outstanding"))
+        parent.bind('<Map>', lambda event: self.refresh())
+        self.refresh()
+        ChangeFeed.get().subscribe(self.totals, ('bills', 'appointments', 'medical_records'),
+                                   self.data_changed)
+    
+    def table(self, title, columns):
+        frame = ttk.LabelFrame(self.parent, text=title)
+        frame.pack(fill='both', expand=True, padx=10, pady=5)
+        tree = ttk.Treeview(frame, columns=columns, show='headings', height=5)
+        for column in columns:
+            tree.heading(column, text=column)
+            tree.column(column, width=90, anchor='e')
+        tree.column(columns[0], width=180, anchor='w')
+        tree.pack(fill='both', expand=True)
+        return tree
+    
+    def set_busy(self, delta):
+        self.busy += delta
+        for tree in (self.revenue_tree, self.doctor_tree, self.balance_tree):
+            tree.configure(cursor='watch' if self.busy else '')
+    
+    def refresh(self, step=0):
+        try:
+            month = datetime.strptime(self.month.get().strip(), '%Y-%m')
+        except ValueError:
+            messagebox.showerror("Error", "Enter the month as YYYY-MM")
+            return
+        # The arrows move by one month
+        index = month.year * 12 + month.month - 1 + step
+        month = f"{index // 12:04d}-{index % 12 + 1:02d}"
+        self.month.delete(0, 'end')
+        self.month.insert(0, month)
+        
+        done = METRICS.start_action('refresh_reports')
+        self.executor.run(HospitalDB.get_reports, month,
+                          on_success=lambda reports: self.show(reports, done), busy=self)
+    
+    def data_changed(self, changes):
+        # The figures are a few rows each; reread them while on screen
+        if self.parent.winfo_ismapped():
+            self.refresh()
+    
+    def show(self, reports, done=None):
+        pending_bills, pending_cents = reports['receivables']
+        billed = sum(row[3] for row in reports['revenue'])
+        visits = sum(row[4] for row in reports['doctors'])
+        appointments = sum(row[2] for row in reports['doctors'])
+        self.totals.configure(text=(
+            f"Outstanding receivables: {money(pending_cents)} in {pending_bills:,} bills    "
+            f"This month: {money(billed)} billed, {appointments:,} appointments, "
+            f"{visits:,} visits"))
+        
+        self.revenue_tree.delete(*self.revenue_tree.get_children())
+        for date, status, bills, cents in reports['revenue']:
+            self.revenue_tree.insert('', 'end', values=(date, status, bills, money(cents)))
+        self.doctor_tree.delete(*self.doctor_tree.get_children())
+        for row in reports['doctors']:
+            self.doctor_tree.insert('', 'end', values=row)
+        self.balance_tree.delete(*self.balance_tree.get_children())
+        for name, patient_id, bills, cents in reports['balances']:
+            self.balance_tree.insert('', 'end', values=(name, patient_id, bills, money(cents)))
+        if done is not None:
+            done()
 
 class LoginWindow:
     def __init__(self):
         self.root = tk.Tk()
         self.root.title("Hospital Management System - Login")
         self.root.geometry("300x200")
-        self.db = HospitalDB()
         self.create_widgets()
+        # The form is drawn before the database is touched. Opening and
+        # migrating it, and reading the first tab's list, happen in the
+        # background while the user types.
+        self.executor = DBExecutor.get()
+        self.executor.attach(self.root)
+        self.executor.run(HospitalDB.warm_up, [TABS[0][2]], priority=DBExecutor.BULK)
         
     def create_widgets(self):
         # Username
@@ -90,45 +2895,79 @@ class LoginWindow:
         username = self.username_entry.get()
         password = hashlib.sha256(self.password_entry.get().encode()).hexdigest()
         
-        cursor = self.db.conn.cursor()
-        cursor.execute('SELECT role FROM users WHERE username = ? AND password = ?',
-                      (username, password))
-        result = cursor.fetchone()
-        
-        if result:
+        # Time to interactive runs until the first tab's list is on screen
+        done = METRICS.start_action('time_to_interactive')
+        self.executor.run(HospitalDB.authenticate, username, password,
+                          on_success=lambda role: self.authenticated(role, done))
+    
+    def authenticated(self, role, done):
+        if role:
             self.root.destroy()
-            MainWindow(result[0])
+            MainWindow(role, on_ready=done)
         else:
             messagebox.showerror("Error", "Invalid credentials")
 
+# Main window tabs: title, builder method and the list the tab opens with
+TABS = [
+    ('Patients', 'create_patients_tab', PATIENT_LIST),
+    ('Doctors', 'create_doctors_tab', DOCTOR_LIST),
+    ('Appointments', 'create_appointments_tab', APPOINTMENT_LIST),
+    ('Calendar', 'create_calendar_tab', None),
+    ('Reports', 'create_reports_tab', None),
+]
+
 class MainWindow:
-    def __init__(self, role):
+    def __init__(self, role, on_ready=None):
         self.root = tk.Tk()
         self.root.title("Hospital Management System")
         self.root.geometry("800x600")
-        self.db = HospitalDB()
+        self.executor = DBExecutor.get()
+        self.executor.attach(self.root)
         self.role = role
+        self.on_ready = on_ready
+        self.picker_cache = PickerCache(self.root)
         self.create_widgets()
         
     def create_widgets(self):
-        # Create notebook for tabs
-        notebook = ttk.Notebook(self.root)
-        notebook.pack(expand=True, fill='both')
+        # Create notebook for tabs. A tab's widgets are built, and its list
+        # queried, the first time it is selected.
+        self.notebook = ttk.Notebook(self.root)
+        self.notebook.pack(expand=True, fill='both')
+        self.unbuilt_tabs = {}
         
-        # Patients tab
-        patients_frame = ttk.Frame(notebook)
-        notebook.add(patients_frame, text='Patients')
-        self.create_patients_tab(patients_frame)
+        tabs = list(TABS)
+        # Query and UI timings, for administrators only
+        if self.role == 'admin':
+            tabs.append(('Diagnostics', 'create_diagnostics_tab', None))
+        for text, builder, query in tabs:
+            frame = ttk.Frame(self.notebook)
+            self.notebook.add(frame, text=text)
+            self.unbuilt_tabs[str(frame)] = (getattr(self, builder), frame, query)
         
-        # Doctors tab
-        doctors_frame = ttk.Frame(notebook)
-        notebook.add(doctors_frame, text='Doctors')
-        self.create_doctors_tab(doctors_frame)
-        
-        # Appointments tab
-        appointments_frame = ttk.Frame(notebook)
-        notebook.add(appointments_frame, text='Appointments')
-        self.create_appointments_tab(appointments_frame)
+        self.notebook.bind('<<NotebookTabChanged>>', self.build_selected_tab)
+        self.build_selected_tab()
+    
+    def build_selected_tab(self, event=None):
+        tab = self.unbuilt_tabs.pop(self.notebook.select(), None)
+        if tab is not None:
+            builder, frame, query = tab
+            builder(frame)
+    
+    def tab_loaded(self):
+        # The first list on screen ends startup; the lists of tabs not
+        # opened yet are then read in the background to warm the cache
+        if self.on_ready is None:
+            return
+        self.on_ready()
+        self.on_ready = None
+        queries = [query for builder, frame, query in self.unbuilt_tabs.values() if query]
+        self.executor.run(HospitalDB.warm_up, queries, priority=DBExecutor.BULK)
+    
+    def create_diagnostics_tab(self, parent):
+        self.diagnostics = DiagnosticsPanel(parent)
+    
+    def create_reports_tab(self, parent):
+        self.reports = ReportsPanel(parent, self.executor)
     
     def create_patients_tab(self, parent):
         # Patient registration form
@@ -162,20 +3001,31 @@ class MainWindow:
         
         ttk.Button(form_frame, text="Register Patient", command=self.register_patient).grid(row=6, column=0, columnspan=2, pady=20)
         
+        # Registered patients who look like the one being entered, checked
+        # as the name, age and phone are typed
+        ttk.Label(form_frame, text="Possible duplicates:").grid(row=7, column=0, columnspan=2, padx=5, sticky="w")
+        self.duplicate_tree = ttk.Treeview(form_frame, columns=("Match", "ID", "Name", "Age", "Phone"),
+                                           show='headings', height=4)
+        for column, width in (("Match", 45), ("ID", 90), ("Name", 110), ("Age", 35), ("Phone", 90)):
+            self.duplicate_tree.heading(column, text=column)
+            self.duplicate_tree.column(column, width=width)
+        self.duplicate_tree.grid(row=8, column=0, columnspan=2, padx=5, pady=5)
+        self.duplicate_check = None
+        self.duplicate_generation = 0
+        for entry in (self.patient_name, self.patient_age, self.patient_phone):
+            entry.bind('<KeyRelease>', self.schedule_duplicate_check)
+        
         # Patient list
         list_frame = ttk.LabelFrame(parent, text="Patient List")
         list_frame.grid(row=0, column=1, padx=10, pady=5, sticky="nsew")
         
-        self.patient_tree = ttk.Treeview(list_frame, columns=("ID", "Name", "Age", "Gender", "Phone"))
-        self.patient_tree.heading("ID", text="ID")
-        self.patient_tree.heading("Name", text="Name")
-        self.patient_tree.heading("Age", text="Age")
-        self.patient_tree.heading("Gender", text="Gender")
-        self.patient_tree.heading("Phone", text="Phone")
+        self.patient_list = PagedTreeview(list_frame, self.executor,
+                                          ("ID", "Name", "Age", "Gender", "Phone"),
+                                          PATIENT_LIST, action='refresh_patient_list',
+                                          on_loaded=self.tab_loaded)
+        self.patient_tree = self.patient_list.tree
         self.patient_tree.column("ID", width=100)
-        self.patient_tree.pack(padx=5, pady=5)
-        
-        self.refresh_patient_list()
+        self.patient_list.pack(padx=5, pady=5)
     
     def create_doctors_tab(self, parent):
         # Doctor registration form
@@ -200,31 +3050,61 @@ class MainWindow:
         
         ttk.Button(form_frame, text="Register Doctor", command=self.register_doctor).grid(row=4, column=0, columnspan=2, pady=20)
         
+        # Weekly working hours, used to offer free appointment slots
+        hours_frame = ttk.LabelFrame(parent, text="Working Hours")
+        hours_frame.grid(row=1, column=0, padx=10, pady=5, sticky="nsew")
+        
+        ttk.Label(hours_frame, text="Doctor:").grid(row=0, column=0, padx=5, pady=5)
+        self.hours_doctor = EntityPicker(hours_frame, self.executor, 'Doctor', self.picker_cache)
+        self.hours_doctor.grid(row=0, column=1, padx=5, pady=5)
+        
+        ttk.Label(hours_frame, text="Days:").grid(row=1, column=0, padx=5, pady=5)
+        self.hours_days = ttk.Entry(hours_frame)
+        self.hours_days.insert(0, "Mon-Fri")
+        self.hours_days.grid(row=1, column=1, padx=5, pady=5)
+        
+        ttk.Label(hours_frame, text="From - To:").grid(row=2, column=0, padx=5, pady=5)
+        times_frame = ttk.Frame(hours_frame)
+        times_frame.grid(row=2, column=1, padx=5, pady=5)
+        self.hours_start = ttk.Entry(times_frame, width=8)
+        self.hours_start.insert(0, "09:00")
+        self.hours_start.pack(side='left')
+        self.hours_end = ttk.Entry(times_frame, width=8)
+        self.hours_end.insert(0, "17:00")
+        self.hours_end.pack(side='left', padx=5)
+        
+        ttk.Label(hours_frame, text="Slot (minutes):").grid(row=3, column=0, padx=5, pady=5)
+        self.hours_slot = ttk.Entry(hours_frame)
+        self.hours_slot.insert(0, "30")
+        self.hours_slot.grid(row=3, column=1, padx=5, pady=5)
+        
+        ttk.Button(hours_frame, text="Save Hours", command=self.save_doctor_hours).grid(row=4, column=0, columnspan=2, pady=10)
+        
         # Doctor list
         list_frame = ttk.LabelFrame(parent, text="Doctor List")
         list_frame.grid(row=0, column=1, padx=10, pady=5, sticky="nsew")
         
-        self.doctor_tree = ttk.Treeview(list_frame, columns=("ID", "Name", "Specialization", "Phone"))
-        self.doctor_tree.heading("ID", text="ID")
-        self.doctor_tree.heading("Name", text="Name")
-        self.doctor_tree.heading("Specialization", text="Specialization")
-        self.doctor_tree.heading("Phone", text="Phone")
+        self.doctor_list = PagedTreeview(list_frame, self.executor,
+                                         ("ID", "Name", "Specialization", "Phone"),
+                                         DOCTOR_LIST, action='refresh_doctor_list',
+                                         on_loaded=self.tab_loaded)
+        self.doctor_tree = self.doctor_list.tree
         self.doctor_tree.column("ID", width=100)
-        self.doctor_tree.pack(padx=5, pady=5)
-        
-        self.refresh_doctor_list()
+        self.doctor_list.pack(padx=5, pady=5)
     
     def create_appointments_tab(self, parent):
         # Appointment booking form
         form_frame = ttk.LabelFrame(parent, text="Book Appointment")
         form_frame.grid(row=0, column=0, padx=10, pady=5, sticky="nsew")
         
-        ttk.Label(form_frame, text="Patient ID:").grid(row=0, column=0, padx=5, pady=5)
-        self.appointment_patient = ttk.Entry(form_frame)
+        ttk.Label(form_frame, text="Patient:").grid(row=0, column=0, padx=5, pady=5)
+        self.appointment_patient = EntityPicker(form_frame, self.executor, 'Patient',
+                                                self.picker_cache)
         self.appointment_patient.grid(row=0, column=1, padx=5, pady=5)
         
-        ttk.Label(form_frame, text="Doctor ID:").grid(row=1, column=0, padx=5, pady=5)
-        self.appointment_doctor = ttk.Entry(form_frame)
+        ttk.Label(form_frame, text="Doctor:").grid(row=1, column=0, padx=5, pady=5)
+        self.appointment_doctor = EntityPicker(form_frame, self.executor, 'Doctor',
+                                               self.picker_cache)
         self.appointment_doctor.grid(row=1, column=1, padx=5, pady=5)
         
         ttk.Label(form_frame, text="Date (YYYY-MM-DD):").grid(row=2, column=0, padx=5, pady=5)
@@ -237,123 +3117,766 @@ class MainWindow:
         
         ttk.Button(form_frame, text="Book Appointment", command=self.book_appointment).grid(row=4, column=0, columnspan=2, pady=20)
         
+        # Next free slots for one doctor or any doctor of a specialization
+        slots_frame = ttk.LabelFrame(parent, text="Free Slots")
+        slots_frame.grid(row=1, column=0, columnspan=2, padx=10, pady=5, sticky="nsew")
+        
+        ttk.Label(slots_frame, text="Specialization:").grid(row=0, column=0, padx=5, pady=5)
+        self.slot_specialization = ttk.Entry(slots_frame)
+        self.slot_specialization.grid(row=0, column=1, padx=5, pady=5)
+        ttk.Button(slots_frame, text="Find Free Slots", command=self.find_free_slots).grid(row=0, column=2, padx=5, pady=5)
+        
+        self.slot_tree = ttk.Treeview(slots_frame, columns=("Date", "Time", "Doctor", "Doctor ID"),
+                                      displaycolumns=("Date", "Time", "Doctor"),
+                                      show='headings', height=5)
+        for column in ("Date", "Time", "Doctor"):
+            self.slot_tree.heading(column, text=column)
+        self.slot_tree.grid(row=1, column=0, columnspan=3, padx=5, pady=5, sticky="nsew")
+        self.slot_tree.bind('<<TreeviewSelect>>', self.use_free_slot)
+        
         # Appointment list
         list_frame = ttk.LabelFrame(parent, text="Appointment List")
         list_frame.grid(row=0, column=1, padx=10, pady=5, sticky="nsew")
         
-        self.appointment_tree = ttk.Treeview(list_frame, columns=("ID", "Patient", "Doctor", "Date", "Time", "Status"))
-        self.appointment_tree.heading("ID", text="ID")
-        self.appointment_tree.heading("Patient", text="Patient")
-        self.appointment_tree.heading("Doctor", text="Doctor")
-        self.appointment_tree.heading("Date", text="Date")
-        self.appointment_tree.heading("Time", text="Time")
-        self.appointment_tree.heading("Status", text="Status")
+        self.appointment_list = PagedTreeview(list_frame, self.executor,
+                                              ("ID", "Patient", "Doctor", "Date", "Time", "Status"),
+                                              APPOINTMENT_LIST, action='refresh_appointment_list',
+                                              on_loaded=self.tab_loaded)
+        self.appointment_tree = self.appointment_list.tree
         self.appointment_tree.column("ID", width=100)
-        self.appointment_tree.pack(padx=5, pady=5)
+        self.appointment_list.pack(padx=5, pady=5)
+    
+    def create_calendar_tab(self, parent):
+        # A day or week of appointments for one doctor or for everyone. Each
+        # view is a range scan on starts_at, paged like the other lists.
+        controls = ttk.Frame(parent)
+        controls.pack(fill='x', padx=10, pady=5)
+        
+        ttk.Label(controls, text="Doctor:").pack(side='left')
+        self.calendar_doctor = EntityPicker(controls, self.executor, 'Doctor', self.picker_cache,
+                                            width=38)
+        self.calendar_doctor.pack(side='left', padx=5)
         
-        self.refresh_appointment_list()
+        ttk.Label(controls, text="Date:").pack(side='left')
+        self.calendar_date = ttk.Entry(controls, width=12)
+        self.calendar_date.insert(0, datetime.now().strftime('%Y-%m-%d'))
+        self.calendar_date.pack(side='left', padx=5)
+        
+        self.calendar_span = ttk.Combobox(controls, values=("Day", "Week"), width=6,
+                                          state='readonly')
+        self.calendar_span.set("Day")
+        self.calendar_span.pack(side='left', padx=5)
+        self.calendar_span.bind('<<ComboboxSelected>>', lambda event: self.show_calendar())
+        
+        ttk.Button(controls, text="<", width=3,
+                   command=lambda: self.show_calendar(-1)).pack(side='left')
+        ttk.Button(controls, text="Today", command=self.show_today).pack(side='left', padx=2)
+        ttk.Button(controls, text=">", width=3,
+                   command=lambda: self.show_calendar(1)).pack(side='left')
+        ttk.Button(controls, text="Show", command=self.show_calendar).pack(side='left', padx=5)
+        
+        list_frame = ttk.LabelFrame(parent, text="Appointments")
+        list_frame.pack(fill='both', expand=True, padx=10, pady=5)
+        
+        first = timestamp_of(datetime.combine(datetime.now().date(), datetime.min.time()))
+        self.calendar_list = PagedTreeview(list_frame, self.executor,
+                                           ("Date", "Time", "Minutes", "Patient", "Doctor", "Status"),
+                                           CALENDAR_LIST, params=(first, first + 86400),
+                                           action='refresh_calendar', on_loaded=self.tab_loaded)
+        self.calendar_list.pack(fill='both', expand=True, padx=5, pady=5)
     
-    def register_patient(self):
+    def show_today(self):
+        self.calendar_date.delete(0, 'end')
+        self.calendar_date.insert(0, datetime.now().strftime('%Y-%m-%d'))
+        self.show_calendar()
+    
+    def show_calendar(self, step=0):
         try:
-            patient_id = str(uuid.uuid4())
-            cursor = self.db.conn.cursor()
-            cursor.execute('''
-            INSERT INTO patients (patient_id, name, age, gender, phone, address, blood_group)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (patient_id, self.patient_name.get(), self.patient_age.get(),
-                 self.patient_gender.get(), self.patient_phone.get(),
-                 self.patient_address.get(), self.patient_blood.get()))
-            self.db.conn.commit()
-            messagebox.showinfo("Success", f"Patient registered successfully\nID: {patient_id}")
-            self.refresh_patient_list()
-        except Exception as e:
+            day = datetime.strptime(self.calendar_date.get().strip(), '%Y-%m-%d')
+        except ValueError:
+            messagebox.showerror("Error", "Enter the date as YYYY-MM-DD")
+            return
+        doctor_id = self.calendar_doctor.get().strip()
+        try:
+            doctor_uid = parse_uid(doctor_id, 'doctor') if doctor_id else None
+        except ValueError as e:
             messagebox.showerror("Error", str(e))
+            return
+        
+        # Weeks run Monday to Sunday; the arrows move by one day or week
+        days = 7 if self.calendar_span.get() == "Week" else 1
+        if days == 7:
+            day -= timedelta(days=day.weekday())
+        day += timedelta(days=step * days)
+        self.calendar_date.delete(0, 'end')
+        self.calendar_date.insert(0, day.strftime('%Y-%m-%d'))
+        
+        first = timestamp_of(day)
+        last = first + days * 86400
+        if doctor_uid is None:
+            self.calendar_list.show(CALENDAR_LIST, (first, last))
+        else:
+            self.calendar_list.show(DOCTOR_CALENDAR_LIST, (doctor_uid, first, last))
+    
+    def patient_form(self):
+        return (self.patient_name.get(), self.patient_age.get(), self.patient_gender.get(),
+                self.patient_phone.get(), self.patient_address.get(), self.patient_blood.get())
+    
+    def schedule_duplicate_check(self, event=None):
+        # Debounced like the search window; an older check still running
+        # is ignored when it finishes
+        if self.duplicate_check is not None:
+            self.root.after_cancel(self.duplicate_check)
+        self.duplicate_generation += 1
+        self.duplicate_check = self.root.after(400, self.check_duplicates)
+    
+    def check_duplicates(self):
+        self.duplicate_check = None
+        generation = self.duplicate_generation
+        
+        def checked(matches):
+            if generation == self.duplicate_generation:
+                self.show_duplicates(matches)
+        
+        self.executor.run(HospitalDB.find_duplicate_patients, *self.patient_form()[:5],
+                          on_success=checked)
+    
+    def show_duplicates(self, matches):
+        self.duplicate_tree.delete(*self.duplicate_tree.get_children())
+        for score, patient_id, name, age, gender, phone, address in matches:
+            self.duplicate_tree.insert('', 'end', values=(f"{score:.0%}", patient_id, name, age, phone))
+    
+    def register_patient(self):
+        # The check runs again on what is being registered, in case the
+        # same person was registered at another desk since it was typed
+        done = METRICS.start_action('register_patient')
+        form = self.patient_form()
+        if self.duplicate_check is not None:
+            self.root.after_cancel(self.duplicate_check)
+            self.duplicate_check = None
+        self.duplicate_generation += 1
+        
+        def checked(matches):
+            self.show_duplicates(matches)
+            if matches and not messagebox.askyesno(
+                    "Possible duplicate",
+                    f"{len(matches)} registered patient(s) may be the same person; they are "
+                    "listed under the form.\n\nRegister a new patient anyway?"):
+                return
+            self.executor.run(HospitalDB.add_patient, *form,
+                              on_success=lambda result: self.patient_registered(result, done),
+                              busy=self.patient_list)
+        
+        self.executor.run(HospitalDB.find_duplicate_patients, *form[:5],
+                          on_success=checked, busy=self.patient_list)
+    
+    def patient_registered(self, result, done=None):
+        patient_id, rowid = result
+        SEARCH_CACHE.invalidate('Patient')
+        self.show_duplicates([])
+        # The row goes in while the dialog is open
+        self.patient_list.insert_row(rowid, on_done=done)
+        messagebox.showinfo("Success", f"Patient registered successfully\nID: {patient_id}")
     
     def register_doctor(self):
-        try:
-            doctor_id = str(uuid.uuid4())
-            cursor = self.db.conn.cursor()
-            cursor.execute('''
-            INSERT INTO doctors (doctor_id, name, specialization, phone, email)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (doctor_id, self.doctor_name.get(), self.doctor_specialization.get(),
-                 self.doctor_phone.get(), self.doctor_email.get()))
-            self.db.conn.commit()
-            messagebox.showinfo("Success", f"Doctor registered successfully\nID: {doctor_id}")
-            self.refresh_doctor_list()
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
+        done = METRICS.start_action('register_doctor')
+        self.executor.run(HospitalDB.add_doctor, self.doctor_name.get(),
+                          self.doctor_specialization.get(), self.doctor_phone.get(),
+                          self.doctor_email.get(),
+                          on_success=lambda result: self.doctor_registered(result, done),
+                          busy=self.doctor_list)
+    
+    def doctor_registered(self, result, done=None):
+        doctor_id, rowid = result
+        SEARCH_CACHE.invalidate('Doctor')
+        self.doctor_list.insert_row(rowid, on_done=done)
+        messagebox.showinfo("Success", f"Doctor registered successfully\nID: {doctor_id}")
     
     def book_appointment(self):
-        try:
-            appointment_id = str(uuid.uuid4())
-            cursor = self.db.conn.cursor()
-            cursor.execute('''
-            INSERT INTO appointments (appointment_id, patient_id, doctor_id, date, time, status)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''', (appointment_id, self.appointment_patient.get(),
-                 self.appointment_doctor.get(), self.appointment_date.get(),
-                 self.appointment_time.get(), "Scheduled"))
-            self.db.conn.commit()
-            messagebox.showinfo("Success", "Appointment booked successfully")
-            self.refresh_appointment_list()
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
+        done = METRICS.start_action('book_appointment')
+        self.executor.run(HospitalDB.book_appointment, self.appointment_patient.get(),
+                          self.appointment_doctor.get(), self.appointment_date.get(),
+                          self.appointment_time.get(),
+                          on_success=lambda result: self.appointment_booked(result, done),
+                          busy=self.appointment_list)
+    
+    def appointment_booked(self, result, done=None):
+        appointment_id, rowid = result
+        self.appointment_list.insert_row(rowid, on_done=done)
+        messagebox.showinfo("Success", "Appointment booked successfully")
+        # Offered slots may be taken now; find them again for fresh ones
+        self.slot_tree.delete(*self.slot_tree.get_children())
+    
+    def save_doctor_hours(self):
+        self.executor.run(HospitalDB.set_doctor_hours, self.hours_doctor.get().strip(),
+                          self.hours_days.get(), self.hours_start.get(),
+                          self.hours_end.get(), self.hours_slot.get(),
+                          on_success=lambda days: messagebox.showinfo(
+                              "Success", f"Working hours saved for {days} day(s)"))
+    
+    def find_free_slots(self):
+        # A doctor ID in the booking form narrows the search to that doctor
+        done = METRICS.start_action('find_free_slots')
+        self.executor.run(HospitalDB.find_free_slots, self.appointment_doctor.get().strip(),
+                          self.slot_specialization.get(),
+                          on_success=lambda slots: self.show_free_slots(slots, done))
+    
+    def show_free_slots(self, slots, done=None):
+        self.slot_tree.delete(*self.slot_tree.get_children())
+        for slot in slots:
+            self.slot_tree.insert('', 'end', values=slot)
+        if done is not None:
+            done()
+        if not slots:
+            messagebox.showinfo("Free Slots", "No free slots in the next four weeks. "
+                                "Check that the doctor's working hours are set.")
+    
+    def use_free_slot(self, event):
+        selection = self.slot_tree.selection()
+        if not selection:
+            return
+        date, time_of_day, name, doctor_id = self.slot_tree.item(selection[0])['values']
+        self.appointment_doctor.set(doctor_id, name)
+        for entry, value in ((self.appointment_date, date),
+                             (self.appointment_time, time_of_day)):
+            entry.delete(0, 'end')
+            entry.insert(0, value)
     
     def refresh_patient_list(self):
-        for item in self.patient_tree.get_children():
-            self.patient_tree.delete(item)
-        
-        cursor = self.db.conn.cursor()
-        cursor.execute('SELECT patient_id, name, age, gender, phone FROM patients')
-        for row in cursor.fetchall():
-            self.patient_tree.insert('', 'end', values=row)
+        self.patient_list.refresh()
     
     def refresh_doctor_list(self):
-        for item in self.doctor_tree.get_children():
-            self.doctor_tree.delete(item)
-        
-        cursor = self.db.conn.cursor()
-        cursor.execute('SELECT doctor_id, name, specialization, phone FROM doctors')
-        for row in cursor.fetchall():
-            self.doctor_tree.insert('', 'end', values=row)
+        self.doctor_list.refresh()
     
     def refresh_appointment_list(self):
-        for item in self.appointment_tree.get_children():
-            self.appointment_tree.delete(item)
-        
-        cursor = self.db.conn.cursor()
+        self.appointment_list.refresh()
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+def parse_weekdays(text):
+    # Accepts "Mon-Fri", "Mon,Wed,Fri" or a mix such as "Mon-Wed, Sat"
+    names = [day.lower() for day in WEEKDAYS]
+    weekdays = set()
+    for part in text.split(','):
+        bounds = [b.strip().lower()[:3] for b in part.split('-')]
+        if not bounds[0] or len(bounds) > 2 or any(b not in names for b in bounds):
+            raise ValueError(f"Unknown weekday {part.strip()!r}")
+        first, last = names.index(bounds[0]), names.index(bounds[-1])
+        weekdays.update(range(first, last + 1) if first <= last
+                        else list(range(first, 7)) + list(range(last + 1)))
+    return sorted(weekdays)
+
+def minutes_of(time_of_day):
+    match = re.fullmatch(r'\s*(\d{1,2}):(\d{2})\s*', time_of_day)
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        raise ValueError(f"invalid time {time_of_day!r}")
+    return int(match.group(1)) * 60 + int(match.group(2))
+
+def time_of(minutes):
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+class DaySchedule:
+    # One doctor's bookings on one day as [start, end) minute intervals
+    # sorted by start. reach[i] is the latest end among the first i + 1
+    # intervals, so an overlap test is one binary search even when older
+    # imported rows already overlap each other.
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        self.reach = []
+        for start, end in sorted(intervals):
+            self.starts.append(start)
+            self.ends.append(end)
+            self.reach.append(max(end, self.reach[-1]) if self.reach else end)
+
+    def add(self, start, end):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.reach.insert(i, end)
+        for j in range(i, len(self.reach)):
+            self.reach[j] = max(self.ends[j], self.reach[j - 1] if j else 0)
+
+    def conflicts(self, start, end):
+        # Intervals starting before `end` overlap unless all end by `start`
+        i = bisect.bisect_left(self.starts, end)
+        return i > 0 and self.reach[i - 1] > start
+
+    def free_slots(self, start, end, slot, not_before=0):
+        first = max(start, start + -(-(not_before - start) // slot) * slot)
+        return [s for s in range(first, end - slot + 1, slot)
+                if not self.conflicts(s, s + slot)]
+
+class Scheduler:
+    # Doctor working hours, double-booking checks and free-slot search over
+    # the appointments table. Day schedules come from range scans of
+    # idx_appointments_doctor_start, one day at a time as the search needs
+    # them, and are cached until another connection commits. Booking runs
+    # in the write transaction and re-reads the day under the write lock.
+    DEFAULT_DURATION = 30
+    HORIZON_DAYS = 28
+    MAX_CACHED = 50000
+    EMPTY_DAY = DaySchedule()
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.days = {}
+        self.loaded = set()
+        self.hours = {}
+        self.data_version = None
+
+    def sync(self):
+        version = self.reader.execute('PRAGMA data_version').fetchone()[0]
+        if version != self.data_version or len(self.days) + len(self.loaded) > self.MAX_CACHED:
+            self.days.clear()
+            self.loaded.clear()
+            self.hours.clear()
+            self.data_version = version
+
+    @staticmethod
+    def load_hours(conn, doctor_ids):
+        hours = {doctor_id: {} for doctor_id in doctor_ids}
+        cursor = conn.cursor()
+        for start in range(0, len(doctor_ids), 500):
+            chunk = doctor_ids[start:start + 500]
+            cursor.execute(f'''
+            SELECT doctor_id, weekday, start_time, end_time, slot_minutes
+            FROM doctor_hours WHERE doctor_id IN ({', '.join('?' for _ in chunk)})
+            ''', chunk)
+            for doctor_id, weekday, start_time, end_time, slot in cursor.fetchall():
+                hours[doctor_id][weekday] = (minutes_of(start_time), minutes_of(end_time), slot)
+        return hours
+
+    @staticmethod
+    def load_days(conn, doctor_ids, first, last):
+        # Appointments without a readable start cannot be placed on the
+        # calendar and are skipped
+        intervals = {}
+        begin = timestamp_of(datetime.strptime(first, '%Y-%m-%d'))
+        end = timestamp_of(datetime.strptime(last, '%Y-%m-%d') + timedelta(days=1))
+        cursor = conn.cursor()
+        for start in range(0, len(doctor_ids), 500):
+            chunk = doctor_ids[start:start + 500]
+            cursor.execute(f'''
+            SELECT doctor_id, date(starts_at, 'unixepoch'), starts_at % 86400 / 60, duration
+            FROM appointments
+            WHERE doctor_id IN ({', '.join('?' for _ in chunk)})
+            AND starts_at >= ? AND starts_at < ? AND status != 'Cancelled'
+            ''', chunk + [begin, end])
+            for doctor_id, date, minutes, duration in cursor.fetchall():
+                intervals.setdefault((doctor_id, date), []).append((minutes, minutes + duration))
+        return {key: DaySchedule(day) for key, day in intervals.items()}
+
+    def book(self, conn, patient_id, doctor_id, date, time_of_day, duration=None):
+        try:
+            day = datetime.strptime(date.strip(), '%Y-%m-%d')
+            start = minutes_of(time_of_day)
+        except ValueError:
+            raise ValueError("Enter the date as YYYY-MM-DD and the time as HH:MM")
+        date = day.strftime('%Y-%m-%d')
+
+        # conn is in the write transaction, so the check and the insert see
+        # every booking committed before, including earlier ones in the same
+        # group commit; two desks or processes cannot both take the slot
+        hours = self.load_hours(conn, [doctor_id])[doctor_id].get(day.weekday())
+        duration = int(duration or (hours[2] if hours else self.DEFAULT_DURATION))
+        end = start + duration
+        if hours and not (hours[0] <= start and end <= hours[1]):
+            raise ValueError(f"Outside the doctor's hours on {WEEKDAYS[day.weekday()]} "
+                             f"({time_of(hours[0])}-{time_of(hours[1])})")
+        schedule = self.load_days(conn, [doctor_id], date, date).get((doctor_id, date))
+        if schedule is not None and schedule.conflicts(start, end):
+            raise ValueError(f"The doctor is already booked between "
+                             f"{time_of(start)} and {time_of(end)} on {date}")
+        uid = new_uid()
+        cursor = conn.cursor()
         cursor.execute('''
-        SELECT a.appointment_id, p.name, d.name, a.date, a.time, a.status
-        FROM appointments a
-        JOIN patients p ON a.patient_id = p.patient_id
-        JOIN doctors d ON a.doctor_id = d.doctor_id
-        ''')
-        for row in cursor.fetchall():
-            self.appointment_tree.insert('', 'end', values=row)
-    
-    def run(self):
-        self.root.mainloop()
+        INSERT INTO appointments
+        (uid, patient_id, doctor_id, starts_at, duration, status)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (uid, patient_id, doctor_id, timestamp_of(day) + start * 60, duration,
+              "Scheduled"))
+        return uid_text(uid), cursor.lastrowid
+
+    def set_hours(self, conn, doctor_id, weekdays, start_time, end_time, slot_minutes):
+        if isinstance(weekdays, str):
+            weekdays = parse_weekdays(weekdays)
+        try:
+            start, end = minutes_of(start_time), minutes_of(end_time)
+            slot_minutes = int(slot_minutes)
+        except ValueError:
+            raise ValueError("Enter times as HH:MM and the slot length in minutes")
+        if start >= end or slot_minutes <= 0 or slot_minutes > end - start:
+            raise ValueError("Working hours must end after they start and fit one slot")
+        cursor = conn.cursor()
+        cursor.executemany('''
+        INSERT OR REPLACE INTO doctor_hours
+        (doctor_id, weekday, start_time, end_time, slot_minutes)
+        VALUES (?, ?, ?, ?, ?)
+        ''', [(doctor_id, weekday, time_of(start), time_of(end), slot_minutes)
+              for weekday in weekdays])
+        return len(weekdays)
+
+    def load_day(self, doctor_ids, date):
+        missing = [d for d in doctor_ids if (d, date) not in self.loaded]
+        if missing:
+            self.days.update(self.load_days(self.reader, missing, date, date))
+            self.loaded.update((d, date) for d in missing)
+
+    def free_slots(self, doctor_id=None, specialization=None, count=10, after=None):
+        if not doctor_id and not (specialization or '').strip():
+            raise ValueError("Enter a doctor ID or a specialization")
+        self.sync()
+        cursor = self.reader.cursor()
+        if doctor_id:
+            cursor.execute('''
+            SELECT doctor_id, name, uid_text(uid) FROM doctors WHERE doctor_id = ?
+            ''', (doctor_id,))
+        else:
+            cursor.execute('''
+            SELECT doctor_id, name, uid_text(uid) FROM doctors
+            WHERE specialization = ? COLLATE NOCASE
+            ''', (specialization.strip(),))
+        doctors = cursor.fetchall()
+        missing = [d for d, name, uid in doctors if d not in self.hours]
+        self.hours.update(self.load_hours(self.reader, missing))
+        # Doctors without working hours have no slots to offer
+        doctors = [doctor for doctor in doctors if self.hours[doctor[0]]]
+
+        after = after or datetime.now()
+        first = datetime(after.year, after.month, after.day)
+        slots = []
+        for n in range(self.HORIZON_DAYS):
+            day = first + timedelta(days=n)
+            date = day.strftime('%Y-%m-%d')
+            self.load_day([d for d, name, uid in doctors if day.weekday() in self.hours[d]],
+                          date)
+            not_before = after.hour * 60 + after.minute if n == 0 else 0
+            found = []
+            for d, name, uid in doctors:
+                working = self.hours[d].get(day.weekday())
+                if working is None:
+                    continue
+                schedule = self.days.get((d, date), self.EMPTY_DAY)
+                for start in schedule.free_slots(*working, not_before=not_before):
+                    found.append((start, name, uid))
+            # Earliest first across doctors, stopping once enough are found
+            for start, name, uid in sorted(found):
+                slots.append((date, time_of(start), name, uid))
+            if len(slots) >= count:
+                break
+        return slots[:count]
+
+class SearchEngine:
+    # Ranked full-text search over patients and doctors. Name searches go
+    # through the FTS5 indexes; ID searches are range scans on the uid
+    # index. Results are always capped at page_size rows.
+    TARGETS = {
+        'Patient': ('patients',
+                    "t.gender || ', Age: ' || t.age || ', Phone: ' || t.phone"),
+        'Doctor': ('doctors',
+                   "t.specialization || ', Phone: ' || t.phone"),
+    }
+
+    PAGE_SIZE = 50
+
+    def __init__(self, conn, page_size=PAGE_SIZE, candidate_limit=1000):
+        self.conn = conn
+        self.page_size = page_size
+        self.candidate_limit = candidate_limit
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'patients_fts'")
+        self.has_fts = cursor.fetchone() is not None
+
+    def search(self, search_type, term, limit=None):
+        limit = limit or self.page_size
+        kind = 'Doctor' if search_type.startswith('Doctor') else 'Patient'
+        term = term.strip()
+        if not term:
+            return []
+        if search_type.endswith('ID'):
+            return self.search_id_prefix(kind, term, limit)
+        column = 'name' if search_type.endswith('Name') else None
+        return self.search_text(kind, term, column, limit)
+
+    def search_id_prefix(self, kind, prefix, limit):
+        table, details = self.TARGETS[kind]
+        # A hex prefix of the 16-byte uid covers one contiguous range
+        digits = prefix.lower().replace('-', '')
+        if not re.fullmatch(r'[0-9a-f]{1,32}', digits):
+            return []
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+        SELECT uid_text(t.uid), t.name, '{kind}', {details}
+        FROM {table} t WHERE t.uid BETWEEN ? AND ?
+        ORDER BY t.uid LIMIT ?
+        ''', (bytes.fromhex(digits.ljust(32, '0')), bytes.fromhex(digits.ljust(32, 'f')),
+              limit))
+        return cursor.fetchall()
+
+    def pick(self, kind, term, limit):
+        # Top matches for a picker: the start of an ID, of a phone number,
+        # or of the name or any word in it. Each is a range scan on an
+        # index, or the full-text index for words after the first.
+        table, details = self.TARGETS[kind]
+        term = term.strip()
+        if not term:
+            return []
+        if re.fullmatch(r'[0-9a-fA-F]{8}-[0-9a-fA-F-]*', term):
+            return self.search_id_prefix(kind, term, limit)
+        digits = re.sub(r'[\s()+-]', '', term)
+        if len(digits) >= 3 and digits.isdigit():
+            if kind == 'Doctor':
+                return self.search_text(kind, digits, 'phone', limit)
+            # Patients' numbers are indexed as their last ten digits
+            prefix = digits[-10:]
+            cursor = self.conn.cursor()
+            cursor.execute(f'''
+            SELECT uid_text(t.uid), t.name, '{kind}', {details}
+            FROM patients t WHERE t.phone_key >= ? AND t.phone_key < ?
+            ORDER BY t.phone_key LIMIT ?''', (prefix, prefix + ':', limit))
+            return cursor.fetchall()
+
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+        SELECT uid_text(t.uid), t.name, '{kind}', {details}
+        FROM {table} t WHERE t.name >= ? COLLATE NOCASE AND t.name < ? COLLATE NOCASE
+        ORDER BY t.name COLLATE NOCASE LIMIT ?''', (term, term + '\U0010ffff', limit))
+        rows = cursor.fetchall()
+        if len(rows) < limit:
+            found = {row[0] for row in rows}
+            rows += [row for row in self.search_text(kind, term, 'name', limit)
+                     if row[0] not in found][:limit - len(rows)]
+        return rows
+
+    def search_text(self, kind, term, column, limit):
+        table, details = self.TARGETS[kind]
+        tokens = re.findall(r'\w+', term.lower())
+        if not tokens:
+            return []
+        cursor = self.conn.cursor()
+        if not self.has_fts:
+            cursor.execute(f'''
+            SELECT uid_text(t.uid), t.name, '{kind}', {details}
+            FROM {table} t WHERE t.{column or 'name'} LIKE ? LIMIT ?
+            ''', (f'%{term}%', limit))
+            return cursor.fetchall()
+
+        query = ' '.join(f'"{token}"*' for token in tokens)
+        if column:
+            query = f'{column} : ({query})'
+        # Common terms can match most of the table. Ranking is done over a
+        # bounded candidate window so its cost does not grow with the data.
+        cursor.execute(f'''
+        SELECT uid_text(t.uid), t.name, '{kind}', {details}
+        FROM (SELECT rowid, rank FROM {table}_fts WHERE {table}_fts MATCH ? LIMIT ?) f
+        JOIN {table} t ON t.rowid = f.rowid
+        ORDER BY f.rank LIMIT ?
+        ''', (query, self.candidate_limit, limit))
+        return cursor.fetchall()
+
+class SearchCache:
+    # Bounded LRU of search results keyed on (search type, normalized term).
+    # A result set smaller than the page cap is complete, so any longer term
+    # that extends it can be answered by filtering it in memory.
+    NARROWABLE = ('Patient ID', 'Patient Name', 'Doctor ID', 'Doctor Name')
+
+    def __init__(self, capacity=128):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.data_versions = {}
+
+    @staticmethod
+    def normalize(term):
+        return ' '.join(term.lower().split())
+
+    def get(self, search_type, term):
+        term = self.normalize(term)
+        with self.lock:
+            key = (search_type, term)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            if search_type not in self.NARROWABLE:
+                return None
+            for end in range(len(term) - 1, 0, -1):
+                entry = self.entries.get((search_type, term[:end]))
+                if entry is not None and entry[1]:
+                    rows = [row for row in entry[0] if self.matches(search_type, term, row)]
+                    self.store(key, rows, True)
+                    return rows
+        return None
+
+    def sync(self, conn):
+        # PRAGMA data_version moves whenever another connection or process
+        # commits; anything cached before that may be stale.
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        last = self.data_versions.get(id(conn))
+        self.data_versions[id(conn)] = version
+        if last is not None and last != version:
+            self.invalidate()
+
+    def put(self, search_type, term, rows, complete):
+        with self.lock:
+            self.store((search_type, self.normalize(term)), rows, complete)
+
+    def store(self, key, rows, complete):
+        self.entries[key] = (rows, complete)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, kind=None):
+        with self.lock:
+            if kind is None:
+                self.entries.clear()
+                return
+            for key in [k for k in self.entries if k[0].startswith(kind)]:
+                del self.entries[key]
+
+    @staticmethod
+    def matches(search_type, term, row):
+        if search_type.endswith('ID'):
+            # IDs are matched on their hex digits, as search_id_prefix does
+            return str(row[0]).lower().replace('-', '').startswith(term.replace('-', ''))
+        words = re.findall(r'\w+', str(row[1]).lower())
+        return all(any(w.startswith(t) for w in words) for t in re.findall(r'\w+', term))
+
+SEARCH_CACHE = SearchCache()
+
+class PickerCache:
+    # Recent picker results of one window by (kind, term), dropped when
+    # patients or doctors change
+    TABLES = {'patients': 'Patient', 'doctors': 'Doctor'}
+
+    def __init__(self, window, capacity=64):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        ChangeFeed.get().subscribe(window, tuple(self.TABLES), self.data_changed)
+
+    def get(self, kind, term):
+        key = (kind, term.strip().lower())
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, kind, term, rows):
+        self.entries[(kind, term.strip().lower())] = rows
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def data_changed(self, changes):
+        kinds = set(self.TABLES.values()) if changes is None else {
+            self.TABLES[change[0]] for change in changes}
+        for key in [key for key in self.entries if key[0] in kinds]:
+            del self.entries[key]
+
+class EntityPicker:
+    # A combobox for a patient or doctor ID. Typing the start of a name,
+    # a phone number or an ID lists the best matches to choose from;
+    # get() returns the chosen one's ID, or the text as typed, so an ID
+    # can still be pasted.
+    def __init__(self, parent, executor, kind, cache, width=30, limit=10, debounce_ms=250):
+        self.executor = executor
+        self.kind = kind
+        self.cache = cache
+        self.limit = limit
+        self.debounce_ms = debounce_ms
+        self.var = tk.StringVar()
+        self.combo = ttk.Combobox(parent, textvariable=self.var, width=width)
+        self.combo.bind('<KeyRelease>', self.schedule)
+        self.combo.bind('<<ComboboxSelected>>', lambda event: self.combo.icursor('end'))
+        # ID of each label listed so far
+        self.ids = {}
+        self.term = ''
+        self.pending = None
+        self.generation = 0
+
+    def pack(self, **options):
+        self.combo.pack(**options)
+
+    def grid(self, **options):
+        self.combo.grid(**options)
+
+    def get(self):
+        text = self.var.get().strip()
+        return self.ids.get(text, text)
+
+    def set(self, entity_id, name=None):
+        label = f"{name} - {entity_id}" if name else entity_id
+        self.ids[label] = entity_id
+        self.term = label
+        self.var.set(label)
+
+    def schedule(self, event=None):
+        # Arrow keys and the like leave the text as it was
+        if self.var.get().strip() == self.term:
+            return
+        if self.pending is not None:
+            self.combo.after_cancel(self.pending)
+        self.generation += 1
+        self.pending = self.combo.after(self.debounce_ms, self.lookup)
+
+    def lookup(self):
+        self.pending = None
+        term = self.term = self.var.get().strip()
+        if term in self.ids:
+            return
+        rows = self.cache.get(self.kind, term)
+        if rows is not None:
+            self.show(rows)
+            return
+        generation = self.generation
+
+        def found(rows):
+            self.cache.put(self.kind, term, rows)
+            if generation == self.generation:
+                self.show(rows)
+
+        self.executor.run(HospitalDB.pick, self.kind, term, self.limit, on_success=found)
+
+    def show(self, rows):
+        current = self.var.get().strip()
+        self.ids = {current: self.ids[current]} if current in self.ids else {}
+        labels = []
+        for entity_id, name, kind, details in rows:
+            label = f"{name} - {details or ''} - {entity_id}"
+            self.ids[label] = entity_id
+            labels.append(label)
+        self.combo.configure(values=labels)
 
 class SearchWindow:
     def __init__(self, parent):
         self.window = tk.Toplevel(parent)
         self.window.title("Search Records")
         self.window.geometry("400x300")
-        self.db = HospitalDB()
+        self.debounce_ms = 250
+        self.generation = 0
+        self.pending = None
+        self.busy = 0
+        self.executor = DBExecutor.get()
+        self.executor.attach(self.window)
         self.create_widgets()
+        self.window.bind('<Destroy>', self.on_destroy)
+        ChangeFeed.get().subscribe(self.window, ('patients', 'doctors'), self.data_changed)
     
     def create_widgets(self):
         # Search options
         ttk.Label(self.window, text="Search by:").pack(pady=5)
         self.search_type = ttk.Combobox(self.window, 
-                                      values=["Patient ID", "Patient Name", 
-                                             "Doctor ID", "Doctor Name"])
+                                      values=["Patient ID", "Patient Name",
+                                             "Patient (any field)",
+                                             "Doctor ID", "Doctor Name",
+                                             "Doctor (any field)"])
         self.search_type.pack(pady=5)
+        self.search_type.bind('<<ComboboxSelected>>', self.schedule_search)
         
         ttk.Label(self.window, text="Search term:").pack(pady=5)
         self.search_term = ttk.Entry(self.window)
         self.search_term.pack(pady=5)
+        self.search_term.bind('<KeyRelease>', self.schedule_search)
         
         ttk.Button(self.window, text="Search", 
                   command=self.perform_search).pack(pady=20)
@@ -367,107 +3890,105 @@ class SearchWindow:
         self.result_tree.heading("Details", text="Details")
         self.result_tree.pack(pady=10, padx=10, fill='both', expand=True)
     
+    def schedule_search(self, event=None):
+        # Debounce keystrokes; bumping the generation interrupts any search
+        # still running for an older term
+        if self.pending is not None:
+            self.window.after_cancel(self.pending)
+        self.generation += 1
+        self.pending = self.window.after(self.debounce_ms, self.perform_search)
+    
     def perform_search(self):
-        for item in self.result_tree.get_children():
-            self.result_tree.delete(item)
-        
+        self.pending = None
+        self.generation += 1
+        generation = self.generation
         search_type = self.search_type.get()
         search_term = self.search_term.get()
         
-        cursor = self.db.conn.cursor()
+        # Cached results are dropped by data_changed below, and by the
+        # worker when its connection sees a commit
+        rows = SEARCH_CACHE.get(search_type, search_term)
+        if rows is not None:
+            done = METRICS.start_action('perform_search (cached)')
+            self.show_results(rows)
+            done()
+            return
         
-        if "Patient" in search_type:
-            if "ID" in search_type:
-                cursor.execute('''
-                SELECT patient_id, name, 'Patient', 
-                       gender || ', Age: ' || age || ', Phone: ' || phone
-                FROM patients WHERE patient_id LIKE ?
-                ''', (f'%{search_term}%',))
-            else:
-                cursor.execute('''
-                SELECT patient_id, name, 'Patient', 
-                       gender || ', Age: ' || age || ', Phone: ' || phone
-                FROM patients WHERE name LIKE ?
-                ''', (f'%{search_term}%',))
-        else:
-            if "ID" in search_type:
-                cursor.execute('''
-                SELECT doctor_id, name, 'Doctor', 
-                       specialization || ', Phone: ' || phone
-                FROM doctors WHERE doctor_id LIKE ?
-                ''', (f'%{search_term}%',))
-            else:
-                cursor.execute('''
-                SELECT doctor_id, name, 'Doctor', 
-                       specialization || ', Phone: ' || phone
-                FROM doctors WHERE name LIKE ?
-                ''', (f'%{search_term}%',))
+        # Superseded searches are counted as started but never finish
+        done = METRICS.start_action('perform_search')
+        
+        def searched(rows):
+            SEARCH_CACHE.put(search_type, search_term, rows,
+                             len(rows) < SearchEngine.PAGE_SIZE)
+            if generation == self.generation:
+                self.show_results(rows)
+                done()
+        
+        def failed(error):
+            # Interrupted searches were superseded; only report real errors
+            if generation == self.generation:
+                messagebox.showerror("Error", str(error), parent=self.window)
         
-        for row in cursor.fetchall():
+        self.executor.run(HospitalDB.search, search_type, search_term,
+                          lambda: generation != self.generation,
+                          on_success=searched, on_error=failed, busy=self)
+    
+    def set_busy(self, delta):
+        self.busy += delta
+        self.result_tree.configure(cursor='watch' if self.busy else '')
+    
+    def show_results(self, rows):
+        self.result_tree.delete(*self.result_tree.get_children())
+        for row in rows:
             self.result_tree.insert('', 'end', values=row)
+    
+    def data_changed(self, changes):
+        if changes is None:
+            SEARCH_CACHE.invalidate()
+        for kind in {'Doctor' if change[0] == 'doctors' else 'Patient'
+                     for change in changes or ()}:
+            SEARCH_CACHE.invalidate(kind)
+        # Search again when the kind of record listed has changed
+        table = 'doctors' if self.search_type.get().startswith('Doctor') else 'patients'
+        if not self.result_tree.get_children() or self.pending is not None:
+            return
+        if changes is None or any(change[0] == table for change in changes):
+            self.perform_search()
+    
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.generation += 1
 
-def main():
-    login = LoginWindow()
-    login.root.mainloop()
-
-if __name__ == "__main__":
-    main()
+def export_patient_data(window, executor, patient_id, tables):
+    if executor.service:
+        messagebox.showerror("Error", "Exports are run on the computer serving the database "
+                             "(python main.py export).", parent=window)
+        return
+    path = filedialog.asksaveasfilename(
+        parent=window, defaultextension='.zip',
+        filetypes=[("Zip archive", "*.zip"), ("JSON lines", "*.jsonl"),
+                   ("Compressed JSON lines", "*.jsonl.gz")])
+    if not path:
+        return
     
-class HospitalDB:
-    def __init__(self):
-        self.conn = sqlite3.connect('hospital.db')
-        self.create_tables()
+    def exported(result):
+        rows, elapsed = result
+        messagebox.showinfo("Success", f"Exported {rows:,} rows to {path}\n"
+                            f"({rows / elapsed if elapsed else 0:,.0f} rows/s)", parent=window)
     
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        # Add Medical Records table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS medical_records (
-            record_id TEXT PRIMARY KEY,
-            patient_id TEXT,
-            doctor_id TEXT,
-            date TEXT,
-            diagnosis TEXT,
-            treatment TEXT,
-            notes TEXT,
-            FOREIGN KEY (patient_id) REFERENCES patients (patient_id),
-            FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id)
-        )''')
-        
-        # Add Prescriptions table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS prescriptions (
-            prescription_id TEXT PRIMARY KEY,
-            record_id TEXT,
-            medicine_name TEXT,
-            dosage TEXT,
-            frequency TEXT,
-            duration TEXT,
-            FOREIGN KEY (record_id) REFERENCES medical_records (record_id)
-        )''')
-        
-        # Add Bills table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bills (
-            bill_id TEXT PRIMARY KEY,
-            patient_id TEXT,
-            date TEXT,
-            description TEXT,
-            amount REAL,
-            status TEXT,
-            FOREIGN KEY (patient_id) REFERENCES patients (patient_id)
-        )''')
-        
-        self.conn.commit()
+    executor.run(HospitalDB.export_patient, patient_id, path, tables,
+                 on_success=exported, priority=DBExecutor.BULK)
 
 class MedicalRecordWindow:
     def __init__(self, parent, patient_id):
         self.window = tk.Toplevel(parent)
         self.window.title("Medical Records")
         self.window.geometry("800x600")
-        self.db = HospitalDB()
+        self.executor = DBExecutor.get()
+        self.executor.attach(self.window)
         self.patient_id = patient_id
+        # Details of listed records by rowid, filled a batch at a time
+        self.record_details = {}
         self.create_widgets()
         
     def create_widgets(self):
@@ -475,25 +3996,20 @@ class MedicalRecordWindow:
         info_frame = ttk.LabelFrame(self.window, text="Patient Information")
         info_frame.pack(fill='x', padx=10, pady=5)
         
-        cursor = self.db.conn.cursor()
-        cursor.execute('SELECT * FROM patients WHERE patient_id = ?', (self.patient_id,))
-        patient = cursor.fetchone()
-        
-        ttk.Label(info_frame, text=f"Name: {patient[1]}").pack(side='left', padx=5)
-        ttk.Label(info_frame, text=f"Age: {patient[2]}").pack(side='left', padx=5)
-        ttk.Label(info_frame, text=f"Gender: {patient[3]}").pack(side='left', padx=5)
+        self.patient_labels = [ttk.Label(info_frame) for _ in range(3)]
+        for label in self.patient_labels:
+            label.pack(side='left', padx=5)
+        self.executor.run(HospitalDB.get_patient, self.patient_id,
+                          on_success=self.show_patient)
         
         # New Record Frame
         record_frame = ttk.LabelFrame(self.window, text="New Medical Record")
         record_frame.pack(fill='x', padx=10, pady=5)
         
         ttk.Label(record_frame, text="Doctor:").grid(row=0, column=0, padx=5, pady=5)
-        self.doctor_var = tk.StringVar()
-        cursor.execute('SELECT doctor_id, name FROM doctors')
-        doctors = cursor.fetchall()
-        self.doctor_combo = ttk.Combobox(record_frame, textvariable=self.doctor_var,
-                                       values=[f"{d[0]} - {d[1]}" for d in doctors])
-        self.doctor_combo.grid(row=0, column=1, padx=5, pady=5)
+        self.doctor_picker = EntityPicker(record_frame, self.executor, 'Doctor',
+                                          PickerCache(self.window))
+        self.doctor_picker.grid(row=0, column=1, padx=5, pady=5)
         
         ttk.Label(record_frame, text="Diagnosis:").grid(row=1, column=0, padx=5, pady=5)
         self.diagnosis = ttk.Entry(record_frame, width=50)
@@ -518,22 +4034,29 @@ class MedicalRecordWindow:
                   command=self.add_prescription_entry).pack(pady=5)
         
         ttk.Button(record_frame, text="Save Medical Record",
-                  command=self.save_record).grid(row=5, column=0, columnspan=2, pady=10)
+                  command=self.save_record).grid(row=5, column=0, pady=10)
+        ttk.Button(record_frame, text="Export History",
+                  command=self.export_history).grid(row=5, column=1, pady=10)
         
         # Records List
         list_frame = ttk.LabelFrame(self.window, text="Medical History")
         list_frame.pack(fill='both', expand=True, padx=10, pady=5)
         
-        self.record_tree = ttk.Treeview(list_frame,
-                                      columns=("Date", "Doctor", "Diagnosis", "Treatment"))
-        self.record_tree.heading("Date", text="Date")
-        self.record_tree.heading("Doctor", text="Doctor")
-        self.record_tree.heading("Diagnosis", text="Diagnosis")
-        self.record_tree.heading("Treatment", text="Treatment")
-        self.record_tree.pack(fill='both', expand=True, padx=5, pady=5)
+        self.record_list = PagedTreeview(list_frame, self.executor,
+                                         ("Date", "Doctor", "Diagnosis", "Treatment"),
+                                         RECORD_LIST,
+                                         params=(parse_uid(self.patient_id, 'patient'),),
+                                         action='refresh_records')
+        self.record_tree = self.record_list.tree
+        self.record_list.pack(fill='both', expand=True, padx=5, pady=5)
         
         self.record_tree.bind('<Double-1>', self.view_record_details)
-        self.refresh_records()
+    
+    def show_patient(self, patient):
+        name, age, gender = patient[1:4]
+        for label, text in zip(self.patient_labels,
+                               (f"Name: {name}", f"Age: {age}", f"Gender: {gender}")):
+            label.configure(text=text)
     
     def add_prescription_entry(self):
         frame = ttk.Frame(self.window)
@@ -554,99 +4077,91 @@ class MedicalRecordWindow:
         self.prescriptions.append((medicine, dosage, frequency, duration))
     
     def save_record(self):
-        try:
-            record_id = str(uuid.uuid4())
-            doctor_id = self.doctor_var.get().split(' - ')[0]
-            
-            cursor = self.db.conn.cursor()
-            
-            # Save medical record
-            cursor.execute('''
-            INSERT INTO medical_records 
-            (record_id, patient_id, doctor_id, date, diagnosis, treatment, notes)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (record_id, self.patient_id, doctor_id, 
-                 datetime.now().strftime('%Y-%m-%d'),
-                 self.diagnosis.get(), self.treatment.get(), 
-                 self.notes.get('1.0', 'end-1c')))
-            
-            # Save prescriptions
-            for med, dos, freq, dur in self.prescriptions:
-                if med.get():  # Only save if medicine name is provided
-                    cursor.execute('''
-                    INSERT INTO prescriptions 
-                    (prescription_id, record_id, medicine_name, dosage, frequency, duration)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (str(uuid.uuid4()), record_id, med.get(), dos.get(),
-                         freq.get(), dur.get()))
-            
-            self.db.conn.commit()
-            messagebox.showinfo("Success", "Medical record saved successfully")
-            self.refresh_records()
-            
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
+        doctor_id = self.doctor_picker.get()
+        # Only save prescriptions where a medicine name is provided
+        prescriptions = [(med.get(), dos.get(), freq.get(), dur.get())
+                         for med, dos, freq, dur in self.prescriptions if med.get()]
+        done = METRICS.start_action('save_record')
+        self.executor.run(HospitalDB.add_medical_record, self.patient_id, doctor_id,
+                          self.diagnosis.get(), self.treatment.get(),
+                          self.notes.get('1.0', 'end-1c'), prescriptions,
+                          on_success=lambda result: self.record_saved(result, done),
+                          busy=self.record_list)
+    
+    def record_saved(self, result, done=None):
+        record_id, rowid = result
+        self.record_list.insert_row(rowid, on_done=done)
+        messagebox.showinfo("Success", "Medical record saved successfully")
+    
+    def export_history(self):
+        export_patient_data(self.window, self.executor, self.patient_id, None)
     
     def refresh_records(self):
-        for item in self.record_tree.get_children():
-            self.record_tree.delete(item)
-        
-        cursor = self.db.conn.cursor()
-        cursor.execute('''
-        SELECT m.date, d.name, m.diagnosis, m.treatment
-        FROM medical_records m
-        JOIN doctors d ON m.doctor_id = d.doctor_id
-        WHERE m.patient_id = ?
-        ORDER BY m.date DESC
-        ''', (self.patient_id,))
-        
-        for row in cursor.fetchall():
-            self.record_tree.insert('', 'end', values=row)
+        self.record_list.refresh()
     
     def view_record_details(self, event):
-        item = self.record_tree.selection()[0]
-        date = self.record_tree.item(item)['values'][0]
+        selection = self.record_tree.selection()
+        if not selection:
+            return
+        rowid = int(selection[0])
+        done = METRICS.start_action('view_record_details')
+        if rowid in self.record_details:
+            self.show_record_details(self.record_details[rowid])
+            done()
+            return
+        
+        # Load every listed record that is not cached yet in one batch, so
+        # opening the others afterwards needs no query at all
+        wanted = [int(item) for item in self.record_tree.get_children()
+                  if int(item) not in self.record_details]
+        
+        def loaded(details):
+            self.record_details.update(details)
+            if rowid in details:
+                self.show_record_details(details[rowid])
+                done()
         
+        self.executor.run(HospitalDB.get_record_details, wanted,
+                          parse_uid(self.patient_id, 'patient'), on_success=loaded)
+    
+    def show_record_details(self, details):
+        record, prescriptions = details
+        record_id, date, doctor, diagnosis, treatment, notes = record
         details_window = tk.Toplevel(self.window)
         details_window.title("Record Details")
         details_window.geometry("600x400")
         
-        cursor = self.db.conn.cursor()
-        cursor.execute('''
-        SELECT m.*, d.name, p.medicine_name, p.dosage, p.frequency, p.duration
-        FROM medical_records m
-        JOIN doctors d ON m.doctor_id = d.doctor_id
-        LEFT JOIN prescriptions p ON m.record_id = p.record_id
-        WHERE m.patient_id = ? AND m.date = ?
-        ''', (self.patient_id, date))
-        
-        record = cursor.fetchone()
-        
         ttk.Label(details_window, text="Medical Record Details",
                  font=('Helvetica', 14, 'bold')).pack(pady=10)
         
         details_frame = ttk.Frame(details_window)
         details_frame.pack(fill='both', expand=True, padx=10)
         
-        ttk.Label(details_frame, text=f"Date: {record[3]}").pack(anchor='w')
-        ttk.Label(details_frame, text=f"Doctor: {record[7]}").pack(anchor='w')
-        ttk.Label(details_frame, text=f"Diagnosis: {record[4]}").pack(anchor='w')
-        ttk.Label(details_frame, text=f"Treatment: {record[5]}").pack(anchor='w')
-        ttk.Label(details_frame, text=f"Notes: {record[6]}").pack(anchor='w')
+        ttk.Label(details_frame, text=f"Date: {date}").pack(anchor='w')
+        ttk.Label(details_frame, text=f"Doctor: {doctor}").pack(anchor='w')
+        ttk.Label(details_frame, text=f"Diagnosis: {diagnosis}").pack(anchor='w')
+        ttk.Label(details_frame, text=f"Treatment: {treatment}").pack(anchor='w')
+        ttk.Label(details_frame, text=f"Notes: {notes}").pack(anchor='w')
         
-        if record[8]:  # If prescriptions exist
+        if prescriptions:
             ttk.Label(details_frame, text="\nPrescriptions:",
                      font=('Helvetica', 12, 'bold')).pack(anchor='w', pady=(10,5))
-            ttk.Label(details_frame,
-                     text=f"Medicine: {record[8]}\nDosage: {record[9]}\n" \
-                          f"Frequency: {record[10]}\nDuration: {record[11]}").pack(anchor='w')
+            columns = ("Medicine", "Dosage", "Frequency", "Duration")
+            prescription_tree = ttk.Treeview(details_frame, columns=columns, show='headings',
+                                             height=min(len(prescriptions), 8))
+            for column in columns:
+                prescription_tree.heading(column, text=column)
+            for prescription in prescriptions:
+                prescription_tree.insert('', 'end', values=prescription)
+            prescription_tree.pack(fill='x', anchor='w')
 
 class BillingWindow:
     def __init__(self, parent, patient_id):
         self.window = tk.Toplevel(parent)
         self.window.title("Billing Management")
         self.window.geometry("600x500")
-        self.db = HospitalDB()
+        self.executor = DBExecutor.get()
+        self.executor.attach(self.window)
         self.patient_id = patient_id
         self.create_widgets()
     
@@ -664,50 +4179,1546 @@ class BillingWindow:
         self.amount.grid(row=1, column=1, padx=5, pady=5)
         
         ttk.Button(bill_frame, text="Generate Bill",
-                  command=self.generate_bill).grid(row=2, column=0, columnspan=2, pady=10)
+                  command=self.generate_bill).grid(row=2, column=0, pady=10)
+        ttk.Button(bill_frame, text="Export Bills",
+                  command=self.export_bills).grid(row=2, column=1, pady=10)
         
         # Bills List
         list_frame = ttk.LabelFrame(self.window, text="Bills History")
         list_frame.pack(fill='both', expand=True, padx=10, pady=5)
         
-        self.bill_tree = ttk.Treeview(list_frame,
-                                    columns=("Date", "Description", "Amount", "Status"))
-        self.bill_tree.heading("Date", text="Date")
-        self.bill_tree.heading("Description", text="Description")
-        self.bill_tree.heading("Amount", text="Amount")
-        self.bill_tree.heading("Status", text="Status")
-        self.bill_tree.pack(fill='both', expand=True, padx=5, pady=5)
-        
-        self.refresh_bills()
+        self.bill_list = PagedTreeview(list_frame, self.executor,
+                                       ("Date", "Description", "Amount", "Status"),
+                                       BILL_LIST,
+                                       params=(parse_uid(self.patient_id, 'patient'),),
+                                       action='refresh_bills')
+        self.bill_tree = self.bill_list.tree
+        self.bill_list.pack(fill='both', expand=True, padx=5, pady=5)
     
     def generate_bill(self):
         try:
-            cursor = self.db.conn.cursor()
-            cursor.execute('''
-            INSERT INTO bills (bill_id, patient_id, date, description, amount, status)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''', (str(uuid.uuid4()), self.patient_id,
-                 datetime.now().strftime('%Y-%m-%d'),
-                 self.description.get(), float(self.amount.get()), "Pending"))
-            
-            self.db.conn.commit()
-            messagebox.showinfo("Success", "Bill generated successfully")
-            self.refresh_bills()
-            
-        except Exception as e:
+            amount = float(self.amount.get())
+        except ValueError as e:
             messagebox.showerror("Error", str(e))
+            return
+        done = METRICS.start_action('generate_bill')
+        self.executor.run(HospitalDB.add_bill, self.patient_id, self.description.get(),
+                          amount, on_success=lambda result: self.bill_generated(result, done),
+                          busy=self.bill_list)
+    
+    def bill_generated(self, result, done=None):
+        bill_id, rowid = result
+        self.bill_list.insert_row(rowid, on_done=done)
+        messagebox.showinfo("Success", "Bill generated successfully")
+    
+    def export_bills(self):
+        export_patient_data(self.window, self.executor, self.patient_id, ['bills'])
     
     def refresh_bills(self):
-        for item in self.bill_tree.get_children():
-            self.bill_tree.delete(item)
+        self.bill_list.refresh()
+
+GENDERS = ("Male", "Female", "Other")
+BLOOD_GROUPS = ("A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-")
+
+def import_field(record, field, required=False):
+    value = record.get(field)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f"{field} is required")
+    return value or None
+
+def validate_patient(record):
+    age = import_field(record, 'age')
+    if age is not None:
+        if not age.isdigit() or int(age) > 150:
+            raise ValueError(f"invalid age {age!r}")
+        age = int(age)
+    gender = import_field(record, 'gender')
+    if gender is not None:
+        gender = gender.capitalize()
+        if gender not in GENDERS:
+            raise ValueError(f"invalid gender {gender!r}")
+    blood_group = import_field(record, 'blood_group')
+    if blood_group is not None and blood_group.upper() not in BLOOD_GROUPS:
+        raise ValueError(f"invalid blood group {blood_group!r}")
+    name = import_field(record, 'name', required=True)
+    phone = import_field(record, 'phone')
+    return ((name, age, gender, phone, import_field(record, 'address'),
+             blood_group and blood_group.upper()) + patient_keys(name, age, phone))
+
+def validate_doctor(record):
+    return (import_field(record, 'name', required=True),
+            import_field(record, 'specialization'), import_field(record, 'phone'),
+            import_field(record, 'email'))
+
+def validate_appointment(record):
+    date = import_field(record, 'date', required=True)
+    time_of_day = import_field(record, 'time', required=True)
+    try:
+        starts_at = timestamp_of(datetime.strptime(f'{date} {time_of_day}', '%Y-%m-%d %H:%M'))
+    except ValueError:
+        raise ValueError(f"invalid date/time {date!r} {time_of_day!r}")
+    return (import_field(record, 'patient_id', required=True),
+            import_field(record, 'doctor_id', required=True),
+            starts_at, import_field(record, 'status') or "Scheduled")
+
+class BulkImporter:
+    # Streams CSV or JSONL rows through validation and foreign-key
+    # resolution into batched executemany transactions. The checkpoint is
+    # committed with each batch, so a resumed import neither skips nor
+    # repeats rows.
+    ENTITIES = {
+        'patients': ('patients', 'patient_id',
+                     ('name', 'age', 'gender', 'phone', 'address', 'blood_group',
+                      'phone_key', 'name_key', 'birth_year'),
+                     validate_patient),
+        'doctors': ('doctors', 'doctor_id',
+                    ('name', 'specialization', 'phone', 'email'),
+                    validate_doctor),
+        'appointments': ('appointments', 'appointment_id',
+                         ('patient_id', 'doctor_id', 'starts_at', 'status'),
+                         validate_appointment),
+    }
+
+    def __init__(self, conn, entity, path, source=None, file_format=None,
+                 batch_size=10000, defer_indexes=False, rejects_path=None,
+                 resume=False, out=sys.stdout):
+        self.conn = conn
+        self.entity = entity
+        self.table, self.key_column, self.columns, self.validate = self.ENTITIES[entity]
+        self.path = str(pathlib.Path(path).resolve())
+        self.source = source or 'default'
+        self.file_format = file_format or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        self.batch_size = batch_size
+        self.defer_indexes = defer_indexes
+        self.rejects_path = rejects_path or f"{path}.rejects.jsonl"
+        self.resume = resume
+        self.out = out
+        self.records_done = 0
+        self.rows_imported = 0
+        self.rows_rejected = 0
+
+    def records(self):
+        with open(self.path, newline='', encoding='utf-8') as f:
+            if self.file_format == 'csv':
+                yield from csv.DictReader(f)
+            else:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def load_checkpoint(self):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT records_done, rows_imported, rows_rejected, indexes_deferred, completed
+        FROM import_checkpoints WHERE source = ? AND entity = ? AND path = ?
+        ''', (self.source, self.entity, self.path))
+        return cursor.fetchone()
+
+    def run(self):
+        checkpoint = self.load_checkpoint()
+        if checkpoint and not checkpoint[4] and not self.resume:
+            raise ValueError(f"an earlier import of {self.path} was interrupted; "
+                             "pass --resume to continue it")
+        if checkpoint and self.resume:
+            if checkpoint[4]:
+                print(f"{self.path} was already imported", file=self.out)
+                return
+            self.records_done, self.rows_imported, self.rows_rejected = checkpoint[:3]
+            self.defer_indexes = self.defer_indexes or bool(checkpoint[3])
+            print(f"Resuming after record {self.records_done:,}", file=self.out)
+        if self.defer_indexes:
+            self.drop_indexes()
+
+        started = time.perf_counter()
+        imported_before = self.rows_imported
+        batch, rejects = [], []
+        self.rejects_file = None
+        try:
+            for number, record in enumerate(self.records()):
+                if number < self.records_done:
+                    continue
+                try:
+                    batch.append((number, record, self.validate(record)))
+                except ValueError as e:
+                    rejects.append((number, record, str(e)))
+                if len(batch) + len(rejects) >= self.batch_size:
+                    self.write_batch(batch, rejects, number + 1)
+                    batch, rejects = [], []
+                    self.report(started, imported_before)
+            self.write_batch(batch, rejects, None)
+        finally:
+            if self.rejects_file is not None:
+                self.rejects_file.close()
+
+        if self.defer_indexes:
+            print("Rebuilding indexes...", file=self.out)
+            self.rebuild_indexes()
+        self.report(started, imported_before, final=True)
+
+    def resolve(self, batch, rejects):
+        # Map external patient and doctor references to integer keys
+        if self.entity != 'appointments':
+            return batch
+        wanted = {'patients': set(), 'doctors': set()}
+        for number, record, row in batch:
+            wanted['patients'].add(row[0])
+            wanted['doctors'].add(row[1])
+        resolved = {}
+        cursor = self.conn.cursor()
+        for entity, refs in wanted.items():
+            refs = list(refs)
+            found = {}
+            for start in range(0, len(refs), 500):
+                chunk = refs[start:start + 500]
+                marks = ', '.join('?' for _ in chunk)
+                cursor.execute(f'''
+                SELECT external_id, internal_id FROM import_id_map
+                WHERE source = ? AND entity = ? AND external_id IN ({marks})
+                ''', [self.source, entity] + chunk)
+                found.update(cursor.fetchall())
+                # References may also be public IDs already in this database
+                uids = {}
+                for ref in chunk:
+                    try:
+                        uids[parse_uid(ref)] = ref
+                    except ValueError:
+                        pass
+                if uids:
+                    key_column = self.ENTITIES[entity][1]
+                    cursor.execute(f'''
+                    SELECT uid, {key_column} FROM {entity}
+                    WHERE uid IN ({', '.join('?' for _ in uids)})
+                    ''', list(uids))
+                    for uid, key in cursor.fetchall():
+                        found.setdefault(uids[uid], key)
+            resolved[entity] = found
+
+        kept = []
+        for number, record, row in batch:
+            patient_id = resolved['patients'].get(row[0])
+            doctor_id = resolved['doctors'].get(row[1])
+            if patient_id is None:
+                rejects.append((number, record, f"unknown patient {row[0]!r}"))
+            elif doctor_id is None:
+                rejects.append((number, record, f"unknown doctor {row[1]!r}"))
+            else:
+                kept.append((number, record, (patient_id, doctor_id) + row[2:]))
+        return kept
+
+    def write_batch(self, batch, rejects, records_done):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            batch = self.resolve(batch, rejects)
+            # Keys are handed out here, under the write lock, so the import
+            # map can record them without reading the rows back
+            first_key = self.conn.execute(f'''
+            SELECT COALESCE(MAX({self.key_column}), 0) + 1 FROM {self.table}''').fetchone()[0]
+            rows, mappings = [], []
+            for key, (number, record, row) in enumerate(batch, start=first_key):
+                rows.append((key, new_uid()) + row)
+                external_id = import_field(record, 'external_id') or import_field(record, 'id')
+                if external_id is not None:
+                    mappings.append((self.source, self.entity, external_id, key))
+            marks = ', '.join('?' for _ in range(len(self.columns) + 2))
+            self.conn.executemany(f'''
+            INSERT INTO {self.table} ({self.key_column}, uid, {', '.join(self.columns)})
+            VALUES ({marks})''', rows)
+            self.conn.executemany('''
+            INSERT OR REPLACE INTO import_id_map (source, entity, external_id, internal_id)
+            VALUES (?, ?, ?, ?)''', mappings)
+
+            if records_done is None:
+                self.records_done += len(batch) + len(rejects)
+            else:
+                self.records_done = records_done
+            self.rows_imported += len(rows)
+            self.rows_rejected += len(rejects)
+            self.conn.execute('''
+            INSERT OR REPLACE INTO import_checkpoints
+            (source, entity, path, records_done, rows_imported, rows_rejected,
+             indexes_deferred, completed, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (self.source, self.entity, self.path, self.records_done,
+                  self.rows_imported, self.rows_rejected, int(self.defer_indexes),
+                  int(records_done is None), datetime.now().isoformat(timespec='seconds')))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        if rejects and self.rejects_file is None:
+            self.rejects_file = open(self.rejects_path, 'a', encoding='utf-8')
+        for number, record, error in rejects:
+            self.rejects_file.write(json.dumps({'record': number, 'error': error, 'data': record}) + '\n')
+        if rejects:
+            self.rejects_file.flush()
+
+    def drop_indexes(self):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT type, name FROM sqlite_master
+        WHERE tbl_name = ? AND ((type = 'index' AND name LIKE 'idx_%')
+                                OR (type = 'trigger' AND (name LIKE '%_fts_%'
+                                                          OR name LIKE '%_summary_%')))
+        ''', (self.table,))
+        for kind, name in cursor.fetchall():
+            self.conn.execute(f'DROP {kind.upper()} {name}')
+        self.conn.commit()
+
+    def rebuild_indexes(self):
+        # Re-running the migrations recreates whatever drop_indexes removed,
+        # and recounts the summaries the dropped triggers did not update
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = self.conn.cursor()
+            migrate_access_path_indexes(cursor)
+            migrate_search_index(cursor)
+            migrate_scheduling(cursor)
+            migrate_appointment_times(cursor)
+            migrate_summaries(cursor)
+            migrate_date_indexes(cursor)
+            migrate_patient_blocks(cursor)
+            migrate_name_indexes(cursor)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        # That recount only saw this database; archived rows count too
+        if self.conn.execute('SELECT 1 FROM archives LIMIT 1').fetchone():
+            rebuild_summaries(self.conn)
+
+    def report(self, started, imported_before, final=False):
+        elapsed = time.perf_counter() - started
+        rate = (self.rows_imported - imported_before) / elapsed if elapsed else 0
+        prefix = "Imported" if final else "..."
+        print(f"{prefix} {self.rows_imported:,} rows, {self.rows_rejected:,} rejected, "
+              f"{rate:,.0f} rows/s", file=self.out)
+        if final and self.rows_rejected:
+            print(f"Rejected rows written to {self.rejects_path}", file=self.out)
+
+class Exporter:
+    # Streams query results to CSV, JSONL or a zip of CSVs in fetchmany
+    # chunks, so memory use does not depend on how much history is exported.
+    # All datasets are read inside one transaction for a consistent snapshot.
+    # SQLite attaches at most 10 files to a connection
+    MAX_ARCHIVES = 10
+
+    def __init__(self, conn, chunk_size=1000):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.archives = []
+
+    def attach_archives(self, patient_id=None, date_from=None, date_to=None):
+        # Attaches the yearly archives that can hold rows for these filters
+        # and returns their schemas for datasets(). They are detached when
+        # the export finishes.
+        sql = 'SELECT a.year, a.file FROM archives a WHERE a.year BETWEEN ? AND ?'
+        params = [int(date_from[:4]) if date_from and date_from[:4].isdigit() else 0,
+                  int(date_to[:4]) if date_to and date_to[:4].isdigit() else 9999]
+        if patient_id:
+            sql += ''' AND a.year IN (
+                SELECT year FROM archive_contents
+                WHERE patient_id = (SELECT patient_id FROM patients WHERE uid = ?))'''
+            params.append(parse_uid(patient_id, 'patient'))
+        years = self.conn.execute(sql + ' ORDER BY a.year', params).fetchall()
+        if len(years) > self.MAX_ARCHIVES:
+            raise ValueError(f"The export covers {len(years)} archived years; export at most "
+                             f"{self.MAX_ARCHIVES} at a time with --from/--to")
+        for year, file in years:
+            self.archives.append(attach_archive(self.conn, year, file))
+        return list(self.archives)
+
+    @staticmethod
+    def datasets(patient_id=None, doctor_id=None, date_from=None, date_to=None, archives=()):
+        conditions, params = [], []
+        appointment_conditions, appointment_params = [], []
+        if patient_id:
+            conditions.append('m.patient_id = (SELECT patient_id FROM patients WHERE uid = ?)')
+            params.append(parse_uid(patient_id, 'patient'))
+        if doctor_id:
+            conditions.append('m.doctor_id = (SELECT doctor_id FROM doctors WHERE uid = ?)')
+            params.append(parse_uid(doctor_id, 'doctor'))
+            appointment_conditions.append(conditions[-1].replace('m.', 'a.'))
+            appointment_params.append(params[-1])
+        # Appointments are filtered on their start timestamp
+        try:
+            if date_from:
+                conditions.append('m.date >= ?')
+                params.append(date_from)
+                appointment_conditions.append('a.starts_at >= ?')
+                appointment_params.append(timestamp_of(datetime.strptime(date_from, '%Y-%m-%d')))
+            if date_to:
+                conditions.append('m.date <= ?')
+                params.append(date_to)
+                appointment_conditions.append('a.starts_at < ?')
+                appointment_params.append(timestamp_of(datetime.strptime(date_to, '%Y-%m-%d')
+                                                       + timedelta(days=1)))
+        except ValueError:
+            raise ValueError("Enter dates as YYYY-MM-DD")
+        where = ' AND '.join(conditions) or '1'
+        # Bills use the same filters under their own alias. Rows are
+        # exported with their public IDs rather than integer keys.
+        bill_where = where.replace('m.', 'b.')
+        appointment_where = ' AND '.join(appointment_conditions) or '1'
+
+        # (name, archived table and its alias, query over {schema}, order
+        # within one file, order across files, parameters)
+        datasets = [
+            ('medical_records', 'medical_records m', f'''
+            SELECT uid_text(m.uid) AS record_id, uid_text(p.uid) AS patient_id,
+                   p.name AS patient, uid_text(d.uid) AS doctor_id, d.name AS doctor,
+                   m.date, m.diagnosis, m.treatment, m.notes
+            FROM {{schema}}.medical_records m
+            LEFT JOIN patients p ON p.patient_id = m.patient_id
+            LEFT JOIN doctors d ON d.doctor_id = m.doctor_id
+            WHERE {where}''', 'm.date', 'date', params),
+            ('prescriptions', 'medical_records m', f'''
+            SELECT uid_text(pr.uid) AS prescription_id, uid_text(m.uid) AS record_id,
+                   m.date, pr.medicine_name, pr.dosage, pr.frequency, pr.duration
+            FROM {{schema}}.medical_records m
+            JOIN {{schema}}.prescriptions pr ON pr.record_id = m.record_id
+            WHERE {where}''', 'm.date', 'date', params),
+        ]
+        if not doctor_id:
+            datasets.append(('bills', 'bills b', f'''
+            SELECT uid_text(b.uid) AS bill_id, uid_text(p.uid) AS patient_id,
+                   b.date, b.description, b.amount, b.status
+            FROM {{schema}}.bills b LEFT JOIN patients p ON p.patient_id = b.patient_id
+            WHERE {bill_where}''', 'b.date', 'date', params))
+        if not patient_id:
+            datasets.append(('appointments', 'appointments a', f'''
+            SELECT uid_text(a.uid) AS appointment_id, uid_text(p.uid) AS patient_id,
+                   p.name AS patient, uid_text(d.uid) AS doctor_id, d.name AS doctor,
+                   {APPOINTMENT_DATE} AS date, {APPOINTMENT_TIME} AS time,
+                   a.duration, a.status
+            FROM {{schema}}.appointments a
+            LEFT JOIN patients p ON p.patient_id = a.patient_id
+            LEFT JOIN doctors d ON d.doctor_id = a.doctor_id
+            WHERE {appointment_where}''', 'a.starts_at', 'date, time', appointment_params))
+
+        result = []
+        for name, source, sql, order, merged_order, dataset_params in datasets:
+            if not archives:
+                result.append((name, f"{sql.replace('{schema}', 'main')} ORDER BY {order}",
+                               dataset_params))
+                continue
+            # Archived rows follow from each year's file. A row caught
+            # mid-archive is in both; the working copy is exported.
+            table, alias = source.split()
+            parts = [sql.replace('{schema}', 'main')] + [
+                f'''{sql.replace('{schema}', schema)}
+                AND NOT EXISTS (SELECT 1 FROM main.{table} WHERE rowid = {alias}.rowid)'''
+                for schema in archives]
+            result.append((name, f"SELECT * FROM ({' UNION ALL '.join(parts)}) "
+                                 f"ORDER BY {merged_order}",
+                           list(dataset_params) * len(parts)))
+        return result
+
+    @staticmethod
+    def format_for(path):
+        if path.endswith('.zip'):
+            return 'zip'
+        if path.endswith(('.jsonl', '.jsonl.gz')):
+            return 'jsonl'
+        return 'csv'
+
+    def rows(self, sql, params):
+        cursor = self.conn.cursor()
+        cursor.execute(sql, params)
+        columns = [c[0] for c in cursor.description]
+        yield columns
+        while True:
+            chunk = cursor.fetchmany(self.chunk_size)
+            if not chunk:
+                break
+            yield from chunk
+
+    def export(self, datasets, path, file_format=None, tables=None):
+        file_format = file_format or self.format_for(path)
+        if tables:
+            datasets = [d for d in datasets if d[0] in tables]
+        started = time.perf_counter()
+        total = 0
+        # Archives are attached before the snapshot starts, as SQLite requires
+        self.conn.execute('BEGIN')
+        try:
+            if file_format == 'jsonl':
+                opener = gzip.open if path.endswith('.gz') else open
+                with opener(path, 'wt', encoding='utf-8', newline='') as f:
+                    for name, sql, params in datasets:
+                        total += self.write_jsonl(f, name, self.rows(sql, params))
+            elif file_format == 'zip':
+                with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                    for name, sql, params in datasets:
+                        with archive.open(f'{name}.csv', 'w') as raw:
+                            with io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+                                total += self.write_csv(f, self.rows(sql, params))
+            else:
+                os.makedirs(path, exist_ok=True)
+                for name, sql, params in datasets:
+                    with open(os.path.join(path, f'{name}.csv'), 'w',
+                              encoding='utf-8', newline='') as f:
+                        total += self.write_csv(f, self.rows(sql, params))
+        finally:
+            self.conn.rollback()
+            while self.archives:
+                self.conn.execute(f'DETACH DATABASE {self.archives.pop()}')
+        elapsed = time.perf_counter() - started
+        return total, elapsed
+
+    @staticmethod
+    def write_csv(f, rows):
+        writer = csv.writer(f)
+        writer.writerow(next(rows))
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        return count
+
+    @staticmethod
+    def write_jsonl(f, name, rows):
+        columns = next(rows)
+        count = 0
+        for row in rows:
+            record = dict(zip(columns, row))
+            record['table'] = name
+            f.write(json.dumps(record) + '\n')
+            count += 1
+        return count
+
+# Scores above this are shown as possible duplicates
+DUPLICATE_SCORE = 0.75
+
+def text_similarity(a, b):
+    # 0.5 when either is unknown, so a missing field neither helps nor hurts
+    if not a or not b:
+        return 0.5
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+def duplicate_score(a, b):
+    # a and b are (name, birth_year, gender, phone_key, address). The name
+    # counts most, compared word by word in any order; a shared phone
+    # number next. Ages are rounded at registration, so birth years a year
+    # apart still count for most.
+    name = text_similarity(' '.join(sorted(name_words(a[0]))), ' '.join(sorted(name_words(b[0]))))
+    if a[1] is None or b[1] is None:
+        born = 0.5
+    else:
+        born = max(0, 1 - abs(a[1] - b[1]) / (BIRTH_YEAR_BAND + 2))
+    gender = 0.5 if not a[2] or not b[2] else float(a[2] == b[2])
+    phone = 0.5 if not a[3] or not b[3] else float(a[3] == b[3])
+    address = text_similarity(' '.join(name_words(a[4])), ' '.join(name_words(b[4])))
+    return 0.45 * name + 0.25 * phone + 0.15 * born + 0.05 * gender + 0.1 * address
+
+class DuplicateFinder:
+    # Finds patients registered more than once by comparing each patient
+    # only with the others in its blocks (see patient_keys), and merges
+    # them. Blocks larger than max_block, such as a placeholder phone
+    # number shared by hundreds of patients, are skipped.
+    COLUMNS = 'patient_id, name, birth_year, gender, phone_key, address'
+    MERGED_TABLES = ('appointments', 'medical_records', 'bills')
+    FILLED_COLUMNS = ('age', 'birth_year', 'gender', 'phone', 'address', 'blood_group')
+
+    def __init__(self, conn, threshold=DUPLICATE_SCORE, max_block=500):
+        self.conn = conn
+        self.threshold = threshold
+        self.max_block = max_block
+
+    def matches(self, name, age, gender, phone, address, limit=10):
+        # Registered patients that look like this new one, best first
+        keys = patient_keys(name, age, phone)
+        new = (name, keys[2], gender, keys[0], address)
+        rows = self.conn.execute(DUPLICATE_CANDIDATES, {
+            'phone': keys[0], 'name': keys[1], 'year': keys[2], 'band': BIRTH_YEAR_BAND,
+            'block': self.max_block}).fetchall()
+        scored = sorted(((duplicate_score(new, row[1:]), row[0]) for row in rows), reverse=True)
+        scored = [(score, patient_id) for score, patient_id in scored[:limit]
+                  if score >= self.threshold]
+        if not scored:
+            return []
+        details = self.details([patient_id for score, patient_id in scored])
+        return [(round(score, 2),) + details[patient_id] for score, patient_id in scored]
+
+    def details(self, patient_ids):
+        marks = ', '.join('?' for _ in patient_ids)
+        return {row[0]: row[1:] for row in self.conn.execute(f'''
+        SELECT patient_id, uid_text(uid), name, age, gender, phone, address
+        FROM patients WHERE patient_id IN ({marks})''', patient_ids)}
+
+    def blocks(self, key, order):
+        # Members of every block with more than one patient, block by block
+        rows = self.conn.execute(f'''
+        SELECT {key}, {self.COLUMNS} FROM patients
+        WHERE {key} IN (SELECT {key} FROM patients WHERE {key} IS NOT NULL
+                        GROUP BY {key} HAVING count(*) BETWEEN 2 AND ?)
+        ORDER BY {key}, {order}''', (self.max_block,))
+        for value, members in itertools.groupby(rows, key=lambda row: row[0]):
+            yield [row[1:] for row in members]
+
+    def clusters(self):
+        # Groups of two or more patients joined by pairs that score above
+        # the threshold, oldest registration first. Returns the clusters
+        # and the number of pairs compared.
+        parent = {}
+
+        def root(patient_id):
+            while parent.get(patient_id, patient_id) != patient_id:
+                patient_id = parent[patient_id]
+            return patient_id
+
+        def compare(a, b):
+            if duplicate_score(a[1:], b[1:]) >= self.threshold:
+                a_root, b_root = root(a[0]), root(b[0])
+                parent[max(a_root, b_root)] = min(a_root, b_root)
+
+        compared = set()
+        for members in self.blocks('phone_key', 'patient_id'):
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    compared.add((a[0], b[0]))
+                    compare(a, b)
+        for members in self.blocks('name_key', 'birth_year, patient_id'):
+            # Sorted by birth year, so each patient is compared with those
+            # that follow it until they are too much younger. Unknown years
+            # sort first and are compared with everyone.
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    if a[2] is not None and b[2] - a[2] > BIRTH_YEAR_BAND:
+                        break
+                    pair = (min(a[0], b[0]), max(a[0], b[0]))
+                    if pair in compared:
+                        continue
+                    compared.add(pair)
+                    compare(a, b)
+
+        clusters = {}
+        for patient_id in parent:
+            clusters.setdefault(root(patient_id), set()).add(patient_id)
+        result = []
+        for first, members in sorted(clusters.items()):
+            members = sorted(members | {first})
+            details = self.details(members)
+            result.append([details[patient_id] for patient_id in members])
+        return result, len(compared)
+
+    def merge(self, survivor, duplicates):
+        # Moves the duplicates' appointments, records and bills, archived
+        # ones included, to the survivor, fills the survivor's empty fields
+        # from them and deletes them. Archive files are updated first, each
+        # in its own transaction: if the merge is interrupted, running it
+        # again finishes it.
+        survivor = lookup_key(self.conn, 'patient', survivor)
+        duplicates = sorted({lookup_key(self.conn, 'patient', uid) for uid in duplicates})
+        if not duplicates or survivor in duplicates:
+            raise ValueError("Give the patient to keep and at least one other to merge into it")
+        marks = ', '.join('?' for _ in duplicates)
+        self.conn.commit()
+        moved = dict.fromkeys(self.MERGED_TABLES, 0)
+
+        # Archived rows have no patients in their file to check against
+        self.conn.execute('PRAGMA foreign_keys=OFF')
+        try:
+            for year, file in self.conn.execute(f'''
+            SELECT DISTINCT c.year, a.file FROM archive_contents c JOIN archives a USING (year)
+            WHERE c.patient_id IN ({marks})''', duplicates).fetchall():
+                schema = attach_archive(self.conn, year, file, readonly=False)
+                try:
+                    self.conn.execute('BEGIN IMMEDIATE')
+                    for table, year_sql, older, closed in ARCHIVE_TABLES:
+                        moved[table] += self.conn.execute(f'''
+                        UPDATE {schema}.{table} SET patient_id = ?
+                        WHERE patient_id IN ({marks})''', [survivor] + duplicates).rowcount
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                finally:
+                    self.conn.execute(f'DETACH DATABASE {schema}')
+        finally:
+            self.conn.execute('PRAGMA foreign_keys=ON')
+
+        # The summary triggers move pending bills between patient balances
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = self.conn.cursor()
+            for table in self.MERGED_TABLES:
+                cursor.execute(f'UPDATE {table} SET patient_id = ? WHERE patient_id IN ({marks})',
+                               [survivor] + duplicates)
+                moved[table] += cursor.rowcount
+            cursor.execute(f'''
+            INSERT INTO archive_contents (table_name, patient_id, year, rows)
+            SELECT table_name, ?, year, sum(rows) FROM archive_contents
+            WHERE patient_id IN ({marks}) GROUP BY table_name, year
+            ON CONFLICT (table_name, patient_id, year) DO UPDATE SET rows = rows + excluded.rows
+            ''', [survivor] + duplicates)
+            cursor.execute(f'DELETE FROM archive_contents WHERE patient_id IN ({marks})', duplicates)
+            # Later imports that refer to a duplicate find the survivor
+            cursor.execute(f'''
+            UPDATE import_id_map SET internal_id = ?
+            WHERE entity = 'patients' AND internal_id IN ({marks})''', [survivor] + duplicates)
+            # The newest registration that has a field wins
+            for column in self.FILLED_COLUMNS:
+                cursor.execute(f'''
+                UPDATE patients SET {column} = (
+                    SELECT {column} FROM patients WHERE patient_id IN ({marks})
+                    AND nullif({column}, '') IS NOT NULL ORDER BY patient_id DESC LIMIT 1)
+                WHERE patient_id = ? AND nullif({column}, '') IS NULL
+                AND EXISTS (SELECT 1 FROM patients WHERE patient_id IN ({marks})
+                            AND nullif({column}, '') IS NOT NULL)''',
+                               duplicates + [survivor] + duplicates)
+            cursor.execute('''
+            UPDATE patients SET phone_key = ? WHERE patient_id = ?''',
+                           (phone_key(cursor.execute('SELECT phone FROM patients WHERE patient_id = ?',
+                                                     (survivor,)).fetchone()[0]), survivor))
+            cursor.execute(f'DELETE FROM patients WHERE patient_id IN ({marks})', duplicates)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return moved
+
+class Archiver:
+    # Moves closed rows older than a cutoff into yearly archive files a
+    # batch at a time, so the app can keep working while it runs. A batch is
+    # first copied to its archive, then deleted here in a second
+    # transaction. A crash in between leaves a second copy, which the next
+    # run replaces; a row is never in neither place.
+    MAX_ATTACHED = 8
+
+    def __init__(self, conn, before, batch_size=500, out=sys.stderr):
+        try:
+            cutoff = datetime.strptime(before, '%Y-%m-%d')
+        except ValueError:
+            raise ValueError("Enter the cutoff date as YYYY-MM-DD")
+        self.conn = conn
+        self.params = {'cutoff': before, 'cutoff_ts': timestamp_of(cutoff)}
+        self.batch_size = batch_size
+        self.out = out
+        self.attached = OrderedDict()
+        # Archived rows still refer to patients and doctors in this file,
+        # which SQLite cannot check across files. Prescriptions are deleted
+        # before their records.
+        conn.execute('PRAGMA foreign_keys=OFF')
+        # Python calls the statement trace once per trigger statement, about
+        # ten per archived row; the timings are only wanted for the app
+        conn.set_trace_callback(None)
+
+    def run(self):
+        started = time.perf_counter()
+        moved = {}
+        try:
+            for table, year_sql, older, closed in ARCHIVE_TABLES:
+                moved[table] = 0
+                last = 0
+                while True:
+                    # Walks the table once in rowid order. The newest row
+                    # stays, so new rows are numbered after archived ones.
+                    rows = self.conn.execute(f'''
+                    SELECT rowid, {year_sql} FROM {table} NOT INDEXED
+                    WHERE rowid > :last AND rowid < (SELECT max(rowid) FROM {table})
+                    AND {older} AND {closed} AND {year_sql} BETWEEN 1000 AND 9999
+                    ORDER BY rowid LIMIT :batch''',
+                        dict(self.params, last=last, batch=self.batch_size)).fetchall()
+                    if not rows:
+                        break
+                    last = rows[-1][0]
+                    years = {}
+                    for rowid, year in rows:
+                        years.setdefault(year, []).append(rowid)
+                    for year, ids in sorted(years.items()):
+                        moved[table] += self.move(table, year, ids)
+                    print(f"{table}: {moved[table]:,} rows archived", file=self.out)
+        finally:
+            while self.attached:
+                year, (schema, file) = self.attached.popitem()
+                self.conn.execute(f'DETACH DATABASE {schema}')
+        return moved, time.perf_counter() - started
+
+    def archive(self, year):
+        # Attaches the year's archive for writing, creating its tables and
+        # indexes like this database's on first use
+        if year in self.attached:
+            self.attached.move_to_end(year)
+            return self.attached[year]
+        while len(self.attached) >= self.MAX_ATTACHED:
+            old_year, (schema, file) = self.attached.popitem(last=False)
+            self.conn.execute(f'DETACH DATABASE {schema}')
+        row = self.conn.execute('SELECT file FROM archives WHERE year = ?', (year,)).fetchone()
+        file = row[0] if row else archive_file(self.conn, year)
+        schema = attach_archive(self.conn, year, file, readonly=False)
+        tables = [table for table, year_sql, older, closed in ARCHIVE_TABLES] + ['prescriptions']
+        for table in tables:
+            for (sql,) in self.conn.execute('''
+            SELECT sql FROM main.sqlite_master
+            WHERE tbl_name = ? AND type IN ('table', 'index') AND sql IS NOT NULL
+            ORDER BY type DESC''', (table,)).fetchall():
+                self.conn.execute(re.sub(r'^CREATE (TABLE|UNIQUE INDEX|INDEX) ',
+                                         rf'CREATE \1 IF NOT EXISTS {schema}.', sql))
+        self.conn.commit()
+        self.attached[year] = (schema, file)
+        return self.attached[year]
+
+    def move(self, table, year, ids):
+        schema, file = self.archive(year)
+        marks = ', '.join('?' for _ in ids)
+        copies = [(table, 'rowid')]
+        if table == 'medical_records':
+            copies.append(('prescriptions', 'record_id'))
+
+        # Copy; only the archive is written
+        self.conn.execute('BEGIN')
+        try:
+            for name, key in copies:
+                self.conn.execute(f'''
+                INSERT OR REPLACE INTO {schema}.{name}
+                SELECT * FROM main.{name} WHERE {key} IN ({marks})''', ids)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        # Delete the rows whose copy is still identical, and record where
+        # they went. The delete triggers take the rows out of the report
+        # summaries; they are added back from the archive, since archived
+        # rows still count.
+        columns = [row[1] for row in self.conn.execute(f'PRAGMA main.table_info({table})')]
+        same = ' AND '.join(f'h.{column} IS a.{column}' for column in columns)
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = self.conn.cursor()
+            moved = [rowid for (rowid,) in cursor.execute(f'''
+            SELECT h.rowid FROM main.{table} h JOIN {schema}.{table} a ON a.rowid = h.rowid
+            WHERE h.rowid IN ({marks}) AND {same}''', ids).fetchall()]
+            if moved:
+                moved_marks = ', '.join('?' for _ in moved)
+                cursor.execute('INSERT OR IGNORE INTO archives (year, file) VALUES (?, ?)',
+                               (year, file))
+                cursor.execute(f'''
+                INSERT INTO archive_contents (table_name, patient_id, year, rows)
+                SELECT ?, patient_id, ?, count(*) FROM {schema}.{table}
+                WHERE rowid IN ({moved_marks}) AND patient_id IS NOT NULL GROUP BY patient_id
+                ON CONFLICT (table_name, patient_id, year) DO UPDATE SET rows = rows + excluded.rows
+                ''', [table, year] + moved)
+                for name, key in reversed(copies):
+                    cursor.execute(f'DELETE FROM main.{name} WHERE {key} IN ({moved_marks})', moved)
+                for summary, source, changed, keys, counters, condition in SUMMARY_SOURCES:
+                    if source == table:
+                        cursor.execute(summary_upsert(
+                            summary, keys, counters, f'({condition}) AND {{row}}.rowid IN ({moved_marks})',
+                            's', source=f'{schema}.{table}'), moved)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        # Rows edited after they were copied, e.g. a bill set back to
+        # Pending, stay here; drop their stale copies
+        if len(moved) < len(ids):
+            self.conn.execute('BEGIN')
+            try:
+                for name, key in copies:
+                    self.conn.execute(f'''
+                    DELETE FROM {schema}.{name}
+                    WHERE {key} IN ({marks}) AND {key} IN (SELECT rowid FROM main.{table})''', ids)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return len(moved)
+
+class BackupSet:
+    # A directory of point-in-time snapshots of the live database. Each
+    # starts as a stepped copy through SQLite's backup API, read from one
+    # WAL snapshot so writers carry on meanwhile, and is integrity-checked
+    # before it is kept. The first snapshot of a chain is stored whole,
+    # later ones only as the pages that changed since the one before.
+    # latest.db is a copy of the newest snapshot to compare against.
+    MANIFEST = 'manifest.json'
+    LATEST = 'latest.db'
+
+    def __init__(self, directory, out=sys.stderr):
+        self.directory = directory
+        self.out = out
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def snapshots(self):
+        try:
+            with open(self.path(self.MANIFEST), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def save(self, snapshots):
+        with open(self.path(self.MANIFEST + '.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(snapshots, f, indent=2)
+        os.replace(self.path(self.MANIFEST + '.tmp'), self.path(self.MANIFEST))
+
+    def snapshot(self, manager, pages=1024, sleep_ms=5, full_every=24):
+        snapshots = self.snapshots()
+        created = datetime.now()
+        name = base = created.strftime('snapshot-%Y%m%d-%H%M%S')
+        number = 1
+        while any(s['name'] == name for s in snapshots):
+            number += 1
+            name = f'{base}-{number}'
+        staging = self.path('staging.db')
+        if os.path.exists(staging):
+            os.remove(staging)
+        stats = self.copy_live(manager, staging, pages, sleep_ms)
+        self.verify(staging)
+
+        # A new chain starts with a full copy; the rest store changed pages
+        parent = snapshots[-1] if snapshots and os.path.exists(self.path(self.LATEST)) else None
+        chain = 0
+        if parent is not None:
+            chain = parent['chain'] + 1
+            if chain >= full_every:
+                parent, chain = None, 0
+        page_size = stats['page_size']
+        if parent is None:
+            file = name + '.db'
+            shutil.copyfile(staging, self.path(file))
+            changed = stats['pages']
+        else:
+            file = name + '.delta.gz'
+            changed = self.write_delta(self.path(self.LATEST), staging, self.path(file), page_size)
+        os.replace(staging, self.path(self.LATEST))
+
+        snapshot = {
+            'name': name, 'file': file, 'parent': parent and parent['name'], 'chain': chain,
+            'created': created.isoformat(timespec='seconds'), 'page_size': page_size,
+            'pages': stats['pages'], 'changed_pages': changed,
+            'bytes': os.path.getsize(self.path(file)), 'sha256': self.digest(self.path(self.LATEST)),
+        }
+        self.save(snapshots + [snapshot])
+        return dict(stats, name=name, full=parent is None, changed_pages=changed,
+                    bytes=snapshot['bytes'])
+
+    def copy_live(self, manager, path, pages, sleep_ms):
+        # Copies `pages` pages per step, sleeping between steps. The copy
+        # reads one WAL snapshot throughout, so writers are never locked
+        # out and it never restarts; meanwhile the WAL cannot be
+        # checkpointed past it and grows instead. A probe takes the write
+        # lock every 50 ms to measure how long the app's writes waited.
+        source = manager.connect(readonly=True)
+        target = sqlite3.connect(path)
+        waits = []
+        wal_bytes = []
+        stop = threading.Event()
+
+        def probe():
+            conn = manager.connect()
+            try:
+                while not stop.wait(0.05):
+                    started = time.perf_counter()
+                    conn.execute('BEGIN IMMEDIATE')
+                    waits.append((time.perf_counter() - started) * 1000)
+                    conn.rollback()
+                    try:
+                        wal_bytes.append(os.path.getsize(manager.path + '-wal'))
+                    except OSError:
+                        pass
+            finally:
+                conn.close()
+
+        def progress(status, remaining, total):
+            if remaining and sleep_ms:
+                time.sleep(sleep_ms / 1000)
+
+        prober = threading.Thread(target=probe, daemon=True)
+        prober.start()
+        started = time.perf_counter()
+        try:
+            source.execute('BEGIN')
+            source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+            page_size = source.execute('PRAGMA page_size').fetchone()[0]
+            source.backup(target, pages=pages, progress=progress)
+            source.rollback()
+        finally:
+            elapsed = time.perf_counter() - started
+            stop.set()
+            prober.join()
+            source.close()
+            target.close()
+        size = os.path.getsize(path)
+        return {
+            'page_size': page_size, 'pages': size // page_size, 'seconds': round(elapsed, 3),
+            'mb_per_s': round(size / 1e6 / elapsed, 1) if elapsed else None,
+            'max_write_wait_ms': round(max(waits), 1) if waits else 0.0,
+            'write_probes': len(waits),
+            'max_wal_mb': round(max(wal_bytes) / 1e6, 1) if wal_bytes else 0.0,
+        }
+
+    @staticmethod
+    def verify(path):
+        conn = sqlite3.connect(path)
+        try:
+            problems = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        finally:
+            conn.close()
+        if problems != ['ok']:
+            raise ValueError(f"{path} failed its integrity check: {'; '.join(problems[:5])}")
+
+    @staticmethod
+    def digest(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def write_delta(old_path, new_path, path, page_size):
+        # Page number and contents of every page that differs
+        changed = 0
+        with open(old_path, 'rb') as old, open(new_path, 'rb') as new, \
+                gzip.open(path, 'wb') as out:
+            number = 0
+            for page in iter(lambda: new.read(page_size), b''):
+                number += 1
+                if old.read(page_size) != page:
+                    out.write(struct.pack('>I', number))
+                    out.write(page)
+                    changed += 1
+        return changed
+
+    def rebuild(self, name, path):
+        # Writes the database as it was at snapshot `name`: its chain's
+        # full copy with each delta applied in turn, checked against the
+        # digest taken when it was made
+        snapshots = {s['name']: s for s in self.snapshots()}
+        if name not in snapshots:
+            raise ValueError(f"No snapshot named {name}")
+        chain = [snapshots[name]]
+        while chain[-1]['parent'] is not None:
+            chain.append(snapshots[chain[-1]['parent']])
+        chain.reverse()
+        shutil.copyfile(self.path(chain[0]['file']), path)
+        with open(path, 'r+b') as f:
+            for delta in chain[1:]:
+                page_size = delta['page_size']
+                with gzip.open(self.path(delta['file']), 'rb') as changes:
+                    for header in iter(lambda: changes.read(4), b''):
+                        f.seek((struct.unpack('>I', header)[0] - 1) * page_size)
+                        f.write(changes.read(page_size))
+                f.truncate(delta['pages'] * page_size)
+        if self.digest(path) != snapshots[name]['sha256']:
+            raise ValueError(f"Snapshot {name} does not match the copy it was made from")
+        self.verify(path)
+
+    def restore(self, manager, name=None):
+        # Copies a snapshot over the live database through the backup API,
+        # so the app's connections see the change like any other commit.
+        # Writers wait while the pages go in.
+        snapshots = self.snapshots()
+        if not snapshots:
+            raise ValueError(f"There are no snapshots in {self.directory}")
+        name = name or snapshots[-1]['name']
+        staging = self.path('restore.db')
+        self.rebuild(name, staging)
+        source = sqlite3.connect(staging)
+        live = manager.connect()
+        started = time.perf_counter()
+        try:
+            source.backup(live)
+            migrate(live)
+            # Change feed positions are from the snapshot; open apps rejoin
+            # and reload their views when they next check in
+            live.execute('DELETE FROM change_subscribers')
+            live.commit()
+        finally:
+            source.close()
+            live.close()
+            os.remove(staging)
+        return name, time.perf_counter() - started
+
+    def rotate(self, keep):
+        # Keeps the newest `keep` snapshots and whatever their deltas need
+        snapshots = self.snapshots()
+        by_name = {s['name']: s for s in snapshots}
+        needed = set()
+        for snapshot in snapshots[-keep:] if keep > 0 else []:
+            while snapshot is not None and snapshot['name'] not in needed:
+                needed.add(snapshot['name'])
+                snapshot = by_name.get(snapshot['parent'])
+        removed = [s for s in snapshots if s['name'] not in needed]
+        self.save([s for s in snapshots if s['name'] in needed])
+        for snapshot in removed:
+            os.remove(self.path(snapshot['file']))
+        return [s['name'] for s in removed]
+
+def analyze_partition(path, first, last, as_of):
+    # One [first, last) date range of the analytics report, read on its own
+    # read-only connection inside a single snapshot. Returns partial sums
+    # keyed by report row, which the parent adds together.
+    conn = ConnectionManager(path).connect(readonly=True)
+    try:
+        conn.execute('BEGIN')
+        cursor = conn.cursor()
+        start = timestamp_of(datetime.strptime(first, '%Y-%m-%d'))
+        end = timestamp_of(datetime.strptime(last, '%Y-%m-%d'))
+        partial = {name: {} for name in AnalyticsEngine.REPORTS}
+        
+        # Minutes booked against minutes in each doctor's working week
+        utilization = partial['doctor_utilization']
+        cursor.execute('''
+        SELECT doctor_id, sum(duration) FROM appointments
+        WHERE starts_at >= ? AND starts_at < ? AND status IS NOT 'Cancelled'
+        AND doctor_id IS NOT NULL GROUP BY doctor_id''', (start, end))
+        for doctor_id, minutes in cursor.fetchall():
+            utilization[(doctor_id,)] = [minutes, 0]
+        weekdays = [0] * 7
+        first_weekday = datetime.strptime(first, '%Y-%m-%d').weekday()
+        for offset in range((end - start) // 86400):
+            weekdays[(first_weekday + offset) % 7] += 1
+        cursor.execute('SELECT doctor_id, weekday, start_time, end_time FROM doctor_hours')
+        for doctor_id, weekday, start_time, end_time in cursor.fetchall():
+            minutes = (minutes_of(end_time) - minutes_of(start_time)) * weekdays[weekday]
+            utilization.setdefault((doctor_id,), [0, 0])[1] += minutes
+        
+        # Appointments that were due before as_of but never completed or
+        # cancelled count as no-shows
+        cursor.execute('''
+        SELECT strftime('%Y-%m', starts_at, 'unixepoch'), count(*),
+               sum(status = 'Completed'), sum(status = 'Cancelled'),
+               sum(starts_at < ? AND status IS NOT 'Cancelled'),
+               sum(starts_at < ? AND status = 'Scheduled')
+        FROM appointments WHERE starts_at >= ? AND starts_at < ? GROUP BY 1''',
+                       (as_of, as_of, start, end))
+        for month, *counts in cursor.fetchall():
+            partial['attendance_by_month'][(month,)] = counts
+        
+        cursor.execute('''
+        SELECT substr(date, 1, 7), coalesce(diagnosis, ''), count(*) FROM medical_records
+        WHERE date >= ? AND date < ? GROUP BY 1, 2''', (first, last))
+        for month, diagnosis, records in cursor.fetchall():
+            partial['diagnoses_by_month'][(month, diagnosis)] = [records]
         
-        cursor = self.db.conn.cursor()
+        # A bill belongs to the specialization of the patient's latest
+        # visit on or before its date
         cursor.execute('''
-        SELECT date, description, amount, status
-        FROM bills
-        WHERE patient_id = ?
-        ORDER BY date DESC
-        ''', (self.patient_id,))
-        
-        for row in cursor.fetchall():
-            self.bill_tree.insert('', 'end', values=row)
\ No newline at end of file
+        SELECT substr(b.date, 1, 4),
+               coalesce((SELECT d.specialization FROM medical_records m
+                         JOIN doctors d ON d.doctor_id = m.doctor_id
+                         WHERE m.patient_id = b.patient_id AND m.date <= b.date
+                         ORDER BY m.date DESC LIMIT 1), 'Unattributed'),
+               count(*), sum(CAST(round(coalesce(b.amount, 0) * 100) AS INTEGER))
+        FROM bills b WHERE b.date >= ? AND b.date < ? GROUP BY 1, 2''', (first, last))
+        for year, specialization, bills, cents in cursor.fetchall():
+            partial['bills_by_specialization'][(year, specialization)] = [bills, cents]
+        return partial
+    finally:
+        conn.close()
+
+class AnalyticsEngine:
+    # Utilization and census reports over the whole history. The range is
+    # split into month partitions that run in a process pool, each on its
+    # own read-only connection, so a report never takes a write lock and
+    # scales with the cores available. Only partial sums come back to be
+    # merged.
+    REPORTS = ('doctor_utilization', 'attendance_by_month', 'diagnoses_by_month',
+               'bills_by_specialization')
+
+    def __init__(self, path, workers=None, partition_months=1):
+        self.path = str(pathlib.Path(path).resolve())
+        self.workers = workers or os.cpu_count() or 1
+        self.partition_months = partition_months
+
+    def date_range(self, conn):
+        # First and last day with any appointment, record or bill. Each
+        # bound on its own is a single index lookup.
+        bounds = conn.execute('''
+        SELECT (SELECT min(date) FROM medical_records), (SELECT max(date) FROM medical_records),
+               (SELECT min(date) FROM bills), (SELECT max(date) FROM bills),
+               (SELECT date(min(starts_at), 'unixepoch') FROM appointments),
+               (SELECT date(max(starts_at), 'unixepoch') FROM appointments)''').fetchone()
+        firsts = [bound for bound in bounds[0::2] if bound]
+        lasts = [bound for bound in bounds[1::2] if bound]
+        return (min(firsts) if firsts else None, max(lasts) if lasts else None)
+
+    def partitions(self, date_from, date_to):
+        # [first, last) ranges of partition_months calendar months each,
+        # clipped to date_from and the day after date_to
+        first = datetime.strptime(date_from, '%Y-%m-%d')
+        end = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
+        ranges = []
+        while first < end:
+            index = first.year * 12 + first.month - 1 + self.partition_months
+            last = min(datetime(index // 12, index % 12 + 1, 1), end)
+            ranges.append((first.strftime('%Y-%m-%d'), last.strftime('%Y-%m-%d')))
+            first = last
+        return ranges
+
+    @staticmethod
+    def merge(partials):
+        totals = {name: {} for name in AnalyticsEngine.REPORTS}
+        for partial in partials:
+            for name, rows in partial.items():
+                for key, counts in rows.items():
+                    total = totals[name].setdefault(key, [0] * len(counts))
+                    for index, count in enumerate(counts):
+                        total[index] += count or 0
+        return totals
+
+    def run(self, date_from=None, date_to=None):
+        started = time.perf_counter()
+        conn = ConnectionManager(self.path).connect(readonly=True)
+        try:
+            earliest, latest = self.date_range(conn)
+            date_from = date_from or earliest
+            date_to = date_to or latest
+            try:
+                ranges = self.partitions(date_from, date_to) if date_from and date_to else []
+            except ValueError:
+                raise ValueError("Enter dates as YYYY-MM-DD")
+            as_of = timestamp_of(datetime.now())
+            jobs = [(self.path, first, last, as_of) for first, last in ranges]
+            if self.workers > 1 and len(jobs) > 1:
+                with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+                    partials = list(pool.map(analyze_partition, *zip(*jobs)))
+            else:
+                partials = [analyze_partition(*job) for job in jobs]
+            totals = self.merge(partials)
+            doctors = {row[0]: row[1:] for row in conn.execute(
+                'SELECT doctor_id, uid_text(uid), name, specialization FROM doctors')}
+        finally:
+            conn.close()
+        
+        report = {
+            'generated_at': datetime.now().isoformat(timespec='seconds'),
+            'from': date_from,
+            'to': date_to,
+            'partitions': len(jobs),
+            'workers': self.workers,
+            'doctor_utilization': [],
+            'attendance_by_month': [],
+            'diagnoses_by_month': [],
+            'bills_by_specialization': [],
+        }
+        for (doctor_id,), (booked, available) in sorted(totals['doctor_utilization'].items()):
+            uid, name, specialization = doctors.get(doctor_id, (None, None, None))
+            report['doctor_utilization'].append({
+                'doctor_id': uid, 'doctor': name, 'specialization': specialization,
+                'booked_minutes': booked, 'available_minutes': available,
+                'utilization': round(booked / available, 4) if available else None})
+        for (month,), (appointments, completed, cancelled, due, no_shows) in sorted(
+                totals['attendance_by_month'].items()):
+            report['attendance_by_month'].append({
+                'month': month, 'appointments': appointments, 'completed': completed,
+                'cancelled': cancelled, 'no_shows': no_shows,
+                'no_show_rate': round(no_shows / due, 4) if due else None})
+        for (month, diagnosis), (records,) in sorted(totals['diagnoses_by_month'].items()):
+            report['diagnoses_by_month'].append({
+                'month': month, 'diagnosis': diagnosis, 'records': records})
+        for (year, specialization), (bills, cents) in sorted(
+                totals['bills_by_specialization'].items()):
+            report['bills_by_specialization'].append({
+                'year': year, 'specialization': specialization, 'bills': bills,
+                'total': cents / 100, 'average': round(cents / bills / 100, 2)})
+        report['elapsed_s'] = round(time.perf_counter() - started, 3)
+        return report
+
+    @staticmethod
+    def write(report, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+def run_migrate(args):
+    conn = ConnectionManager.get().connect()
+    applied = migrate(conn)
+    for number, name in applied:
+        print(f"Applied migration {number}: {name}")
+    print(f"Schema version {schema_version(conn)}")
+
+def run_check_plans(args):
+    conn = ConnectionManager.get().writer
+    failures = 0
+    for name, plan, ok in check_query_plans(conn):
+        print(f"{'ok  ' if ok else 'SCAN'} {name}")
+        for step in plan:
+            print(f"       {step}")
+        failures += not ok
+    return 1 if failures else 0
+
+def run_rebuild_summaries(args):
+    conn = ConnectionManager.get().connect()
+    migrate(conn)
+    differences = rebuild_summaries(conn, check=args.check)
+    conn.close()
+    for summary, count in differences:
+        print(f"{summary}: {count:,} rows {'differ' if args.check else 'corrected'}")
+    if args.check and any(count for summary, count in differences):
+        return 1
+
+def run_analytics(args):
+    # Bring the schema up to date first; the report itself only reads
+    conn = ConnectionManager.get().connect()
+    migrate(conn)
+    conn.close()
+    engine = AnalyticsEngine(ConnectionManager.get().path, workers=args.workers,
+                             partition_months=args.partition_months)
+    try:
+        report = engine.run(args.date_from, args.date_to)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    engine.write(report, args.output)
+    print(f"Analysed {report['from']} to {report['to']} in {report['partitions']} partitions "
+          f"on {report['workers']} workers in {report['elapsed_s']:.1f}s; "
+          f"report written to {args.output}")
+
+def run_archive(args):
+    conn = ConnectionManager.get().connect()
+    migrate(conn)
+    try:
+        moved, elapsed = Archiver(conn, args.before, batch_size=args.batch_size).run()
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    print(f"Archived {sum(moved.values()):,} rows in {elapsed:.1f}s "
+          f"({', '.join(f'{table}: {count:,}' for table, count in moved.items())})")
+
+def run_duplicates(args):
+    conn = ConnectionManager.get().connect()
+    migrate(conn)
+    started = time.perf_counter()
+    clusters, compared = DuplicateFinder(conn, threshold=args.min_score).clusters()
+    conn.close()
+    for number, members in enumerate(clusters, start=1):
+        print(f"Cluster {number}:")
+        for patient_id, name, age, gender, phone, address in members:
+            print(f"  {patient_id}  {name}, {age or '-'}, {gender or '-'}, "
+                  f"{phone or '-'}, {address or '-'}")
+    print(f"{len(clusters):,} clusters of possible duplicates "
+          f"({sum(len(members) for members in clusters):,} patients) from {compared:,} pairs "
+          f"compared in {time.perf_counter() - started:.1f}s")
+
+def run_merge_patients(args):
+    conn = ConnectionManager.get().connect()
+    migrate(conn)
+    try:
+        moved = DuplicateFinder(conn).merge(args.survivor, args.duplicates)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    print(f"Merged {len(set(args.duplicates))} patients into {args.survivor} "
+          f"({', '.join(f'{table}: {count:,}' for table, count in moved.items())})")
+
+def run_backup(args):
+    manager = ConnectionManager.get()
+    migrate(manager.writer)
+    backups = BackupSet(args.directory)
+    while True:
+        try:
+            stats = backups.snapshot(manager, pages=args.pages, sleep_ms=args.sleep_ms,
+                                     full_every=args.full_every)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+        print(f"{stats['name']}: {'full' if stats['full'] else 'incremental'}, "
+              f"{stats['pages']:,} pages in {stats['seconds']:.1f}s ({stats['mb_per_s']} MB/s), "
+              f"{stats['changed_pages']:,} pages stored ({stats['bytes'] / 1e6:.1f} MB), "
+              f"integrity ok. Writes waited at most {stats['max_write_wait_ms']} ms "
+              f"({stats['write_probes']} probes); WAL peaked at {stats['max_wal_mb']} MB")
+        for name in backups.rotate(args.keep):
+            print(f"Removed {name}")
+        if not args.every:
+            return
+        time.sleep(args.every * 60)
+
+def run_restore(args):
+    backups = BackupSet(args.directory)
+    if args.list:
+        for s in backups.snapshots():
+            kind = 'full' if s['parent'] is None else 'incremental'
+            print(f"{s['name']}  {s['created']}  {kind:<11}  {s['pages']:,} pages")
+        return
+    try:
+        name, elapsed = backups.restore(ConnectionManager.get(), args.snapshot)
+    except (ValueError, KeyError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    print(f"Restored {name} in {elapsed:.1f}s")
+
+def run_serve(args):
+    try:
+        service = HospitalService(ConnectionManager.get(), args.host, args.port, args.readers,
+                                  os.environ.get('HOSPITAL_SERVICE_TOKEN'))
+    except OSError as e:
+        print(f"Error: cannot listen on {args.host}:{args.port}: {e}", file=sys.stderr)
+        return 1
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    host, port = service.address
+    print(f"Serving {service.manager.path} on http://{host}:{port} "
+          f"with {args.readers} readers; desks run python main.py --service http://{host}:{port}",
+          flush=True)
+    # Stopped with Ctrl+C or by the service manager's SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+def run_import(args):
+    conn = ConnectionManager.get().connect()
+    migrate(conn)
+    importer = BulkImporter(conn, args.entity, args.path, source=args.source,
+                            file_format=args.format, batch_size=args.batch_size,
+                            defer_indexes=args.defer_indexes, rejects_path=args.rejects,
+                            resume=args.resume)
+    try:
+        importer.run()
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+def run_export(args):
+    conn = ConnectionManager.get().connect(readonly=True)
+    exporter = Exporter(conn, chunk_size=args.chunk_size)
+    try:
+        archives = exporter.attach_archives(args.patient, args.date_from, args.date_to)
+        datasets = exporter.datasets(args.patient, args.doctor, args.date_from, args.date_to,
+                                     archives)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    tables = args.tables.split(',') if args.tables else None
+    rows, elapsed = exporter.export(datasets, args.output, args.format, tables)
+    conn.close()
+    print(f"Exported {rows:,} rows to {args.output} in {elapsed:.1f}s "
+          f"({rows / elapsed if elapsed else 0:,.0f} rows/s)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hospital Management System")
+    parser.add_argument('--db', help="database file (default: $HOSPITAL_DB or hospital.db)")
+    parser.add_argument('--service', help="use the hospital service at this URL instead of "
+                                          "opening the database (default: $HOSPITAL_SERVICE)")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('migrate', help="apply pending schema migrations")
+    commands.add_parser('check-plans', help="verify hot queries are index-backed")
+    summaries_parser = commands.add_parser('rebuild-summaries',
+                                           help="recount the report summaries from scratch")
+    summaries_parser.add_argument('--check', action='store_true',
+                                  help="only report summary rows that differ from a recount")
+    archive_parser = commands.add_parser('archive',
+                                         help="move closed rows older than a date to yearly files")
+    archive_parser.add_argument('--before', required=True,
+                                help="archive rows dated before this day (YYYY-MM-DD)")
+    archive_parser.add_argument('--batch-size', type=int, default=500)
+    duplicates_parser = commands.add_parser('duplicates',
+                                            help="list patients that may be registered twice")
+    duplicates_parser.add_argument('--min-score', type=float, default=DUPLICATE_SCORE,
+                                   help="similarity from 0 to 1 above which patients match")
+    merge_parser = commands.add_parser('merge-patients',
+                                       help="merge duplicate patients into the one to keep")
+    merge_parser.add_argument('survivor', help="ID of the patient to keep")
+    merge_parser.add_argument('duplicates', nargs='+', help="IDs of the patients merged into it")
+    serve_parser = commands.add_parser('serve', help="serve the database to desks over HTTP")
+    serve_parser.add_argument('--host', default='127.0.0.1',
+                              help="address to listen on (default: this computer only; "
+                                   "any other needs $HOSPITAL_SERVICE_TOKEN)")
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--readers', type=int, default=4,
+                              help="read-only connections shared by the desks")
+    backup_parser = commands.add_parser('backup', help="snapshot the database while it is in use")
+    backup_parser.add_argument('directory', help="directory holding the snapshots")
+    backup_parser.add_argument('--every', type=float,
+                               help="keep running, taking a snapshot every this many minutes")
+    backup_parser.add_argument('--keep', type=int, default=48, help="snapshots to keep")
+    backup_parser.add_argument('--full-every', type=int, default=24,
+                               help="store every Nth snapshot whole, the rest as changed pages")
+    backup_parser.add_argument('--pages', type=int, default=1024, help="pages copied per step")
+    backup_parser.add_argument('--sleep-ms', type=float, default=5,
+                               help="pause between steps")
+    restore_parser = commands.add_parser('restore', help="copy a snapshot back over the database")
+    restore_parser.add_argument('directory', help="directory holding the snapshots")
+    restore_parser.add_argument('--snapshot', help="snapshot name (default: the newest)")
+    restore_parser.add_argument('--list', action='store_true', help="list the snapshots")
+    import_parser = commands.add_parser('import', help="bulk import CSV or JSONL data")
+    import_parser.add_argument('entity', choices=sorted(BulkImporter.ENTITIES))
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'])
+    import_parser.add_argument('--source', help="originating system; external IDs are resolved per source")
+    import_parser.add_argument('--batch-size', type=int, default=10000)
+    import_parser.add_argument('--defer-indexes', action='store_true',
+                               help="drop secondary and search indexes until the load ends")
+    import_parser.add_argument('--rejects', help="file for rejected rows (default: PATH.rejects.jsonl)")
+    import_parser.add_argument('--resume', action='store_true',
+                               help="continue from the last committed checkpoint")
+
+    export_parser = commands.add_parser('export', help="stream records, prescriptions and bills to files")
+    export_parser.add_argument('output', help="directory for CSV, or a .jsonl, .jsonl.gz or .zip file")
+    export_parser.add_argument('--patient', help="only this patient's history")
+    export_parser.add_argument('--doctor', help="only records and appointments of this doctor")
+    export_parser.add_argument('--from', dest='date_from', help="first date (YYYY-MM-DD)")
+    export_parser.add_argument('--to', dest='date_to', help="last date (YYYY-MM-DD)")
+    export_parser.add_argument('--format', choices=['csv', 'jsonl', 'zip'])
+    export_parser.add_argument('--tables', help="comma-separated subset of tables")
+    export_parser.add_argument('--chunk-size', type=int, default=1000)
+
+    analytics_parser = commands.add_parser('analytics',
+                                           help="utilization and census reports over the history")
+    analytics_parser.add_argument('output', help="JSON report file")
+    analytics_parser.add_argument('--from', dest='date_from', help="first date (YYYY-MM-DD)")
+    analytics_parser.add_argument('--to', dest='date_to', help="last date (YYYY-MM-DD)")
+    analytics_parser.add_argument('--workers', type=int,
+                                  help="worker processes (default: one per core)")
+    analytics_parser.add_argument('--partition-months', type=int, default=1,
+                                  help="months of history per worker task")
+    args = parser.parse_args(argv)
+
+    if args.db:
+        ConnectionManager.configure(args.db)
+    if args.command == 'migrate':
+        return run_migrate(args)
+    if args.command == 'check-plans':
+        return run_check_plans(args)
+    if args.command == 'rebuild-summaries':
+        return run_rebuild_summaries(args)
+    if args.command == 'archive':
+        return run_archive(args)
+    if args.command == 'duplicates':
+        return run_duplicates(args)
+    if args.command == 'merge-patients':
+        return run_merge_patients(args)
+    if args.command == 'serve':
+        return run_serve(args)
+    if args.command == 'backup':
+        return run_backup(args)
+    if args.command == 'restore':
+        return run_restore(args)
+    if args.command == 'import':
+        return run_import(args)
+    if args.command == 'export':
+        return run_export(args)
+    if args.command == 'analytics':
+        return run_analytics(args)
+
+    if args.service:
+        DBExecutor.configure(service=args.service)
+
+    # Startup runs until the login form is drawn
+    done = METRICS.start_action('startup')
+    login = LoginWindow()
+    login.root.after_idle(done)
+    login.root.mainloop()
+    # The last window is closed; stop other desks keeping change log
+    # entries for this one
+    ChangeFeed.get().close()
+
+if __name__ == "__main__":
+    sys.exit(main())
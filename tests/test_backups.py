@@ -0,0 +1,68 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from main import BackupSet, ConnectionManager, HospitalDB
+
+class BackupRestoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manager = ConnectionManager(os.path.join(self.directory, 'hospital.db'))
+        self.db = HospitalDB(self.manager)
+        self.backups = BackupSet(os.path.join(self.directory, 'backups'), out=io.StringIO())
+
+    def tearDown(self):
+        self.manager.close()
+        shutil.rmtree(self.directory)
+
+    def register(self, count, start=0):
+        for number in range(start, start + count):
+            patient, _ = self.db.add_patient(f'Patient {number}', 30 + number % 50, 'Female',
+                                             f'98450{number:05d}', 'MG Road', 'O+')
+            self.db.add_bill(patient, 'Consultation', 100.0 + number)
+
+    def contents(self):
+        conn = self.manager.connect(readonly=True)
+        try:
+            return {table: sorted(conn.execute(f'SELECT * FROM {table}'))
+                    for table in ('patients', 'bills', 'revenue_totals')}
+        finally:
+            conn.close()
+
+    def test_full_and_incremental_snapshots_restore_exactly(self):
+        self.register(200)
+        first = self.backups.snapshot(self.manager, pages=16, sleep_ms=0)
+        at_first = self.contents()
+        self.register(20, start=200)
+        second = self.backups.snapshot(self.manager, pages=16, sleep_ms=0)
+        at_second = self.contents()
+        self.assertTrue(first['full'])
+        self.assertFalse(second['full'])
+        self.assertLess(second['changed_pages'], second['pages'])
+
+        self.register(20, start=220)
+        self.assertEqual(self.backups.restore(self.manager)[0], second['name'])
+        self.assertEqual(self.contents(), at_second)
+        self.backups.restore(self.manager, first['name'])
+        self.assertEqual(self.contents(), at_first)
+        conn = self.manager.connect(readonly=True)
+        try:
+            self.assertEqual(conn.execute('PRAGMA integrity_check').fetchall(), [('ok',)])
+        finally:
+            conn.close()
+
+    def test_corrupt_delta_is_refused(self):
+        self.register(50)
+        self.backups.snapshot(self.manager, pages=16, sleep_ms=0)
+        self.register(5, start=50)
+        second = self.backups.snapshot(self.manager, pages=16, sleep_ms=0)
+        delta = self.backups.path(second['name'] + '.delta.gz')
+        with open(delta, 'wb') as f:
+            f.write(b'')
+        with self.assertRaisesRegex(ValueError, 'does not match'):
+            self.backups.restore(self.manager, second['name'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from main import (BILL_LIST, RECORD_LIST, Archiver, ConnectionManager, DuplicateFinder,
+                  HospitalDB, parse_uid)
+
+class MergeArchivedPatientTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manager = ConnectionManager(os.path.join(self.directory, 'hospital.db'))
+        db = HospitalDB(self.manager)
+        self.survivor, _ = db.add_patient('Mary Smith', 34, 'Female', '9845012345', '', 'O+')
+        self.duplicate, _ = db.add_patient('Mary Smyth', 34, 'Female', '+91 98450 12345',
+                                           'MG Road', '')
+        doctor, _ = db.add_doctor('Dr. Rao', 'Cardiology', '9000000000', 'rao@example.com')
+        prescription = [('Paracetamol', '500 mg', 'Twice daily', '3 days')]
+        for patient in (self.duplicate, self.duplicate, self.survivor):
+            db.add_bill(patient, 'Consultation', 500.0)
+            db.add_medical_record(patient, doctor, 'Migraine', 'Rest', '', prescription)
+        # The duplicate's first bill and record are old enough to archive;
+        # the newest row of each table always stays
+        conn = self.manager.connect()
+        for table in ('bills', 'medical_records'):
+            conn.execute(f'''UPDATE {table} SET date = '2020-03-01'
+                             WHERE rowid = (SELECT min(rowid) FROM {table})''')
+        conn.execute("UPDATE bills SET status = 'Paid'")
+        conn.commit()
+        moved, elapsed = Archiver(conn, '2021-01-01', out=io.StringIO()).run()
+        self.assertEqual(moved, {'appointments': 0, 'medical_records': 1, 'bills': 1})
+        conn.close()
+        self.conn = self.manager.connect()
+
+    def tearDown(self):
+        self.conn.close()
+        self.manager.close()
+        shutil.rmtree(self.directory)
+
+    def history(self, query, patient):
+        db = HospitalDB(self.manager, reader=self.manager.connect(readonly=True))
+        try:
+            return (db.count_rows(query, (parse_uid(patient),), 100),
+                    len(db.fetch_page(query, (parse_uid(patient),), None, 100)))
+        finally:
+            db.reader.close()
+
+    def test_merge_moves_working_and_archived_rows(self):
+        self.assertEqual(self.history(BILL_LIST, self.duplicate), (2, 2))
+        moved = DuplicateFinder(self.conn).merge(self.survivor, [self.duplicate])
+        self.assertEqual(moved['bills'], 2)
+        self.assertEqual(moved['medical_records'], 2)
+
+        self.assertEqual(self.history(BILL_LIST, self.survivor), (3, 3))
+        self.assertEqual(self.history(RECORD_LIST, self.survivor), (3, 3))
+        survivor_key = self.conn.execute('SELECT patient_id FROM patients WHERE uid = ?',
+                                         (parse_uid(self.survivor),)).fetchone()[0]
+        self.conn.execute("ATTACH DATABASE ? AS archive",
+                          (os.path.join(self.directory, 'hospital-2020.db'),))
+        for table in ('bills', 'medical_records'):
+            self.assertEqual(self.conn.execute(
+                f'SELECT DISTINCT patient_id FROM archive.{table}').fetchall(), [(survivor_key,)])
+        self.assertEqual(self.conn.execute('''
+        SELECT DISTINCT patient_id FROM archive_contents''').fetchall(), [(survivor_key,)])
+        self.conn.execute('DETACH DATABASE archive')
+
+        self.assertIsNone(self.conn.execute('SELECT 1 FROM patients WHERE uid = ?',
+                                            (parse_uid(self.duplicate),)).fetchone())
+        self.assertEqual(self.conn.execute('PRAGMA foreign_key_check').fetchall(), [])
+        # Blank fields of the patient kept are filled from the duplicate
+        self.assertEqual(self.conn.execute('SELECT address, blood_group FROM patients').fetchall(),
+                         [('MG Road', 'O+')])
+
+    def test_merge_refuses_merging_a_patient_into_itself(self):
+        with self.assertRaises(ValueError):
+            DuplicateFinder(self.conn).merge(self.survivor, [self.survivor])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from main import METRICS, ConnectionManager
+
+class StatementCountTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.enabled = METRICS.enabled
+        METRICS.enabled = True
+        self.conn = ConnectionManager(os.path.join(self.directory, 'hospital.db')).connect()
+        self.conn.executescript('''
+        CREATE TABLE items (value INTEGER);
+        CREATE TABLE audit (value INTEGER);
+        CREATE TRIGGER items_audit AFTER INSERT ON items BEGIN
+            INSERT INTO audit VALUES (new.value);
+            INSERT INTO audit VALUES (new.value + 1);
+        END;
+        ''')
+        METRICS.reset()
+
+    def tearDown(self):
+        self.conn.close()
+        METRICS.enabled = self.enabled
+        METRICS.reset()
+        shutil.rmtree(self.directory)
+
+    def statement(self, sql):
+        return METRICS.snapshot()['statements'][sql]
+
+    def test_identical_executions_are_each_recorded(self):
+        @METRICS.timed
+        def poll(conn):
+            return conn.execute('SELECT 1').fetchone()
+
+        for _ in range(5):
+            poll(self.conn)
+        cursor = self.conn.cursor()
+        for _ in range(3):
+            cursor.execute('SELECT 1')
+        stats = self.statement('SELECT ?')
+        self.assertEqual(stats['calls'], 8)
+        self.assertEqual(stats['count'], 5)
+
+    def test_trigger_statements_are_not_counted_as_executions(self):
+        for _ in range(3):
+            self.conn.execute('INSERT INTO items VALUES (7)')
+        self.conn.executemany('INSERT INTO items VALUES (?)', [(7,), (7,)])
+        self.assertEqual(self.statement('INSERT INTO items VALUES (?)')['calls'], 5)
+        self.assertEqual(self.conn.execute('SELECT count(*) FROM audit').fetchone()[0], 10)
+
+if __name__ == '__main__':
+    unittest.main()
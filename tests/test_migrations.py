@@ -0,0 +1,164 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import uuid
+from datetime import datetime
+
+from main import MIGRATIONS, ConnectionManager, migrate, timestamp_of, uid_text
+
+# The schema the app created before migrations existed: uuid4 text keys
+# and free-text appointment dates, from both HospitalDB definitions
+BASELINE_SCHEMA = '''
+CREATE TABLE users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    role TEXT NOT NULL
+);
+CREATE TABLE patients (
+    patient_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    age INTEGER,
+    gender TEXT,
+    phone TEXT,
+    address TEXT,
+    blood_group TEXT
+);
+CREATE TABLE doctors (
+    doctor_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    specialization TEXT,
+    phone TEXT,
+    email TEXT
+);
+CREATE TABLE appointments (
+    appointment_id TEXT PRIMARY KEY,
+    patient_id TEXT,
+    doctor_id TEXT,
+    date TEXT,
+    time TEXT,
+    status TEXT,
+    FOREIGN KEY (patient_id) REFERENCES patients (patient_id),
+    FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id)
+);
+CREATE TABLE medical_records (
+    record_id TEXT PRIMARY KEY,
+    patient_id TEXT,
+    doctor_id TEXT,
+    date TEXT,
+    diagnosis TEXT,
+    treatment TEXT,
+    notes TEXT,
+    FOREIGN KEY (patient_id) REFERENCES patients (patient_id),
+    FOREIGN KEY (doctor_id) REFERENCES doctors (doctor_id)
+);
+CREATE TABLE prescriptions (
+    prescription_id TEXT PRIMARY KEY,
+    record_id TEXT,
+    medicine_name TEXT,
+    dosage TEXT,
+    frequency TEXT,
+    duration TEXT,
+    FOREIGN KEY (record_id) REFERENCES medical_records (record_id)
+);
+CREATE TABLE bills (
+    bill_id TEXT PRIMARY KEY,
+    patient_id TEXT,
+    date TEXT,
+    description TEXT,
+    amount REAL,
+    status TEXT,
+    FOREIGN KEY (patient_id) REFERENCES patients (patient_id)
+);
+'''
+
+class BaselineMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'hospital.db')
+        self.ids = {name: str(uuid.uuid4()) for name in
+                    ('mary', 'john', 'doctor', 'visit', 'unreadable', 'record', 'dose', 'bill')}
+        ids = self.ids
+        conn = sqlite3.connect(self.path)
+        conn.executescript(BASELINE_SCHEMA)
+        conn.execute("INSERT INTO users VALUES ('admin', 'hash', 'admin')")
+        conn.executemany('INSERT INTO patients VALUES (?, ?, ?, ?, ?, ?, ?)', [
+            (ids['mary'], 'Mary Smith', 34, 'Female', '9845012345', 'MG Road', 'O+'),
+            (ids['john'], 'John Lee', 51, 'Male', '9845099999', 'Park Ave', 'A-'),
+        ])
+        conn.execute('INSERT INTO doctors VALUES (?, ?, ?, ?, ?)',
+                     (ids['doctor'], 'Dr. Rao', 'Cardiology', '9000000000', 'rao@example.com'))
+        conn.executemany('INSERT INTO appointments VALUES (?, ?, ?, ?, ?, ?)', [
+            (ids['visit'], ids['mary'], ids['doctor'], '2024-03-05', '10:30', 'Scheduled'),
+            (ids['unreadable'], ids['john'], ids['doctor'], 'next tuesday', '', 'Scheduled'),
+        ])
+        conn.execute('INSERT INTO medical_records VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (ids['record'], ids['mary'], ids['doctor'], '2024-03-05', 'Migraine',
+                      'Rest', ''))
+        conn.execute('INSERT INTO prescriptions VALUES (?, ?, ?, ?, ?, ?)',
+                     (ids['dose'], ids['record'], 'Paracetamol', '500 mg', 'Twice daily',
+                      '3 days'))
+        conn.execute('INSERT INTO bills VALUES (?, ?, ?, ?, ?, ?)',
+                     (ids['bill'], ids['john'], '2024-03-06', 'Consultation', 500.0, 'Paid'))
+        conn.commit()
+        conn.close()
+        self.conn = ConnectionManager(self.path).connect()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def patient_key(self, name):
+        return self.conn.execute('SELECT patient_id FROM patients WHERE uid = ?',
+                                 (uuid.UUID(self.ids[name]).bytes,)).fetchone()[0]
+
+    def test_applies_every_step_once(self):
+        applied = migrate(self.conn)
+        self.assertEqual([number for number, step in applied], list(range(1, len(MIGRATIONS) + 1)))
+        self.assertEqual(self.conn.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(migrate(self.conn), [])
+
+    def test_database_is_consistent(self):
+        migrate(self.conn)
+        self.assertEqual(self.conn.execute('PRAGMA integrity_check').fetchall(), [('ok',)])
+        self.assertEqual(self.conn.execute('PRAGMA foreign_key_check').fetchall(), [])
+        self.assertEqual(self.conn.execute('SELECT count(*) FROM users').fetchone()[0], 1)
+
+    def test_keeps_ids_as_compact_uids(self):
+        migrate(self.conn)
+        for table, key in (('patients', 'mary'), ('patients', 'john'), ('doctors', 'doctor'),
+                           ('appointments', 'visit'), ('medical_records', 'record'),
+                           ('prescriptions', 'dose'), ('bills', 'bill')):
+            uid = self.conn.execute(f'SELECT uid FROM {table} WHERE uid = ?',
+                                    (uuid.UUID(self.ids[key]).bytes,)).fetchone()[0]
+            self.assertEqual(len(uid), 16)
+            self.assertEqual(uid_text(uid), self.ids[key])
+
+    def test_rewrites_foreign_keys_to_integer_keys(self):
+        migrate(self.conn)
+        patient, doctor = self.conn.execute('''
+        SELECT patient_id, doctor_id FROM appointments WHERE uid = ?''',
+            (uuid.UUID(self.ids['visit']).bytes,)).fetchone()
+        self.assertEqual(patient, self.patient_key('mary'))
+        self.assertIsInstance(doctor, int)
+        bill_patient = self.conn.execute('SELECT patient_id FROM bills').fetchone()[0]
+        self.assertEqual(bill_patient, self.patient_key('john'))
+        record = self.conn.execute('''
+        SELECT m.uid FROM prescriptions p JOIN medical_records m ON m.record_id = p.record_id
+        ''').fetchone()[0]
+        self.assertEqual(uid_text(record), self.ids['record'])
+
+    def test_converts_appointment_times(self):
+        migrate(self.conn)
+        rows = dict(self.conn.execute('SELECT uid, starts_at FROM appointments'))
+        self.assertEqual(rows[uuid.UUID(self.ids['visit']).bytes],
+                         timestamp_of(datetime(2024, 3, 5, 10, 30)))
+        starts_at, entered_as = self.conn.execute('''
+        SELECT starts_at, entered_as FROM appointments WHERE uid = ?''',
+            (uuid.UUID(self.ids['unreadable']).bytes,)).fetchone()
+        self.assertIsNone(starts_at)
+        self.assertEqual(entered_as, 'next tuesday')
+
+if __name__ == '__main__':
+    unittest.main()
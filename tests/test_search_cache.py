@@ -0,0 +1,28 @@
+import unittest
+
+from main import SearchCache
+
+PATIENT = ('0190a1b2-c3d4-7e5f-8a9b-0c1d2e3f4a5b', 'Mary Smith', 'Patient', 'Female')
+OTHER = ('0190a1b2-d000-7000-8000-000000000000', 'John Lee', 'Patient', 'Male')
+
+class SearchCacheTest(unittest.TestCase):
+    def test_narrows_dashless_id_prefix(self):
+        cache = SearchCache()
+        cache.put('Patient ID', '0190a1b2', [PATIENT, OTHER], True)
+        self.assertEqual(cache.get('Patient ID', '0190a1b2c'), [PATIENT])
+        self.assertEqual(cache.get('Patient ID', '0190a1b2c3d4'), [PATIENT])
+        self.assertEqual(cache.get('Patient ID', '0190a1b2-c3d4-7e'), [PATIENT])
+
+    def test_narrows_name_prefix(self):
+        cache = SearchCache()
+        cache.put('Patient Name', 'm', [PATIENT], True)
+        self.assertEqual(cache.get('Patient Name', 'Mary Sm'), [PATIENT])
+        self.assertEqual(cache.get('Patient Name', 'Maz'), [])
+
+    def test_incomplete_results_are_not_narrowed(self):
+        cache = SearchCache()
+        cache.put('Patient ID', '0190', [PATIENT], False)
+        self.assertIsNone(cache.get('Patient ID', '0190a'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from main import ConnectionManager, HospitalDB, WriteQueue
+
+def insert(conn, value):
+    conn.execute('INSERT INTO items (value) VALUES (?)', (value,))
+    return value
+
+def fail(conn, value):
+    conn.execute('INSERT INTO items (value) VALUES (?)', (value,))
+    raise ValueError(f"{value} is refused")
+
+class WriteQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manager = ConnectionManager(os.path.join(self.directory, 'hospital.db'))
+        conn = self.manager.connect()
+        conn.execute('CREATE TABLE items (value TEXT)')
+        conn.commit()
+        conn.close()
+        self.queues = []
+
+    def tearDown(self):
+        for writes in self.queues:
+            writes.close()
+        shutil.rmtree(self.directory)
+
+    def queue(self, **options):
+        writes = WriteQueue(self.manager, **options)
+        self.queues.append(writes)
+        return writes
+
+    def values(self):
+        conn = self.manager.connect(readonly=True)
+        try:
+            return sorted(value for (value,) in conn.execute('SELECT value FROM items'))
+        finally:
+            conn.close()
+
+    def test_failing_operation_is_undone_alone_within_its_batch(self):
+        writes = self.queue()
+        # Hold the writer in a first transaction so the next three queue up
+        # and are committed together
+        started, release = threading.Event(), threading.Event()
+
+        def hold(conn):
+            started.set()
+            release.wait(5)
+
+        held = writes.submit(hold)
+        started.wait(5)
+        futures = [writes.submit(insert, 'a'), writes.submit(fail, 'b'), writes.submit(insert, 'c')]
+        release.set()
+        held.result(5)
+        self.assertEqual(futures[0].result(5), 'a')
+        with self.assertRaisesRegex(ValueError, 'b is refused'):
+            futures[1].result(5)
+        self.assertEqual(futures[2].result(5), 'c')
+        self.assertEqual(writes.batches, 2)
+        self.assertEqual(self.values(), ['a', 'c'])
+
+    def test_lone_failing_operation_is_rolled_back(self):
+        writes = self.queue()
+        with self.assertRaises(ValueError):
+            writes.write(fail, 'x')
+        self.assertEqual(writes.write(insert, 'y'), 'y')
+        self.assertEqual(self.values(), ['y'])
+
+    def test_waits_for_another_process_holding_the_lock(self):
+        writes = self.queue(lock_timeout_ms=5000)
+        other = self.manager.connect()
+        other.execute('BEGIN IMMEDIATE')
+        future = writes.submit(insert, 'late')
+        time.sleep(0.2)
+        self.assertFalse(future.done())
+        other.commit()
+        other.close()
+        self.assertEqual(future.result(5), 'late')
+        self.assertEqual(self.values(), ['late'])
+
+    def test_reports_busy_when_the_lock_is_not_released(self):
+        writes = self.queue(lock_timeout_ms=200)
+        other = self.manager.connect()
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            with self.assertRaisesRegex(sqlite3.OperationalError, 'busy'):
+                writes.write(insert, 'lost')
+        finally:
+            other.rollback()
+            other.close()
+        self.assertEqual(self.values(), [])
+
+    def test_batch_of_cancelled_operations_does_not_take_the_lock(self):
+        writes = self.queue()
+        begun = []
+        begin = writes.begin
+        writes.begin = lambda conn: begun.append(conn) or begin(conn)
+        started, release = threading.Event(), threading.Event()
+
+        def hold(conn):
+            started.set()
+            release.wait(5)
+
+        held = writes.submit(hold)
+        started.wait(5)
+        self.assertTrue(writes.submit(insert, 'cancelled').cancel())
+        release.set()
+        held.result(5)
+        self.assertEqual(writes.write(insert, 'kept'), 'kept')
+        self.assertEqual(len(begun), 2)
+        self.assertEqual(self.values(), ['kept'])
+
+    def test_concurrent_databases_share_one_queue(self):
+        # As DBExecutor's workers do, several threads build a HospitalDB on
+        # a fresh manager at once
+        for attempt in range(20):
+            manager = ConnectionManager(os.path.join(self.directory, f'shared-{attempt}.db'))
+            manager.prepare()
+            barrier = threading.Barrier(4)
+            queues = []
+
+            def build():
+                barrier.wait(5)
+                queues.append(HospitalDB(manager, reader=manager.writer).writes)
+
+            threads = [threading.Thread(target=build) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+            try:
+                self.assertEqual(len(queues), 4)
+                self.assertTrue(all(writes is manager.write_queue for writes in queues))
+            finally:
+                manager.close()
+
+if __name__ == '__main__':
+    unittest.main()